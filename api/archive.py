@@ -0,0 +1,118 @@
+"""
+    Retention of the Message table.
+
+    archive_messages() moves read messages older than settings.MESSAGE_ARCHIVE_AFTER_DAYS
+    into ArchivedMessage, one transaction per batch, so Message and its indexes only hold
+    the recent window, unread messages and the last message of each conversation (still
+    referenced by its ConversationSummary). On PostgreSQL the archive is partitioned by
+    month of created_at, the partitions a batch needs are created before it is copied.
+    Schedule it with cron through `manage.py archive_messages`, or call archive_messages()
+    from any periodic task runner.
+
+    History reads through to the archive. The newest archived (created_at, id) of each
+    friendship is cached, only a conversation page reaching past it also reads the
+    archive. Each batch drops the entries of the friendships it archived; with a per
+    process cache, other workers may miss the latest archived rows for up to
+    settings.FRIENDS_CACHE_TIMEOUT.
+"""
+import gzip
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import Message, ArchivedMessage, ConversationSummary
+
+FIELDS = ('id', 'friendship_id', 'sender_id', 'recipient_id', 'content', 'created_at', 'has_been_read', 'read_at')
+
+_missing = object()
+
+
+def enabled():
+    return settings.MESSAGE_ARCHIVE_AFTER_DAYS is not None
+
+
+def archive_cutoff():
+    return timezone.now() - timedelta(days=settings.MESSAGE_ARCHIVE_AFTER_DAYS)
+
+
+def archivable(cutoff):
+    # NOT IN over a NULL would match nothing.
+    last_messages = ConversationSummary.objects.filter(last_message__isnull=False).values('last_message_id')
+    return Message.objects.filter(created_at__lt=cutoff, has_been_read=True).exclude(id__in=last_messages)
+
+
+def create_partitions(rows, created):
+    """Creates the monthly partitions of the archive the rows fall in, on PostgreSQL. `created` caches their names."""
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        for year, month in sorted({(row['created_at'].year, row['created_at'].month) for row in rows}):
+            name = f'api_archivedmessage_p{year}_{month:02d}'
+            if name in created:
+                continue
+            start = datetime(year, month, 1, tzinfo=dt_timezone.utc)
+            end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=dt_timezone.utc)
+            cursor.execute(f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "api_archivedmessage" '
+                           'FOR VALUES FROM (%s) TO (%s)', [start, end])
+            created.add(name)
+
+
+def archive_messages(batch_size=1000, export=None):
+    """
+        Moves every archivable message to the archive and returns how many were moved.
+        With `export`, a file path, the moved rows are also written there as gzip compressed
+        JSON lines, each batch once it is committed.
+    """
+    cutoff = archive_cutoff()
+    archived, last_id, partitions = 0, 0, set()
+    export_file = gzip.open(export, 'wt') if export else None
+    try:
+        while True:
+            with transaction.atomic():
+                rows = list(archivable(cutoff).filter(id__gt=last_id).order_by('id').values(*FIELDS)[:batch_size])
+                if not rows:
+                    break
+                create_partitions(rows, partitions)
+                ArchivedMessage.objects.bulk_create([ArchivedMessage(**row) for row in rows])
+                Message.objects.filter(id__in=[row['id'] for row in rows]).delete()
+            cache.delete_many([horizon_key(friendship_id) for friendship_id in {row['friendship_id'] for row in rows}])
+            if export_file:
+                export_file.writelines(json.dumps(row, cls=DjangoJSONEncoder) + '\n' for row in rows)
+            archived += len(rows)
+            last_id = rows[-1]['id']
+    finally:
+        if export_file:
+            export_file.close()
+    return archived
+
+
+def horizon_key(friendship_id):
+    return f'archive_horizon.{friendship_id}'
+
+
+def archive_horizon(friendship_id):
+    """The (created_at, id) of the newest archived message of the friendship, None if there is none."""
+    horizon = cache.get(horizon_key(friendship_id), _missing)
+    if horizon is _missing:
+        horizon = ArchivedMessage.objects.filter(friendship_id=friendship_id).order_by('-created_at', '-id') \
+            .values_list('created_at', 'id').first()
+        cache.set(horizon_key(friendship_id), horizon, settings.FRIENDS_CACHE_TIMEOUT)
+    return horizon
+
+
+def reaches_archive(friendship_id, page, after, limit):
+    """
+        Whether archived messages may belong to a conversation page read from Message: the
+        `limit + 1` rows fetched from the cursor, oldest first after `after`, newest first otherwise.
+    """
+    if not enabled():
+        return False
+    horizon = archive_horizon(friendship_id)
+    if horizon is None:
+        return False
+    if after:
+        return tuple(after) < horizon
+    return len(page) <= limit or (page[-1]['created_at'], page[-1]['id']) < horizon
@@ -0,0 +1,35 @@
+"""
+    Incremental maintenance of ConversationSummary rows, so the inbox never has to
+    be derived from the message history.
+"""
+from collections import defaultdict, Counter
+from django.db.models import Q, F, Value
+from django.db.models.functions import Greatest
+from .models import ConversationSummary
+
+PREVIEW_LENGTH = 50
+
+
+def record_messages(messages):
+    """Moves each conversation's last message forward and counts the messages as unread for their recipient."""
+    by_friendship = defaultdict(list)
+    for message in messages:
+        by_friendship[message.friendship_id].append(message)
+    for friendship_id, batch in by_friendship.items():
+        last = max(batch, key=lambda message: message.id)
+        summaries = ConversationSummary.objects.filter(friendship_id=friendship_id)
+        summaries.filter(Q(last_message__isnull=True) | Q(last_message__lt=last.id)).update(
+            last_message=last,
+            last_message_sender_id=last.sender_id,
+            last_message_preview=last.content[:PREVIEW_LENGTH],
+            last_message_at=last.created_at
+        )
+        for recipient_id, count in Counter(message.recipient_id for message in batch).items():
+            summaries.filter(user_id=recipient_id).update(unread_count=F('unread_count') + count)
+
+
+def record_read(friendship_id, user_id, count):
+    if not count:
+        return
+    ConversationSummary.objects.filter(friendship_id=friendship_id, user_id=user_id) \
+        .update(unread_count=Greatest(F('unread_count') - count, Value(0)))
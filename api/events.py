@@ -0,0 +1,91 @@
+"""
+    Per-user event log behind the sync endpoint. Every event pushed to a user's
+    sockets is appended here first, so a client that was offline can ask for
+    everything after the last seq it saw instead of reloading its whole state.
+
+    The log is bounded: prune_events() drops events older than
+    settings.EVENT_LOG_MAX_AGE_DAYS and past the newest settings.EVENT_LOG_MAX_EVENTS
+    of each user, run it with cron through `manage.py prune_events`. A client syncing
+    from a pruned seq gets ResyncRequired instead of a partial log.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Max
+from django.utils import timezone
+from .models import UserEvent, UserEventSequence
+
+
+class ResyncRequired(Exception):
+    """Events after the cursor were pruned. `cursor` is the user's last seq, to sync from once reloaded."""
+
+    def __init__(self, cursor):
+        super().__init__(cursor)
+        self.cursor = cursor
+
+
+def allocate_seqs(user_id, count):
+    """Reserves the next `count` sequence numbers of the user, holding their sequence row locked until commit."""
+    sequence = UserEventSequence.objects.filter(user_id=user_id)
+    if not sequence.update(last_seq=F('last_seq') + count):
+        UserEventSequence.objects.get_or_create(user_id=user_id)
+        sequence.update(last_seq=F('last_seq') + count)
+    last_seq = sequence.values_list('last_seq', flat=True).get()
+    return range(last_seq - count + 1, last_seq + 1)
+
+
+def record_events(user_id, events):
+    """
+        Appends (type, content) pairs to the user's log and returns their sequence numbers.
+        The append commits together with the allocation, so no event can become visible
+        after a later one of the same user.
+    """
+    if not events:
+        return []
+    with transaction.atomic():
+        seqs = allocate_seqs(user_id, len(events))
+        UserEvent.objects.bulk_create([
+            UserEvent(user_id=user_id, seq=seq, type=event_type, content=content)
+            for seq, (event_type, content) in zip(seqs, events)
+        ])
+    return list(seqs)
+
+
+def events_since(user_id, cursor, limit):
+    """
+        Returns up to `limit` events of the user after `cursor`, oldest first, and whether more
+        follow. Raises ResyncRequired if some of them were pruned.
+    """
+    events = list(UserEvent.objects.filter(user_id=user_id, seq__gt=cursor).order_by('seq')
+                  .values('seq', 'type', 'content')[:limit + 1])
+    # Seqs have no gaps: a log starting right after the cursor cannot have lost events.
+    if not events or events[0]['seq'] != cursor + 1:
+        sequence = UserEventSequence.objects.filter(user_id=user_id).values_list('pruned_through', 'last_seq').first()
+        if sequence is not None and cursor < sequence[0]:
+            raise ResyncRequired(sequence[1])
+    return events[:limit], len(events) > limit
+
+
+def prune_targets(cutoff, max_events):
+    """Maps each user with events to prune to the seq to prune through."""
+    targets = dict(UserEvent.objects.filter(created_at__lt=cutoff).values('user_id')
+                   .annotate(through=Max('seq')).values_list('user_id', 'through'))
+    over_cap = UserEventSequence.objects.filter(last_seq__gt=F('pruned_through') + max_events)
+    for user_id, last_seq in over_cap.values_list('user_id', 'last_seq'):
+        targets[user_id] = max(targets.get(user_id, 0), last_seq - max_events)
+    return targets
+
+
+def prune_events(batch_size=100):
+    """Drops the events past retention, the logs of `batch_size` users per transaction. Returns how many."""
+    cutoff = timezone.now() - timedelta(days=settings.EVENT_LOG_MAX_AGE_DAYS)
+    targets = list(prune_targets(cutoff, settings.EVENT_LOG_MAX_EVENTS).items())
+    pruned = 0
+    for start in range(0, len(targets), batch_size):
+        with transaction.atomic():
+            for user_id, through in targets[start:start + batch_size]:
+                deleted, _ = UserEvent.objects.filter(user_id=user_id, seq__lte=through).delete()
+                pruned += deleted
+                UserEventSequence.objects.filter(user_id=user_id, pruned_through__lt=through) \
+                    .update(pruned_through=through)
+    return pruned
@@ -0,0 +1,57 @@
+"""
+    Per-user friend cache, so friendship checks on the message path need no query,
+    and the rendered friend list served by GetFriends. Entries are dropped whenever
+    a Friendship of the user is saved or deleted.
+"""
+import json
+import hashlib
+from django.conf import settings
+from django.core.cache import cache
+from .models import Friendship
+from .serializers import FriendshipOutSerializer
+
+
+def friends_key(user_id):
+    return f'friends.{user_id}'
+
+
+def get_friends(user_id):
+    """Maps the username of each friend of the user to (friend id, friendship id)."""
+    friends = cache.get(friends_key(user_id))
+    if friends is not None:
+        return friends
+    friends = {}
+    rows = Friendship.objects.of(user_id).values_list('id', 'user_id', 'user__username',
+                                                      'friend_id', 'friend__username')
+    for friendship_id, low_id, low_username, high_id, high_username in rows:
+        if low_id == user_id:
+            friends[high_username] = (high_id, friendship_id)
+        else:
+            friends[low_username] = (low_id, friendship_id)
+    cache.set(friends_key(user_id), friends, settings.FRIENDS_CACHE_TIMEOUT)
+    return friends
+
+
+def friend_list_key(user_id):
+    return f'friend_list.{user_id}'
+
+
+def get_friend_list(user_id):
+    """
+        Returns the ETag and FriendshipOutSerializer data of the user's friendships, oldest first.
+        The ETag is a digest of the data, a list rendered again after an invalidation keeps its ETag
+        if nothing changed.
+    """
+    entry = cache.get(friend_list_key(user_id))
+    if entry is not None:
+        return entry
+    friendships = Friendship.objects.of(user_id).select_related('user', 'friend').order_by('created_at', 'id')
+    friends = [dict(row) for row in FriendshipOutSerializer(friendships, many=True, context={'user_id': user_id}).data]
+    digest = hashlib.sha1(json.dumps(friends, separators=(',', ':')).encode()).hexdigest()
+    entry = (f'"{digest}"', friends)
+    cache.set(friend_list_key(user_id), entry, settings.FRIENDS_CACHE_TIMEOUT)
+    return entry
+
+
+def invalidate_friends(*user_ids):
+    cache.delete_many([key(user_id) for user_id in user_ids for key in (friends_key, friend_list_key)])
@@ -0,0 +1,83 @@
+"""
+    Friend request and friendship transitions.
+
+    Each transition is one transaction of as few statements as it can be. Where they can,
+    lookups by username are folded into the statement doing the work: a request that is not
+    there shows as a DELETE affecting no rows, a duplicate as the IntegrityError of
+    FriendRequest's unique pair. The database holds the invariants: one request per
+    direction, none to oneself, one canonical Friendship per pair. Whether the users are
+    already friends is read from the friend cache. Other rows are read before the
+    transaction, which then starts with a write: on SQLite a transaction reading first
+    fails if another writer commits before its first write. Events follow from the
+    post_save and post_delete receivers of models.py and ws_api/dispatch.py: they are
+    logged inside the same transaction, pushed and the friend caches dropped once it commits.
+"""
+from django.db import transaction, IntegrityError
+from .models import DefaultUser, Friendship, FriendRequest
+from .friends import get_friends
+
+
+class FriendshipError(Exception):
+    """The transition does not apply, the message is meant for the user."""
+
+
+def send_request(user, to_username):
+    if to_username == user.username:
+        raise FriendshipError('Cannot send friend request to yourself!')
+    if to_username in get_friends(user.id):
+        raise FriendshipError('Cannot send friend request to current friend!')
+    to_user = DefaultUser.objects.filter(username=to_username).only('id', 'username').first()
+    if to_user is None:
+        raise FriendshipError('That user does not exists.')
+    try:
+        with transaction.atomic():
+            return FriendRequest.objects.create(from_user=user, to_user=to_user)
+    except IntegrityError:
+        raise FriendshipError('You have already sent a friend request to that user.')
+
+
+def accept_request(user, from_username):
+    """Turns the request into a Friendship, dropping the user's own request to the sender if any."""
+    friend = DefaultUser.objects.filter(username=from_username).only('id', 'username').first()
+    if friend is None:
+        raise FriendshipError('You do not have any pending friend requests from that user.')
+    try:
+        with transaction.atomic():
+            deleted, _ = FriendRequest.objects.filter(from_user=friend, to_user=user).delete()
+            if not deleted:
+                raise FriendshipError('You do not have any pending friend requests from that user.')
+            FriendRequest.objects.filter(from_user=user, to_user=friend).delete()
+            low, high = sorted((user, friend), key=lambda member: member.id)
+            return Friendship.objects.create(user=low, friend=high)
+    except IntegrityError:
+        # Accepted concurrently from another socket.
+        raise FriendshipError('You are already friends with that user.')
+
+
+def reject_request(user, from_username):
+    deleted, _ = FriendRequest.objects.filter(to_user=user, from_user__username=from_username).delete()
+    if not deleted:
+        raise FriendshipError('You do not have any pending friend requests from that user.')
+
+
+def withdraw_request(user, to_username):
+    deleted, _ = FriendRequest.objects.filter(from_user=user, to_user__username=to_username).delete()
+    if not deleted:
+        raise FriendshipError('You do not have a pending friend request sent to that user.')
+
+
+def remove_friend(user, friend_username):
+    """Deletes the friendship with its summaries and messages."""
+    friends = get_friends(user.id)
+    if friend_username not in friends:
+        raise FriendshipError('You do not have a friend with that name.')
+    _, friendship_id = friends[friend_username]
+    # The users are loaded along, the removed_friend events render their usernames.
+    friendship = Friendship.objects.select_related('user', 'friend').filter(id=friendship_id).first()
+    if friendship is None:
+        raise FriendshipError('You do not have a friend with that name.')
+    with transaction.atomic():
+        _, deleted = friendship.delete()
+        if not deleted.get(Friendship._meta.label):
+            # Removed concurrently, its events are rolled back with the rest.
+            raise FriendshipError('You do not have a friend with that name.')
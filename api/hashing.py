@@ -0,0 +1,90 @@
+"""
+    Password hashing off the request workers.
+
+    PBKDF2 is CPU bound by design, a burst of logins would otherwise take every
+    core of the worker serving them. Hashes run on a pool of
+    settings.PASSWORD_HASHING_WORKERS processes instead; at most
+    settings.PASSWORD_HASHING_QUEUE of them may be queued or running per process,
+    past that requests fail right away with a 503 rather than wait. With no
+    workers, hashes run on the calling thread.
+"""
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.contrib.auth.hashers import make_password, check_password
+from rest_framework import exceptions, status
+
+
+class HashingBusy(exceptions.APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many logins in progress, retry shortly.'
+    default_code = 'hashing_busy'
+    wait = 1
+
+
+_executor = None
+_pending = 0
+_lock = threading.Lock()
+
+
+def setup_worker():
+    import django
+    django.setup()
+    if hasattr(os, 'nice'):
+        # Requests keep the CPU when it is contended, logins wait.
+        os.nice(settings.PASSWORD_HASHING_NICENESS)
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        # Spawned rather than forked, the request workers are multithreaded.
+        _executor = ProcessPoolExecutor(max_workers=settings.PASSWORD_HASHING_WORKERS,
+                                        mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=setup_worker)
+    return _executor
+
+
+def finished(future):
+    global _pending
+    with _lock:
+        _pending -= 1
+
+
+def run(func, *args):
+    global _pending
+    if not settings.PASSWORD_HASHING_WORKERS:
+        return func(*args)
+    with _lock:
+        if _pending >= settings.PASSWORD_HASHING_QUEUE:
+            raise HashingBusy
+        _pending += 1
+        try:
+            future = executor().submit(func, *args)
+        except BaseException:
+            _pending -= 1
+            raise
+    future.add_done_callback(finished)
+    return future.result()
+
+
+def verify(password, encoded):
+    """Returns whether the password matches, and its new hash if the stored one is outdated."""
+    rehashed = []
+    valid = check_password(password, encoded, setter=lambda raw: rehashed.append(make_password(raw)))
+    return valid, rehashed[0] if rehashed else None
+
+
+def hash_password(password):
+    return run(make_password, password)
+
+
+def check_user_password(user, password):
+    """User.check_password through the pool, saving the upgraded hash when the hasher changed."""
+    valid, rehashed = run(verify, password, user.password)
+    if rehashed is not None:
+        user.password = rehashed
+        user.save(update_fields=['password'])
+    return valid
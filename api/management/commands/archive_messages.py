@@ -0,0 +1,30 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from api import archive
+
+
+class Command(BaseCommand):
+    help = 'Moves read messages older than settings.MESSAGE_ARCHIVE_AFTER_DAYS into the archive table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Messages moved per transaction.')
+        parser.add_argument('--export', metavar='DIRECTORY',
+                            help='Also writes the moved messages there as a .jsonl.gz file.')
+        parser.add_argument('--dry-run', action='store_true', help='Only counts the messages to move.')
+
+    def handle(self, *args, **options):
+        if not archive.enabled():
+            raise CommandError('MESSAGE_ARCHIVE_AFTER_DAYS is not set.')
+        cutoff = archive.archive_cutoff()
+        if options['dry_run']:
+            self.stdout.write(f'{archive.archivable(cutoff).count()} messages older than {cutoff:%Y-%m-%d %H:%M} '
+                              'to archive')
+            return
+        export = None
+        if options['export']:
+            export = os.path.join(options['export'], f'messages-{timezone.now():%Y%m%dT%H%M%S}.jsonl.gz')
+        count = archive.archive_messages(batch_size=options['batch_size'], export=export)
+        self.stdout.write(f'archived {count} messages older than {cutoff:%Y-%m-%d %H:%M}')
+        if export:
+            self.stdout.write(f'exported to {export}')
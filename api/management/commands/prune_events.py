@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from api import events
+
+
+class Command(BaseCommand):
+    help = 'Drops events of the per-user sync log older than settings.EVENT_LOG_MAX_AGE_DAYS ' \
+           'or past the newest settings.EVENT_LOG_MAX_EVENTS of their user.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Users pruned per transaction.')
+
+    def handle(self, *args, **options):
+        count = events.prune_events(batch_size=options['batch_size'])
+        self.stdout.write(f'pruned {count} events, keeping {settings.EVENT_LOG_MAX_AGE_DAYS} days and at most '
+                          f'{settings.EVENT_LOG_MAX_EVENTS} per user')
@@ -0,0 +1,216 @@
+"""
+    Request instrumentation, exported in the Prometheus text format on /metrics.
+
+    Every REST view (through MetricsMiddleware) and every WebSocket endpoint (through
+    ws_api.consumers.Endpoint) records its wall time, database queries and query time,
+    and response size into histograms labelled with the transport and endpoint name.
+    Open sockets and sockets per user are tracked as gauges.
+
+    Off unless settings.METRICS_ENABLED: the middleware then removes itself and the
+    endpoints skip instrumentation after a single settings lookup. Metrics are per
+    process, each worker is scraped on its own.
+"""
+import threading
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+DURATION_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# Sample of the request being handled, collects the size of the frames it sends.
+current_sample = ContextVar('current_sample', default=None)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def family(name, kind, help_text, samples):
+    """Renders a metric family from (name suffix, label names, label values, value) samples."""
+    yield f'# HELP {name} {help_text}'
+    yield f'# TYPE {name} {kind}'
+    for suffix, names, values, value in samples:
+        yield f'{name}{suffix}{format_labels(names, values)} {format_value(value)}'
+
+
+class Histogram:
+
+    def __init__(self, name, help_text, labels, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, values, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(values)
+            if series is None:
+                # One count per bucket plus +Inf, then the sum.
+                series = self.series[values] = [0] * (len(self.buckets) + 1) + [0]
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        labels = self.labels + ('le',)
+        with self.lock:
+            series = {values: list(counts) for values, counts in self.series.items()}
+        for values, counts in sorted(series.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield '_bucket', labels, values + (bound,), total
+            yield '_sum', self.labels, values, counts[-1]
+            yield '_count', self.labels, values, total
+
+    def collect(self):
+        return family(self.name, 'histogram', self.help_text, self.samples())
+
+
+class Registry:
+
+    def __init__(self):
+        self.collectors = []
+
+    def register(self, collect):
+        """`collect()` returns the exposition lines of one or more metric families."""
+        self.collectors.append(collect)
+        return collect
+
+    def render(self):
+        return ''.join(f'{line}\n' for collect in self.collectors for line in collect())
+
+
+registry = Registry()
+
+request_duration = Histogram('messer_request_duration_seconds', 'Wall time of a request.',
+                             ('transport', 'endpoint'), DURATION_BUCKETS)
+request_queries = Histogram('messer_request_queries', 'Database queries run by a request.',
+                            ('transport', 'endpoint'), QUERY_BUCKETS)
+request_query_duration = Histogram('messer_request_query_duration_seconds',
+                                   'Time a request spent in database queries.',
+                                   ('transport', 'endpoint'), DURATION_BUCKETS)
+response_size = Histogram('messer_response_size_bytes', 'Bytes a request sent back.',
+                          ('transport', 'endpoint'), SIZE_BUCKETS)
+
+for histogram in (request_duration, request_queries, request_query_duration, response_size):
+    registry.register(histogram.collect)
+
+
+class Sample:
+
+    def __init__(self, transport, endpoint):
+        self.transport = transport
+        self.endpoint = endpoint
+        self.queries = 0
+        self.query_time = 0.0
+        self.size = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_time += perf_counter() - started
+
+
+@contextmanager
+def observe_request(transport, endpoint):
+    """
+        Records the request run in the block, its endpoint may still be renamed through the
+        yielded sample. Queries are counted on the current thread's connection.
+    """
+    sample = Sample(transport, endpoint)
+    token = current_sample.set(sample)
+    started = perf_counter()
+    try:
+        with connection.execute_wrapper(sample):
+            yield sample
+    finally:
+        current_sample.reset(token)
+        labels = (sample.transport, sample.endpoint)
+        request_duration.observe(labels, perf_counter() - started)
+        request_queries.observe(labels, sample.queries)
+        request_query_duration.observe(labels, sample.query_time)
+        response_size.observe(labels, sample.size)
+
+
+class Sockets:
+    """Open sockets per consumer class and per user."""
+
+    def __init__(self):
+        self.sockets = Counter()
+        self.users = Counter()
+        self.lock = threading.Lock()
+
+    def opened(self, consumer, user_id):
+        with self.lock:
+            self.sockets[consumer] += 1
+            self.users[user_id] += 1
+
+    def closed(self, consumer, user_id):
+        with self.lock:
+            self.sockets[consumer] -= 1
+            self.users[user_id] -= 1
+            if not self.users[user_id]:
+                del self.users[user_id]
+
+    def collect(self):
+        with self.lock:
+            sockets = dict(self.sockets)
+            per_user = Counter(min(count, 4) for count in self.users.values())
+        yield from family('messer_open_sockets', 'gauge', 'Open WebSocket connections.', [
+            ('', ('consumer',), (consumer,), count) for consumer, count in sorted(sockets.items())
+        ])
+        yield from family('messer_connected_users', 'gauge', 'Users by their number of open sockets.', [
+            ('', ('sockets',), ('4+' if count == 4 else str(count),), per_user[count]) for count in range(1, 5)
+        ])
+
+
+sockets = Sockets()
+registry.register(sockets.collect)
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '(unmatched)'
+    view_class = getattr(match.func, 'view_class', None)
+    return view_class.__name__ if view_class else match.view_name
+
+
+class MetricsMiddleware:
+    """Records every HTTP request under the name of the view that served it."""
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with observe_request('http', '(unmatched)') as sample:
+            response = self.get_response(request)
+            sample.endpoint = view_name(request)
+            if not response.streaming:
+                sample.size = len(response.content)
+        return response
@@ -0,0 +1,78 @@
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+import django.db.models.deletion
+
+
+def collapse_friendships(apps, schema_editor):
+    """
+        Gives every message its sender and recipient, then merges each pair of mirrored
+        friendships into the row with the lower user id, moving the messages along.
+    """
+    Friendship = apps.get_model('api', 'Friendship')
+    Message = apps.get_model('api', 'Message')
+    friendship = Friendship.objects.filter(id=OuterRef('friendship_id'))
+    Message.objects.update(sender_id=Subquery(friendship.values('user_id')[:1]),
+                           recipient_id=Subquery(friendship.values('friend_id')[:1]))
+    for reversed_friendship in Friendship.objects.filter(user__gt=F('friend')):
+        canonical = Friendship.objects.filter(user_id=reversed_friendship.friend_id,
+                                              friend_id=reversed_friendship.user_id).first()
+        if canonical is None:
+            Friendship.objects.filter(id=reversed_friendship.id).update(user_id=reversed_friendship.friend_id,
+                                                                        friend_id=reversed_friendship.user_id)
+            continue
+        Message.objects.filter(friendship_id=reversed_friendship.id).update(friendship_id=canonical.id)
+        reversed_friendship.delete()
+
+
+def expand_friendships(apps, schema_editor):
+    Friendship = apps.get_model('api', 'Friendship')
+    Message = apps.get_model('api', 'Message')
+    for friendship in list(Friendship.objects.all()):
+        reversed_friendship = Friendship.objects.create(user_id=friendship.friend_id, friend_id=friendship.user_id)
+        Message.objects.filter(friendship_id=friendship.id, sender_id=friendship.friend_id) \
+            .update(friendship_id=reversed_friendship.id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='defaultuser',
+            name='friends',
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='sender',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE,
+                                    related_name='sent_messages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='recipient',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE,
+                                    related_name='received_messages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(collapse_friendships, expand_friendships),
+        migrations.AlterField(
+            model_name='message',
+            name='sender',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                    related_name='sent_messages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='recipient',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                    related_name='received_messages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='friendship',
+            constraint=models.CheckConstraint(check=models.Q(('user__lt', models.F('friend'))),
+                                              name='friendship_canonical_order'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.3 on 2026-10-18 07:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_message_client_id'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('has_been_read', False)), fields=['friendship', 'recipient', 'created_at'], name='message_unread_idx'),
+        ),
+    ]
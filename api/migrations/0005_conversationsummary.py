@@ -0,0 +1,62 @@
+# Generated by Django 4.1.3 on 2026-10-18 07:41
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def create_summaries(apps, schema_editor):
+    Friendship = apps.get_model('api', 'Friendship')
+    Message = apps.get_model('api', 'Message')
+    ConversationSummary = apps.get_model('api', 'ConversationSummary')
+    unread_counts = Message.objects.filter(has_been_read=False).values('friendship_id', 'recipient_id') \
+        .annotate(count=Count('id')).values_list('friendship_id', 'recipient_id', 'count')
+    unread = {(friendship_id, recipient_id): count for friendship_id, recipient_id, count in unread_counts}
+    summaries = []
+    for friendship in Friendship.objects.all().iterator():
+        last = Message.objects.filter(friendship_id=friendship.id).order_by('-id').first()
+        for user_id, friend_id in ((friendship.user_id, friendship.friend_id),
+                                   (friendship.friend_id, friendship.user_id)):
+            summaries.append(ConversationSummary(
+                friendship_id=friendship.id, user_id=user_id, friend_id=friend_id,
+                last_message=last,
+                last_message_sender_id=last.sender_id if last else None,
+                last_message_preview=last.content[:50] if last else '',
+                last_message_at=last.created_at if last else None,
+                unread_count=unread.get((friendship.id, user_id), 0)
+            ))
+    ConversationSummary.objects.bulk_create(summaries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_message_unread_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_preview', models.CharField(blank=True, max_length=50)),
+                ('last_message_at', models.DateTimeField(null=True)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('friend', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('friendship', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='summaries', to='api.friendship')),
+                ('last_message', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.message')),
+                ('last_message_sender', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='conversationsummary',
+            index=models.Index(fields=['user', '-last_message_at'], name='api_convers_user_id_d90573_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='conversationsummary',
+            unique_together={('user', 'friendship')},
+        ),
+        migrations.RunPython(create_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+from django.db.models.functions import Collate, Lower
+
+
+def username_prefix_index(schema_editor):
+    # Bytewise comparison keeps each prefix one contiguous range, see search.py.
+    key = Lower('username')
+    if schema_editor.connection.vendor == 'postgresql':
+        key = Collate(key, 'C')
+    return models.Index(key, name='user_username_prefix_idx')
+
+
+def add_index(apps, schema_editor):
+    schema_editor.add_index(apps.get_model('api', 'DefaultUser'), username_prefix_index(schema_editor))
+
+
+def remove_index(apps, schema_editor):
+    schema_editor.remove_index(apps.get_model('api', 'DefaultUser'), username_prefix_index(schema_editor))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_user_events'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_index, remove_index),
+    ]
@@ -0,0 +1,69 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# A partitioned table needs the partition key in its primary key, Django's own
+# CREATE TABLE would declare `id` alone. Partitions are added by archive.py.
+POSTGRESQL_TABLE = [
+    '''
+    CREATE TABLE "api_archivedmessage" (
+        "id" bigint NOT NULL,
+        "friendship_id" bigint NOT NULL
+            REFERENCES "api_friendship" ("id") DEFERRABLE INITIALLY DEFERRED,
+        "sender_id" bigint NOT NULL
+            REFERENCES "api_defaultuser" ("id") DEFERRABLE INITIALLY DEFERRED,
+        "recipient_id" bigint NOT NULL
+            REFERENCES "api_defaultuser" ("id") DEFERRABLE INITIALLY DEFERRED,
+        "content" varchar(200) NOT NULL,
+        "created_at" timestamp with time zone NOT NULL,
+        "has_been_read" boolean NOT NULL,
+        "read_at" timestamp with time zone NULL,
+        PRIMARY KEY ("id", "created_at")
+    ) PARTITION BY RANGE ("created_at")
+    ''',
+    'CREATE INDEX "archived_message_history_idx" ON "api_archivedmessage" ("friendship_id", "created_at")',
+    'CREATE INDEX "api_archivedmessage_sender_id_idx" ON "api_archivedmessage" ("sender_id")',
+    'CREATE INDEX "api_archivedmessage_recipient_id_idx" ON "api_archivedmessage" ("recipient_id")',
+]
+
+
+def create_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for sql in POSTGRESQL_TABLE:
+            schema_editor.execute(sql)
+    else:
+        schema_editor.create_model(apps.get_model('api', 'ArchivedMessage'))
+
+
+def drop_table(apps, schema_editor):
+    # Drops the partitions along with a partitioned table.
+    schema_editor.delete_model(apps.get_model('api', 'ArchivedMessage'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_user_username_prefix_idx'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.CreateModel(
+                name='ArchivedMessage',
+                fields=[
+                    ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                    ('content', models.CharField(max_length=200)),
+                    ('created_at', models.DateTimeField()),
+                    ('has_been_read', models.BooleanField(default=True)),
+                    ('read_at', models.DateTimeField(null=True)),
+                    ('friendship', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='api.friendship')),
+                    ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                    ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ],
+                options={
+                    'indexes': [models.Index(fields=['friendship', 'created_at'], name='archived_message_history_idx')],
+                },
+            ),
+        ]),
+        migrations.RunPython(create_table, drop_table),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.3 on 2026-10-18 08:39
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def delete_requests_to_self(apps, schema_editor):
+    apps.get_model('api', 'FriendRequest').objects.filter(from_user=F('to_user')).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_archivedmessage'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_requests_to_self, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='friendrequest',
+            constraint=models.CheckConstraint(check=models.Q(('from_user', models.F('to_user')), _negated=True), name='friend_request_not_to_self'),
+        ),
+    ]
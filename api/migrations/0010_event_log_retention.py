@@ -0,0 +1,22 @@
+# Generated by Django 4.1.3 on 2026-10-18 08:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_friend_request_not_to_self'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usereventsequence',
+            name='pruned_through',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='userevent',
+            index=models.Index(fields=['created_at'], name='user_event_created_at_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.1.3 on 2026-10-18 09:11
+
+from django.db import migrations, models
+import django.db.models.lookups
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_event_log_retention'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='conversationsummary',
+            name='api_convers_user_id_d90573_idx',
+        ),
+        migrations.AddIndex(
+            model_name='conversationsummary',
+            index=models.Index(models.F('user'), django.db.models.lookups.IsNull(models.F('last_message_at'), True), models.OrderBy(models.F('last_message_at'), descending=True), name='conversation_inbox_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1.3 on 2026-10-18 09:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_conversation_inbox_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='conversationsummary',
+            name='last_message',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.message'),
+        ),
+    ]
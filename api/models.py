@@ -1,74 +1,195 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q, F
+from django.db.models.lookups import IsNull
 from django.contrib.auth.models import AbstractUser
 from django.dispatch import receiver
 
 
 class DefaultUser(AbstractUser):
-
+    """
+        Usernames are searched through the user_username_prefix_idx index, created by
+        migration 0007 since its expression depends on the database, see search.py.
+    """
     email = models.EmailField(max_length=50, unique=True)
-    friends = models.ManyToManyField('DefaultUser', through='Friendship')
 
     def __str__(self):
         return self.username
 
+    @property
+    def friends(self):
+        return DefaultUser.objects.filter(id__in=self.friend_ids())
+
+    def friend_ids(self):
+        from .friends import get_friends
+        return {friend_id for friend_id, _ in get_friends(self.id).values()}
+
     def has_friend(self, possible_friend):
-        return self.friendships.filter(friend=possible_friend).exists()
+        return possible_friend.id in self.friend_ids()
+
+
+class FriendshipQuerySet(models.QuerySet):
+
+    def of(self, user):
+        return self.filter(Q(user=user) | Q(friend=user))
+
+    def between(self, user, other):
+        return self.filter(**Friendship.canonical(user.id, other.id))
 
 
 class Friendship(models.Model):
+    """
+        One row per pair of friends, stored with the lower user id in `user`.
+        Use Friendship.canonical() to build lookups for a pair.
+    """
     user = models.ForeignKey(DefaultUser, on_delete=models.CASCADE, related_name='friendships')
     friend = models.ForeignKey(DefaultUser, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = FriendshipQuerySet.as_manager()
+
     class Meta:
         unique_together = [['user', 'friend']]
+        constraints = [models.CheckConstraint(check=Q(user__lt=F('friend')), name='friendship_canonical_order')]
+
+    @staticmethod
+    def canonical(user_id, other_id):
+        low, high = sorted((user_id, other_id))
+        return {'user_id': low, 'friend_id': high}
+
+    def other(self, user_id):
+        return self.friend_id if self.user_id == user_id else self.user_id
+
+    def save(self, *args, **kwargs):
+        if self.user_id and self.friend_id and self.user_id > self.friend_id:
+            self.user, self.friend = self.friend, self.user
+        super().save(*args, **kwargs)
 
 
 class FriendRequest(models.Model):
+    """Pending request from `from_user` to `to_user`, sent and answered through friendships.py."""
     from_user = models.ForeignKey(DefaultUser, on_delete=models.CASCADE, related_name='sent_friend_requests')
     to_user = models.ForeignKey(DefaultUser, on_delete=models.CASCADE, related_name='received_friend_requests')
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         unique_together = [['from_user', 'to_user']]
-
-    def accept_request(self):
-        from_user = self.from_user
-        to_user = self.to_user
-        self.delete()
-        Friendship.objects.get_or_create(user=from_user, friend=to_user)
-
-    def reject_request(self):
-        self.delete()
+        constraints = [models.CheckConstraint(check=~Q(from_user=F('to_user')), name='friend_request_not_to_self')]
 
 
 class Message(models.Model):
     friendship = models.ForeignKey(Friendship, on_delete=models.CASCADE)
+    sender = models.ForeignKey(DefaultUser, on_delete=models.CASCADE, related_name='sent_messages')
+    recipient = models.ForeignKey(DefaultUser, on_delete=models.CASCADE, related_name='received_messages')
     content = models.CharField(max_length=200)
     created_at = models.DateTimeField(auto_now_add=True)
     has_been_read = models.BooleanField(default=False)
     read_at = models.DateTimeField(null=True)
+    client_id = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['friendship', 'created_at']),
+            models.Index(fields=['friendship', 'recipient', 'created_at'], condition=Q(has_been_read=False),
+                         name='message_unread_idx')
+        ]
+        constraints = [models.UniqueConstraint(fields=['sender', 'client_id'], name='message_unique_client_id')]
+
+
+class ArchivedMessage(models.Model):
+    """
+        A read message moved out of Message by archive_messages once older than
+        settings.MESSAGE_ARCHIVE_AFTER_DAYS, keeping its id. Holds no client_id and only
+        the history index. Partitioned by month of created_at on PostgreSQL, see archive.py.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    # Looked up through the history index only.
+    friendship = models.ForeignKey(Friendship, on_delete=models.CASCADE, related_name='+', db_index=False)
+    sender = models.ForeignKey(DefaultUser, on_delete=models.CASCADE, related_name='+')
+    recipient = models.ForeignKey(DefaultUser, on_delete=models.CASCADE, related_name='+')
+    content = models.CharField(max_length=200)
+    created_at = models.DateTimeField()
+    has_been_read = models.BooleanField(default=True)
+    read_at = models.DateTimeField(null=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['friendship', 'created_at'], name='archived_message_history_idx')]
+
+
+class ConversationSummary(models.Model):
+    """
+        Inbox entry of one user for one friendship, kept up to date as messages are
+        sent and read, see conversations.py.
+    """
+    friendship = models.ForeignKey(Friendship, on_delete=models.CASCADE, related_name='summaries')
+    user = models.ForeignKey(DefaultUser, on_delete=models.CASCADE, related_name='conversations')
+    friend = models.ForeignKey(DefaultUser, on_delete=models.CASCADE, related_name='+')
+    # Messages are only deleted along with their summaries (friendships.remove_friend), or once no summary
+    # points at them (archive.py), so a conversation's messages can go in a single DELETE. Deleting one a
+    # summary still points at any other way fails on the database's foreign key when the transaction
+    # commits, it cannot leave the summary dangling.
+    last_message = models.ForeignKey(Message, on_delete=models.DO_NOTHING, null=True, related_name='+')
+    last_message_sender = models.ForeignKey(DefaultUser, on_delete=models.SET_NULL, null=True, related_name='+')
+    last_message_preview = models.CharField(max_length=50, blank=True)
+    last_message_at = models.DateTimeField(null=True)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    # Newest conversation first, those without messages last. Spelled out rather than with
+    # nulls_last, which SQLite cannot index, so that the index matches it on every backend.
+    INBOX_ORDER = (IsNull(F('last_message_at'), True), F('last_message_at').desc())
 
-@receiver(models.signals.post_delete, sender=Friendship)
-def remove_reversed_friendship(instance, **kwargs):
-    user = instance.user
-    friend = instance.friend
-    reversed_friendship = friend.friendships.filter(friend=user)
-    if reversed_friendship.exists():
-        reversed_friendship.delete()
+    class Meta:
+        unique_together = [['user', 'friendship']]
+        indexes = [models.Index(F('user'), IsNull(F('last_message_at'), True), F('last_message_at').desc(),
+                                name='conversation_inbox_idx')]
+
+
+class UserEventSequence(models.Model):
+    """Last sequence number handed out in a user's event log, its row lock orders the appends."""
+    user = models.OneToOneField(DefaultUser, on_delete=models.CASCADE, primary_key=True,
+                                related_name='event_sequence')
+    last_seq = models.PositiveBigIntegerField(default=0)
+    # Events up to this seq were pruned, a client syncing from before it has to reload its state.
+    pruned_through = models.PositiveBigIntegerField(default=0)
+
+
+class UserEvent(models.Model):
+    """
+        Append-only log of the events pushed to a user, numbered per user by `seq`.
+        Lets a reconnecting client catch up from its last seq, see events.py.
+    """
+    user = models.ForeignKey(DefaultUser, on_delete=models.CASCADE, related_name='events')
+    seq = models.PositiveBigIntegerField()
+    type = models.CharField(max_length=32)
+    content = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [['user', 'seq']]
+        indexes = [models.Index(fields=['created_at'], name='user_event_created_at_idx')]
 
 
 @receiver(models.signals.post_save, sender=Friendship)
-def create_reversed_friendship(instance, created, **kwargs):
-    print(f'Created: {created}')
-    if created:
-        user = instance.user
-        friend = instance.friend
-        reversed_friendship, _ = Friendship.objects.get_or_create(friend=user, user=friend)
-
-
-@receiver(models.signals.pre_save, sender=FriendRequest)
-def stop_request_to_friend(instance, **kwargs):
-    assert not instance.from_user.has_friend(instance.to_user), \
-        AssertionError('Cannot send friend request to current friend!')
+def create_conversation_summaries(instance, created, **kwargs):
+    if not created:
+        return
+    ConversationSummary.objects.bulk_create([
+        ConversationSummary(friendship=instance, user_id=instance.user_id, friend_id=instance.friend_id),
+        ConversationSummary(friendship=instance, user_id=instance.friend_id, friend_id=instance.user_id)
+    ])
+
+
+@receiver(models.signals.post_save, sender=Message)
+def update_conversation_summaries(instance, created, **kwargs):
+    if not created:
+        return
+    from .conversations import record_messages
+    record_messages([instance])
+
+
+@receiver(models.signals.post_save, sender=Friendship)
+@receiver(models.signals.post_delete, sender=Friendship)
+def invalidate_friend_caches(instance, **kwargs):
+    from .friends import invalidate_friends
+    # After commit: a list read in between would otherwise be cached with the old friendships.
+    transaction.on_commit(lambda: invalidate_friends(instance.user_id, instance.friend_id))
+
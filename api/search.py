@@ -0,0 +1,40 @@
+"""
+    Username prefix search, served by the user_username_prefix_idx index on
+    lower(username). The key is compared bytewise (COLLATE "C" on PostgreSQL,
+    SQLite's default), so every username starting with a prefix lies in one
+    contiguous index range, read in order and cut at the limit.
+"""
+from django.db import connection
+from django.db.models.functions import Collate, Lower
+from .models import DefaultUser
+from .friends import get_friends
+
+
+def username_key():
+    key = Lower('username')
+    if connection.vendor == 'postgresql':
+        return Collate(key, 'C')
+    return key
+
+
+def prefix_range(prefix):
+    """The [start, end) range of keys beginning with `prefix`."""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def search_queryset(user_id, query):
+    start, end = prefix_range(query.lower())
+    excluded = {friend_id for friend_id, _ in get_friends(user_id).values()} | {user_id}
+    return DefaultUser.objects.alias(key=username_key()) \
+        .filter(key__gte=start, key__lt=end) \
+        .exclude(id__in=excluded) \
+        .order_by('key', 'id')
+
+
+def search_usernames(user_id, query, limit):
+    """
+        Usernames starting with `query`, ignoring case, excluding the user and their friends.
+        Ranked in key order, which puts an exact match first and shorter names before their
+        extensions. SQLite's lower() only folds ASCII.
+    """
+    return list(search_queryset(user_id, query).values_list('username', flat=True)[:limit])
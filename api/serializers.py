@@ -1,6 +1,7 @@
+from itertools import islice
 from rest_framework import serializers
 from .models import DefaultUser, Message, FriendRequest, Friendship
-from django.contrib.auth.hashers import make_password
+from .hashing import hash_password
 
 
 class DefaultUserSerializer(serializers.ModelSerializer):
@@ -12,7 +13,7 @@ class DefaultUserSerializer(serializers.ModelSerializer):
 
     @staticmethod
     def validate_password(data):
-        return make_password(data)
+        return hash_password(data)
 
 
 class DefaultLoginSerializer(serializers.Serializer):
@@ -22,12 +23,12 @@ class DefaultLoginSerializer(serializers.Serializer):
 
 
 class MessageOutSerializer(serializers.ModelSerializer):
-    from_user = serializers.CharField(source='friendship.user')
-    to_user = serializers.CharField(source='friendship.friend')
+    from_user = serializers.CharField(source='sender.username')
+    to_user = serializers.CharField(source='recipient.username')
 
     class Meta:
         model = Message
-        fields = ['from_user', 'to_user', 'created_at', 'has_been_read', 'read_at', 'content']
+        fields = ['id', 'from_user', 'to_user', 'created_at', 'has_been_read', 'read_at', 'content']
 
 
 class FriendRequestOutSerializer(serializers.ModelSerializer):
@@ -40,16 +41,94 @@ class FriendRequestOutSerializer(serializers.ModelSerializer):
 
 
 class FriendshipOutSerializer(serializers.ModelSerializer):
-    friend = serializers.CharField(source='friend.username')
+    """
+        Renders a friendship as seen by context['user_id'], `friend` is the other user.
+    """
+    friend = serializers.SerializerMethodField()
 
     class Meta:
         model = Friendship
         fields = ['friend', 'created_at']
 
-
-
-
-
-
-
-
+    def get_friend(self, friendship):
+        if friendship.user_id == self.context['user_id']:
+            return friendship.friend.username
+        return friendship.user.username
+
+
+class FlatRowSerializer:
+    """
+        Renders a queryset in a single values_list() query, following relations in the
+        same query, into the representation of the matching ModelSerializer. Meant for
+        bulk read paths where one DRF serializer per row is too expensive.
+    """
+    fields = {}
+    datetime_fields = ()
+    datetime_field = serializers.DateTimeField()
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+
+    @property
+    def data(self):
+        return self.render(self.fetch(self.queryset))
+
+    @classmethod
+    def fetch(cls, queryset):
+        names = list(cls.fields)
+        return [dict(zip(names, row)) for row in queryset.values_list(*cls.fields.values())]
+
+    @classmethod
+    def chunks(cls, queryset, size):
+        """
+            Yields the rendered rows `size` at a time. They are read through .iterator(), a
+            server-side cursor where the database has one, so only one chunk is held at once.
+        """
+        names = list(cls.fields)
+        rows = queryset.values_list(*cls.fields.values()).iterator(chunk_size=size)
+        while True:
+            chunk = [dict(zip(names, row)) for row in islice(rows, size)]
+            if not chunk:
+                return
+            yield cls.render(chunk)
+
+    @classmethod
+    def render(cls, rows):
+        for row in rows:
+            for name in cls.datetime_fields:
+                row[name] = cls.datetime_field.to_representation(row[name])
+        return rows
+
+
+class MessageRowSerializer(FlatRowSerializer):
+    fields = {
+        'id': 'id',
+        'from_user': 'sender__username',
+        'to_user': 'recipient__username',
+        'created_at': 'created_at',
+        'has_been_read': 'has_been_read',
+        'read_at': 'read_at',
+        'content': 'content'
+    }
+    datetime_fields = ('created_at', 'read_at')
+
+
+class FriendRequestRowSerializer(FlatRowSerializer):
+    fields = {
+        'from_user': 'from_user__username',
+        'to_user': 'to_user__username',
+        'created_at': 'created_at'
+    }
+    datetime_fields = ('created_at',)
+
+
+class ConversationRowSerializer(FlatRowSerializer):
+    fields = {
+        'friend': 'friend__username',
+        'last_message_id': 'last_message_id',
+        'last_message_from': 'last_message_sender__username',
+        'last_message_preview': 'last_message_preview',
+        'last_message_at': 'last_message_at',
+        'unread_count': 'unread_count'
+    }
+    datetime_fields = ('last_message_at',)
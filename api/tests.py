@@ -1,3 +1,294 @@
-from django.test import TestCase
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.db import connection, transaction, IntegrityError
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from . import friendships, tokens
+from .friends import get_friends
+from .friendships import FriendshipError
+from .models import DefaultUser, Friendship, FriendRequest, Message, ConversationSummary, UserEventSequence
 
-# Create your tests here.
+
+def metric_value(text, sample):
+    for line in text.splitlines():
+        if line.startswith(sample + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return 0.0
+
+
+class MetricsTests(TestCase):
+
+    @override_settings(METRICS_ENABLED=True)
+    def test_views_are_recorded(self):
+        DefaultUser.objects.create_user(username='user', email='user@messer.local', password='password')
+        requests = 'messer_request_duration_seconds_count{transport="http",endpoint="Login"}'
+        queries = 'messer_request_queries_sum{transport="http",endpoint="Login"}'
+        before = self.client.get('/metrics').content.decode()
+        response = self.client.post('/api/login/', {'username': 'user', 'password': 'password'})
+        after = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(after['Content-Type'].startswith('text/plain; version=0.0.4'))
+        after = after.content.decode()
+        self.assertEqual(metric_value(after, requests), metric_value(before, requests) + 1)
+        self.assertGreater(metric_value(after, queries), metric_value(before, queries))
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_disabled(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+class PasswordHashingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def login(self, username='user', password='password', **extra):
+        return self.client.post('/api/login/', {'username': username, 'password': password}, **extra)
+
+    def test_register_and_login_through_the_pool(self):
+        response = self.client.post('/api/register/', {'username': 'user', 'email': 'user@messer.local',
+                                                        'password': 'password'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(DefaultUser.objects.get(username='user').check_password('password'))
+        self.assertEqual(self.login().status_code, 200)
+        self.assertEqual(self.login(password='wrong').status_code, 404)
+
+    def test_outdated_hash_is_upgraded(self):
+        DefaultUser.objects.create(username='user', email='user@messer.local',
+                                   password=make_password('password', hasher='pbkdf2_sha1'))
+        self.assertEqual(self.login().status_code, 200)
+        self.assertTrue(DefaultUser.objects.get(username='user').password.startswith('pbkdf2_sha256$'))
+
+    @override_settings(PASSWORD_HASHING_QUEUE=0)
+    def test_full_queue_is_turned_away(self):
+        DefaultUser.objects.create_user(username='user', email='user@messer.local', password='password')
+        response = self.login()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+    @override_settings(AUTH_RATE_LIMIT_PER_USERNAME=(2, 0.01))
+    def test_username_bucket_rejects_before_hashing(self):
+        DefaultUser.objects.create_user(username='user', email='user@messer.local', password='password')
+        with mock.patch('api.views.check_user_password', return_value=False) as check:
+            responses = [self.login(username=username) for username in ('user', 'user', 'USER', 'other')]
+        self.assertEqual([response.status_code for response in responses], [404, 404, 429, 404])
+        self.assertEqual(check.call_count, 2)
+        self.assertEqual(responses[2]['Retry-After'], '100')
+
+    @override_settings(AUTH_RATE_LIMIT_PER_IP=(1, 0.01))
+    def test_ip_bucket(self):
+        self.assertEqual(self.login().status_code, 404)
+        self.assertEqual(self.login(username='other').status_code, 429)
+        self.assertEqual(self.login(username='other', REMOTE_ADDR='10.0.0.2').status_code, 404)
+
+    @override_settings(AUTH_RATE_LIMIT_PER_IP=(1, 0.01))
+    def test_spoofed_forwarded_for_shares_the_address_bucket(self):
+        self.assertEqual(self.login(HTTP_X_FORWARDED_FOR='10.1.0.1').status_code, 404)
+        self.assertEqual(self.login(HTTP_X_FORWARDED_FOR='10.1.0.2').status_code, 429)
+
+    @override_settings(AUTH_RATE_LIMIT_PER_IP=(1, 0.01))
+    def test_forwarded_for_behind_a_proxy(self):
+        with override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1}):
+            self.assertEqual(self.login(HTTP_X_FORWARDED_FOR='spoofed, 10.1.0.1').status_code, 404)
+            self.assertEqual(self.login(HTTP_X_FORWARDED_FOR='10.1.0.2').status_code, 404)
+            self.assertEqual(self.login(HTTP_X_FORWARDED_FOR='other, 10.1.0.2').status_code, 429)
+
+
+class GetFriendsTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user, self.friend, self.other = [
+            DefaultUser.objects.create(username=username, email=f'{username}@messer.local')
+            for username in ('user', 'friend', 'other')
+        ]
+        self.friendship = Friendship.objects.create(**Friendship.canonical(self.user.id, self.friend.id))
+        self.client.force_login(self.user)
+
+    def get_friends(self, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.post('/api/get-friends/', **headers)
+
+    def test_unchanged_list_is_not_modified(self):
+        response = self.get_friends()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([friend['friend'] for friend in response.json()], ['friend'])
+        self.assertIn('created_at', response.json()[0])
+        # Only the session and its user are read.
+        with self.assertNumQueries(2):
+            cached = self.get_friends(etag=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.content, b'')
+        self.assertEqual(cached['ETag'], response['ETag'])
+
+    def test_saved_and_deleted_friendships_change_the_etag(self):
+        etag = self.get_friends()['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Friendship.objects.create(**Friendship.canonical(self.user.id, self.other.id))
+        response = self.get_friends(etag=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([friend['friend'] for friend in response.json()], ['friend', 'other'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.friendship.delete()
+        response = self.get_friends(etag=response['ETag'])
+        self.assertEqual([friend['friend'] for friend in response.json()], ['other'])
+
+
+class FriendshipServiceTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user, self.friend, self.other = [
+            DefaultUser.objects.create(username=username, email=f'{username}@messer.local')
+            for username in ('user', 'friend', 'other')
+        ]
+        # The first event of a user creates its sequence, counts below are of later ones.
+        UserEventSequence.objects.bulk_create([UserEventSequence(user=user)
+                                               for user in (self.user, self.friend, self.other)])
+        for user in (self.user, self.friend, self.other):
+            get_friends(user.id)
+
+    def test_send(self):
+        # Lookup, insert, and the event appended to each user's log.
+        with self.assertNumQueries(9):
+            friendships.send_request(self.user, 'friend')
+        self.assertTrue(FriendRequest.objects.filter(from_user=self.user, to_user=self.friend).exists())
+        for username, error in (('user', 'Cannot send friend request to yourself!'),
+                                ('nobody', 'That user does not exists.'),
+                                ('friend', 'You have already sent a friend request to that user.')):
+            with self.assertRaisesMessage(FriendshipError, error):
+                friendships.send_request(self.user, username)
+
+    def test_send_to_friend(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Friendship.objects.create(**Friendship.canonical(self.user.id, self.friend.id))
+        get_friends(self.user.id)
+        with self.assertNumQueries(0), self.assertRaisesMessage(FriendshipError, 'current friend'):
+            friendships.send_request(self.user, 'friend')
+
+    def test_accept_drops_both_directions(self):
+        FriendRequest.objects.create(from_user=self.friend, to_user=self.user)
+        FriendRequest.objects.create(from_user=self.user, to_user=self.friend)
+        # Lookup, one DELETE per request direction, the friendship and its two summaries, two events each.
+        with self.assertNumQueries(17):
+            friendship = friendships.accept_request(self.user, 'friend')
+        self.assertEqual((friendship.user_id, friendship.friend_id), (self.user.id, self.friend.id))
+        self.assertFalse(FriendRequest.objects.exists())
+        self.assertEqual(ConversationSummary.objects.filter(friendship=friendship).count(), 2)
+        with self.assertRaisesMessage(FriendshipError, 'pending friend requests from that user'):
+            friendships.accept_request(self.user, 'friend')
+
+    def test_reject_and_withdraw(self):
+        FriendRequest.objects.create(from_user=self.friend, to_user=self.user)
+        FriendRequest.objects.create(from_user=self.user, to_user=self.other)
+        with self.assertNumQueries(1):
+            friendships.reject_request(self.user, 'friend')
+        with self.assertNumQueries(1):
+            friendships.withdraw_request(self.user, 'other')
+        self.assertFalse(FriendRequest.objects.exists())
+        with self.assertRaisesMessage(FriendshipError, 'pending friend requests from that user'):
+            friendships.reject_request(self.user, 'friend')
+        with self.assertRaisesMessage(FriendshipError, 'pending friend request sent to that user'):
+            friendships.withdraw_request(self.user, 'other')
+
+    def test_remove_deletes_the_conversation(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            friendship = Friendship.objects.create(**Friendship.canonical(self.user.id, self.friend.id))
+        Message.objects.create(friendship=friendship, sender=self.user, recipient=self.friend, content='hi')
+        get_friends(self.user.id)
+        # Lookup, one DELETE per table holding the conversation, two events each.
+        with self.captureOnCommitCallbacks(execute=True), self.assertNumQueries(17):
+            friendships.remove_friend(self.user, 'friend')
+        self.assertFalse(Friendship.objects.exists())
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(ConversationSummary.objects.exists())
+        # The removal dropped the cached friend list, it is read again.
+        with self.assertNumQueries(1), self.assertRaisesMessage(FriendshipError, 'a friend with that name'):
+            friendships.remove_friend(self.user, 'friend')
+
+    def test_last_message_cannot_be_deleted_under_its_summary(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            friendship = Friendship.objects.create(**Friendship.canonical(self.user.id, self.friend.id))
+        Message.objects.create(friendship=friendship, sender=self.user, recipient=self.friend, content='hi')
+        # The summaries' foreign key is checked at commit, checked here as the test never commits.
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Message.objects.all().delete()
+            connection.check_constraints()
+        self.assertTrue(Message.objects.exists())
+
+    def test_request_to_self_is_refused_by_the_database(self):
+        with self.assertRaises(IntegrityError):
+            FriendRequest.objects.create(from_user=self.user, to_user=self.user)
+
+
+class CanonicalFriendshipMigrationTests(TransactionTestCase):
+    before = [('api', '0001_initial')]
+    after = [('api', '0002_canonical_friendship')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def setUp(self):
+        apps = self.migrate(self.before)
+        User, Friendship, Message = (apps.get_model('api', name) for name in ('DefaultUser', 'Friendship', 'Message'))
+        self.low, self.high, self.other = [User.objects.create(username=username, email=f'{username}@messer.local').id
+                                           for username in ('low', 'high', 'other')]
+        # Both directions of a pair, each holding the messages its user sent, and a pair stored reversed only.
+        forward = Friendship.objects.create(user_id=self.low, friend_id=self.high)
+        backward = Friendship.objects.create(user_id=self.high, friend_id=self.low)
+        Friendship.objects.create(user_id=self.other, friend_id=self.low)
+        Message.objects.create(friendship=forward, content='from low')
+        Message.objects.create(friendship=backward, content='from high')
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_pairs_collapse_and_expand(self):
+        apps = self.migrate(self.after)
+        Friendship, Message = apps.get_model('api', 'Friendship'), apps.get_model('api', 'Message')
+        self.assertEqual(set(Friendship.objects.values_list('user_id', 'friend_id')),
+                         {(self.low, self.high), (self.low, self.other)})
+        pair = Friendship.objects.get(user_id=self.low, friend_id=self.high)
+        self.assertEqual(set(Message.objects.values_list('friendship_id', 'sender_id', 'recipient_id', 'content')),
+                         {(pair.id, self.low, self.high, 'from low'), (pair.id, self.high, self.low, 'from high')})
+
+        apps = self.migrate(self.before)
+        Friendship, Message = apps.get_model('api', 'Friendship'), apps.get_model('api', 'Message')
+        self.assertEqual(set(Friendship.objects.values_list('user_id', 'friend_id')), {
+            (self.low, self.high), (self.high, self.low), (self.low, self.other), (self.other, self.low)})
+        self.assertEqual(set(Message.objects.values_list('friendship__user_id', 'content')),
+                         {(self.low, 'from low'), (self.high, 'from high')})
+
+
+class ConnectionTokenTests(TestCase):
+
+    def setUp(self):
+        self.user = DefaultUser.objects.create(username='user', email='user@messer.local')
+
+    def test_token_names_the_session_user(self):
+        self.assertEqual(self.client.post('/api/connection-token/').status_code, 403)
+        self.client.force_login(self.user)
+        response = self.client.post('/api/connection-token/')
+        self.assertEqual(response.status_code, 200)
+        session = self.client.session
+        self.assertNotIn(session.session_key, response.json()['token'])
+        self.assertEqual(tokens.read_token(response.json()['token']), (self.user.id, 'user', session.session_key))
+
+    def test_tampered_and_expired_tokens_are_refused(self):
+        self.client.force_login(self.user)
+        token = self.client.post('/api/connection-token/').json()['token']
+        self.assertIsNone(tokens.read_token(token[:-1] + ('A' if token[-1] != 'A' else 'B')))
+        self.assertIsNone(tokens.read_token('not a token'))
+        with override_settings(WS_API_TOKEN_MAX_AGE=-1):
+            self.assertIsNone(tokens.read_token(token))
+
+    def test_logout_revokes_tokens(self):
+        self.client.force_login(self.user)
+        token = self.client.post('/api/connection-token/').json()['token']
+        self.client.post('/api/logout/')
+        self.assertIsNone(tokens.read_token(token))
@@ -0,0 +1,63 @@
+"""
+    Token bucket throttles for the endpoints that hash passwords, so a flood is
+    turned away before it reaches the hashing pool.
+
+    A bucket holds up to `burst` tokens and regains `rate` tokens per second, each
+    request takes one. Buckets live in the default cache, shared by every process
+    when REDIS_URL is set. The read-modify-write is not atomic, concurrent requests
+    on one key may each take the same token; the limit is approximate, not exact.
+"""
+import time
+import hashlib
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.throttling import BaseThrottle
+
+
+class TokenBucketThrottle(BaseThrottle):
+    scope = None
+    setting = None
+
+    def __init__(self):
+        self.burst, self.rate = getattr(settings, self.setting)
+        self.missing = 0
+
+    def get_cache_key(self, request, view):
+        raise NotImplementedError
+
+    def allow_request(self, request, view):
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+        key = f'throttle:{self.scope}:{key}'
+        now = time.time()
+        tokens, updated_at = cache.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        if tokens < 1:
+            self.missing = 1 - tokens
+            return False
+        cache.set(key, (tokens - 1, now), timeout=int(self.burst / self.rate) + 1)
+        return True
+
+    def wait(self):
+        return self.missing / self.rate
+
+
+class IPThrottle(TokenBucketThrottle):
+    """Keyed by the client address, X-Forwarded-For is only trusted behind REST_FRAMEWORK['NUM_PROXIES'] proxies."""
+    scope = 'ip'
+    setting = 'AUTH_RATE_LIMIT_PER_IP'
+
+    def get_cache_key(self, request, view):
+        return self.get_ident(request)
+
+
+class UsernameThrottle(TokenBucketThrottle):
+    scope = 'username'
+    setting = 'AUTH_RATE_LIMIT_PER_USERNAME'
+
+    def get_cache_key(self, request, view):
+        username = request.data.get('username') if hasattr(request.data, 'get') else None
+        if not isinstance(username, str):
+            return None
+        return hashlib.sha1(username.lower().encode()).hexdigest()
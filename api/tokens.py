@@ -0,0 +1,68 @@
+"""
+    Signed connection tokens for the websocket API.
+
+    A token carries the user's id and username and a digest of the session it was issued
+    to, signed with SECRET_KEY and timestamped through django.core.signing. The session key
+    itself is never in a token, a token can be handed to scripts that must not read the
+    session cookie: issuing one maps the digest to the key in the default cache, for
+    settings.WS_API_TOKEN_MAX_AGE seconds, the time a token opens sockets for. Logging out
+    drops the mapping, revoking the session's tokens. Checking a token is a signature and a
+    cache read, a handshake presenting one reads neither the session nor the user. Behind
+    several processes the cache must be shared (REDIS_URL), a token only opens sockets on
+    the processes that see its mapping.
+"""
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.utils.crypto import salted_hmac
+
+SALT = 'api.tokens.connection'
+
+
+def session_digest(session_key):
+    return salted_hmac(SALT + '.session', session_key, algorithm='sha256').hexdigest()
+
+
+def session_key_key(digest):
+    return f'connection_token.{digest}'
+
+
+def issue_token(user, session):
+    digest = session_digest(session.session_key)
+    cache.set(session_key_key(digest), session.session_key, settings.WS_API_TOKEN_MAX_AGE)
+    return signing.dumps([user.id, user.username, digest], salt=SALT, compress=False)
+
+
+def revoke_tokens(session_key):
+    cache.delete(session_key_key(session_digest(session_key)))
+
+
+def unsign_token(token):
+    try:
+        return signing.loads(token, salt=SALT, max_age=settings.WS_API_TOKEN_MAX_AGE)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+
+
+def read_token(token):
+    """The (user id, username, session key) of a valid token, None otherwise."""
+    claims = unsign_token(token)
+    if claims is None:
+        return None
+    user_id, username, digest = claims
+    session_key = cache.get(session_key_key(digest))
+    if session_key is None:
+        return None
+    return user_id, username, session_key
+
+
+async def aread_token(token):
+    """read_token() for the event loop: the cache, Redis when shared, is read off the loop."""
+    claims = unsign_token(token)
+    if claims is None:
+        return None
+    user_id, username, digest = claims
+    session_key = await cache.aget(session_key_key(digest))
+    if session_key is None:
+        return None
+    return user_id, username, session_key
@@ -1,10 +1,11 @@
 from django.urls import path
-from .views import Register, Login, Logout, VerifySession, GetFriends
+from .views import Register, Login, Logout, VerifySession, ConnectionToken, GetFriends
 
 urlpatterns = [
     path('register/', Register.as_view()),
     path('login/', Login.as_view()),
     path('logout/', Logout.as_view()),
     path('verify-session/', VerifySession.as_view()),
+    path('connection-token/', ConnectionToken.as_view()),
     path('get-friends/', GetFriends.as_view()),
 ]
\ No newline at end of file
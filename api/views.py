@@ -1,4 +1,7 @@
 from django.shortcuts import render
+from django.http import Http404, HttpResponse
+from django.utils.http import parse_etags
+from django.conf import settings
 from django.utils.decorators import method_decorator
 from django.contrib.auth import login, logout
 from django.contrib.auth.decorators import login_required
@@ -8,12 +11,18 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.authentication import SessionAuthentication
 from .serializers import DefaultUserSerializer, DefaultLoginSerializer
+from .friends import get_friend_list
+from .hashing import check_user_password
+from .tokens import issue_token
+from .throttling import IPThrottle, UsernameThrottle
+from . import metrics
 
 
 class Register(APIView):
 
     authentication_classes = []
     permission_classes = []
+    throttle_classes = [IPThrottle]
 
     def post(self, request):
         serializer = DefaultUserSerializer(data=request.data)
@@ -28,6 +37,7 @@ class Login(APIView):
 
     authentication_classes = []
     permission_classes = []
+    throttle_classes = [IPThrottle, UsernameThrottle]
 
     def post(self, request):
         serializer = DefaultLoginSerializer(data=request.data)
@@ -35,7 +45,7 @@ class Login(APIView):
             return Response({'Authentication failed': 'Insufficient credentials.'}, status=status.HTTP_400_BAD_REQUEST)
         username, password = serializer.data['username'], serializer.data['password']
         user = DefaultUser.objects.filter(username=username).first()
-        if not (user and user.check_password(raw_password=password)):
+        if not (user and check_user_password(user, password)):
             return Response({'Authentication failed': 'Invalid credentials.'}, status=status.HTTP_404_NOT_FOUND)
         login(request, user)
         return Response({'Authentication succeeded': 'Logged in.'}, status=status.HTTP_200_OK)
@@ -57,10 +67,41 @@ class VerifySession(APIView):
         return Response(status=status.HTTP_200_OK)
 
 
+class ConnectionToken(APIView):
+    """
+        A token for opening websocket connections as the session's user, with no query
+        during the handshake. Pass it as the `token` query parameter, see api/tokens.py.
+    """
+    authentication_classes = [SessionAuthentication]
+
+    def post(self, request):
+        return Response({'token': issue_token(request.user, request.session),
+                         'expires_in': settings.WS_API_TOKEN_MAX_AGE}, status=status.HTTP_200_OK)
+
+
 class GetFriends(APIView):
+    """
+        Served from the cached friend list. A request whose If-None-Match holds the list's
+        ETag gets an empty 304, with no query for the list.
+    """
+
+    def get(self, request):
+        return self.post(request)
 
     def post(self, request):
-        user = request.user
-        friends = user.friends.values_list('username', flat=True)
-        return Response(friends, status=status.HTTP_200_OK)
+        etag, friends = get_friend_list(request.user.id)
+        headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(friends, status=status.HTTP_200_OK, headers=headers)
+
+
+class Metrics(APIView):
+
+    authentication_classes = []
+    permission_classes = []
 
+    def get(self, request):
+        if not settings.METRICS_ENABLED:
+            raise Http404
+        return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -10,15 +10,19 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-from ws_api import urls
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'messer_backend.settings')
 
+# Sets up Django before the consumers, and through them the models, are imported.
+django_asgi_application = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter
+from ws_api.auth import TokenAuthMiddleware
+from ws_api import urls
+
 application = ProtocolTypeRouter({
-    'http': get_asgi_application(),
-    'websocket': AuthMiddlewareStack(
+    'http': django_asgi_application,
+    'websocket': TokenAuthMiddleware(
         URLRouter(
             urls.websocket_urlpatterns
         )
@@ -47,7 +47,68 @@ INSTALLED_APPS = [
 
 ASGI_APPLICATION = 'messer_backend.asgi.application'
 
+# Channel layer
+# https://channels.readthedocs.io/en/stable/topics/channel_layers.html
+# With REDIS_URL set, events reach sockets on every worker process. The in-memory layer only
+# delivers within the process that produced the event, fine for tests and a single runserver.
+
+REDIS_URL = os.environ.get('REDIS_URL')
+
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+                'capacity': 1500,
+                'expiry': 10,
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        }
+    }
+
+# Threads available to AsyncAPIConsumer for ORM work, shared by all sockets.
+WS_API_DB_POOL_SIZE = int(os.environ.get('WS_API_DB_POOL_SIZE', 16))
+
+# Seconds a socket trusts its session before checking the session store again. Logouts
+# close sockets immediately, this only bounds sessions ending any other way.
+WS_API_SESSION_CHECK_TTL = int(os.environ.get('WS_API_SESSION_CHECK_TTL', 60))
+
+# Seconds a connection token from /api/connection-token/ opens sockets for, see api/tokens.py.
+WS_API_TOKEN_MAX_AGE = int(os.environ.get('WS_API_TOKEN_MAX_AGE', 60))
+
+# Requests a single socket may have in flight on AsyncAPIConsumer.
+WS_API_MAX_PIPELINED_REQUESTS = int(os.environ.get('WS_API_MAX_PIPELINED_REQUESTS', 8))
+
+# Smallest MessagePack frame, in bytes, compressed on 'messer.msgpack.deflate' sockets.
+WS_API_DEFLATE_THRESHOLD = int(os.environ.get('WS_API_DEFLATE_THRESHOLD', 1024))
+
+# Pushed events arriving within this many seconds leave a socket as one 'batch' frame.
+WS_API_COALESCE_WINDOW = float(os.environ.get('WS_API_COALESCE_WINDOW', 0.005))
+
+# Events that may wait on a single socket, and what happens past that: 'drop' or 'disconnect'.
+WS_API_OUTBOX_HIGH_WATER = int(os.environ.get('WS_API_OUTBOX_HIGH_WATER', 1000))
+WS_API_OUTBOX_OVERFLOW = os.environ.get('WS_API_OUTBOX_OVERFLOW', 'drop')
+
+# Seconds between presence rounds: the changes of a round reach each friend as one 'presence' event.
+WS_API_PRESENCE_INTERVAL = float(os.environ.get('WS_API_PRESENCE_INTERVAL', 1))
+
+# Seconds a user stays online after their last socket closed, so reconnects don't flap. See ws_api/presence.py.
+WS_API_PRESENCE_GRACE = float(os.environ.get('WS_API_PRESENCE_GRACE', 5))
+
+# Seconds between the full presence snapshots processes share over the channel layer.
+WS_API_PRESENCE_HEARTBEAT = float(os.environ.get('WS_API_PRESENCE_HEARTBEAT', 30))
+
+# Records request histograms and socket gauges, served on /metrics in the Prometheus text format.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '0') == '1'
+
 MIDDLEWARE = [
+    'api.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.security.SecurityMiddleware',
@@ -82,12 +143,44 @@ WSGI_APPLICATION = 'messer_backend.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
-
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DB_ENGINE=postgresql selects PostgreSQL for production, otherwise the local SQLite file is used.
+
+if os.environ.get('DB_ENGINE') == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DB_NAME', 'messer'),
+            'USER': os.environ.get('DB_USER', 'messer'),
+            'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+            'HOST': os.environ.get('DB_HOST', 'localhost'),
+            'PORT': os.environ.get('DB_PORT', '5432'),
+            # Connections are kept per thread and checked before reuse, so the ORM pool of
+            # AsyncAPIConsumer holds at most WS_API_DB_POOL_SIZE of them. Point DB_HOST at
+            # PgBouncer to pool across processes.
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+        }
     }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                # Seconds a writer waits for the lock before 'database is locked'.
+                'timeout': 20,
+            },
+        }
+    }
+
+# Applied to every new SQLite connection, see api/db.py. WAL lets readers run alongside the
+# single writer, synchronous=NORMAL is durable across application crashes in WAL mode.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 20000,
+    'temp_store': 'MEMORY',
+    'cache_size': -20000,
 }
 
 
@@ -109,7 +202,59 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Processes hashing passwords for Login and Register, 0 hashes on the request thread. See api/hashing.py.
+PASSWORD_HASHING_WORKERS = int(os.environ.get('PASSWORD_HASHING_WORKERS', 2))
+
+# Hashes queued or running per process before Login and Register answer 503.
+PASSWORD_HASHING_QUEUE = int(os.environ.get('PASSWORD_HASHING_QUEUE', 16))
+
+# Added to the niceness of the hashing processes, so they yield the CPU to request handling.
+PASSWORD_HASHING_NICENESS = int(os.environ.get('PASSWORD_HASHING_NICENESS', 10))
+
+# Token buckets of Login and Register, (burst, tokens regained per second). See api/throttling.py.
+AUTH_RATE_LIMIT_PER_IP = (20, 0.5)
+AUTH_RATE_LIMIT_PER_USERNAME = (5, 0.05)
+
+# Age in days past which archive_messages moves read messages into ArchivedMessage, see api/archive.py.
+# Unset, archival is off and history is read from Message alone.
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.environ['MESSAGE_ARCHIVE_AFTER_DAYS']) \
+    if os.environ.get('MESSAGE_ARCHIVE_AFTER_DAYS') else None
+
+# Retention of the per-user event log behind sync, applied by prune_events, see api/events.py: events
+# older than this many days, and past the newest EVENT_LOG_MAX_EVENTS of a user, are dropped.
+EVENT_LOG_MAX_AGE_DAYS = int(os.environ.get('EVENT_LOG_MAX_AGE_DAYS', 30))
+EVENT_LOG_MAX_EVENTS = int(os.environ.get('EVENT_LOG_MAX_EVENTS', 10000))
+
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+
+# Shared between processes when REDIS_URL is set, so friend cache invalidations reach every worker.
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Seconds a user's cached friend list lives, bounds staleness when the cache is not shared between processes.
+FRIENDS_CACHE_TIMEOUT = 300
+
+# Sessions are read through the cache when it is shared between processes, a logout
+# on one worker would otherwise stay unnoticed by the cached copies of the others.
+SESSION_ENGINE = os.environ.get('SESSION_ENGINE', 'django.contrib.sessions.backends.cached_db' if REDIS_URL
+                                else 'django.contrib.sessions.backends.db')
+
 REST_FRAMEWORK = {
+    # Reverse proxies in front of the app. Throttles key on the address the closest of them saw, 0 ignores
+    # X-Forwarded-For, which clients can set to anything.
+    'NUM_PROXIES': int(os.environ.get('NUM_PROXIES', 0)),
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.SessionAuthentication',
     ],
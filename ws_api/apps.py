@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class WsApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ws_api'
+
+    def ready(self):
+        from . import dispatch
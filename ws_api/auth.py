@@ -0,0 +1,46 @@
+"""
+    Websocket authentication by connection token, see api/tokens.py.
+
+    A handshake to a path with a `token` query parameter is authenticated from the token
+    alone, with no query: the user is a DefaultUser holding its id and username, its other
+    fields are loaded on first access, and the session the token was issued to is loaded
+    lazily too. The socket joins the session's group, so logging out closes it as it would
+    one opened with the cookie, and every WS_API_SESSION_CHECK_TTL seconds the consumer
+    authenticates the session and user again (`token_auth` in the scope). An invalid,
+    expired or revoked token leaves the socket anonymous. Handshakes without a token go
+    through channels' AuthMiddlewareStack.
+"""
+from importlib import import_module
+from urllib.parse import parse_qs
+from channels.auth import AuthMiddlewareStack
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db import DEFAULT_DB_ALIAS
+from api.models import DefaultUser
+from api.tokens import aread_token
+
+
+def token_user(user_id, username):
+    return DefaultUser.from_db(DEFAULT_DB_ALIAS, ['id', 'username'], [user_id, username])
+
+
+class TokenAuthMiddleware(BaseMiddleware):
+
+    def __init__(self, inner):
+        super().__init__(inner)
+        self.session_auth = AuthMiddlewareStack(inner)
+        self.session_store = import_module(settings.SESSION_ENGINE).SessionStore
+
+    async def __call__(self, scope, receive, send):
+        tokens = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('token')
+        if not tokens:
+            return await self.session_auth(scope, receive, send)
+        claims = await aread_token(tokens[0])
+        if claims is None:
+            scope = dict(scope, user=AnonymousUser())
+        else:
+            user_id, username, session_key = claims
+            scope = dict(scope, user=token_user(user_id, username), session=self.session_store(session_key),
+                         token_auth=True)
+        return await self.inner(scope, receive, send)
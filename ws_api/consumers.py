@@ -1,39 +1,109 @@
-import json
-from channels.generic.websocket import WebsocketConsumer
+import time
+import asyncio
+import logging
+from types import SimpleNamespace
+from functools import wraps
+from contextvars import ContextVar
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from channels.generic.websocket import WebsocketConsumer, AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
 from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.utils import timezone
+from django.db import transaction
+from django.db.models import Q, F
 from django.db.utils import IntegrityError
-from django.db.models.signals import post_save, post_delete
-from django.contrib.auth.signals import user_logged_out
-from api.models import DefaultUser, Friendship, FriendRequest, Message
-from api.serializers import MessageOutSerializer, FriendRequestOutSerializer, FriendshipOutSerializer
-from .serializers import EndpointInSerializer, SendMessageSerializer, SendFriendRequestSerializer, \
+from rest_framework.exceptions import ValidationError
+from api.models import FriendRequest, Message, ArchivedMessage, ConversationSummary
+from api.serializers import MessageRowSerializer, FriendRequestRowSerializer, ConversationRowSerializer
+from api.conversations import record_messages, record_read
+from api.events import events_since, ResyncRequired
+from api.search import search_usernames
+from api.friends import get_friends
+from api.friendships import FriendshipError
+from api.tokens import session_digest
+from api import archive, friendships, metrics
+from .outbox import Outbox
+from .dispatch import user_group, session_group, push_event, dispatch_received_messages
+from . import frames, presence
+from .serializers import EndpointSchema, validate_frame, SendMessageSerializer, SendMessagesSerializer, \
+    SendFriendRequestSerializer, \
     RespondToFriendRequestSerializer, RemoveFriendSerializer, WithdrawFriendRequestSerializer, \
-    GetMessagesSerializer, GetFriendRequestsSerializer
+    GetMessagesSerializer, GetFriendRequestsSerializer, MarkReadSerializer, GetConversationsSerializer, \
+    SyncSerializer, SearchUsersSerializer, GetPresenceSerializer, MessageCursorField
+
+
+logger = logging.getLogger(__name__)
+
+# Endpoint of the request being handled, lets work such as queries be attributed to it.
+current_endpoint = ContextVar('current_endpoint', default=None)
+
+_db_executor = None
+
+
+def db_executor():
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = ThreadPoolExecutor(max_workers=settings.WS_API_DB_POOL_SIZE,
+                                          thread_name_prefix='ws-api-db')
+    return _db_executor
+
+
+def run_in_db_pool(func, *args, **kwargs):
+    return database_sync_to_async(func, thread_sensitive=False, executor=db_executor())(*args, **kwargs)
+
+
+def conversation_keyset(messages, before, after):
+    """Orders a conversation's messages from the cursor: oldest first after `after`, newest first otherwise."""
+    if after:
+        created_at, pk = after
+        messages = messages.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk))
+        return messages.order_by('created_at', 'id')
+    if before:
+        created_at, pk = before
+        messages = messages.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+    return messages.order_by('-created_at', '-id')
 
 
 def login_required(endpoint):
-    def protected_endpoint(*args, **kwargs):
-        self = args[0]
-        assert type(self) == APIConsumer, TypeError("Missing arg 'self'!")
-        if not self.scope['session'].exists(self.scope['session'].session_key):
-            self.scope['session'].flush()
-            self.send('Authentication Failed: Login Required!')
+    """
+        Rejects the call once the connection's session has ended. The session store is
+        consulted at most once per WS_API_SESSION_CHECK_TTL seconds per connection, a
+        logout closes the socket right away through logout_callback.
+    """
+    @wraps(endpoint)
+    def protected_endpoint(self, *args, **kwargs):
+        assert isinstance(self, APIConsumerMixin), TypeError("Missing arg 'self'!")
+        if not self.session_is_valid():
+            self.wrap_and_send('Response', {'Error': 'Authentication Failed: Login Required!'})
+            self.sync_close()
             return
-        endpoint(*args, **kwargs)
+        return endpoint(self, *args, **kwargs)
 
     return protected_endpoint
 
 
 class Endpoint:
-    def __init__(self, endpoint: callable, serializer=None):
-        self.endpoint = endpoint
+    """
+        An entry of a consumer's dispatch table: the name of the method serving the endpoint
+        and the schema its content is validated with, compiled once with the class.
+    """
+    def __init__(self, method, serializer=None, read_only=False):
+        self.method = method
         self.serializer = serializer
+        self.schema = EndpointSchema(serializer) if serializer else None
+        self.read_only = read_only
 
-    def __call__(self, *args, **kwargs):
-        return self.endpoint(*args, **kwargs)
+    def __call__(self, consumer, *args, **kwargs):
+        if not settings.METRICS_ENABLED:
+            return getattr(consumer, self.method)(*args, **kwargs)
+        with metrics.observe_request('ws', self.method):
+            return getattr(consumer, self.method)(*args, **kwargs)
 
 
-class APIConsumer(WebsocketConsumer):
+class APIConsumerMixin:
     """
         Requires the following endpoints:
 
@@ -41,11 +111,11 @@ class APIConsumer(WebsocketConsumer):
         - Making a friend request
         - Respond to friend request
         - Remove a friend
+        - Searching for usernames
 
         Future:
 
         - Reacting to a message
-        - Searching for usernames
         - Login/Logout/Register
 
         A message is expected to have the following format:
@@ -55,151 +125,552 @@ class APIConsumer(WebsocketConsumer):
         content: {<OBJECT>}
         }
 
+        The endpoints are plain synchronous ORM code, shared by APIConsumer and
+        AsyncAPIConsumer. Each consumer only supplies the transport.
+
     """
 
-    def __init__(self):
-        super().__init__(self)
+    endpoints = {
+        'send_message': Endpoint('send_message', SendMessageSerializer),
+        'send_messages': Endpoint('send_messages', SendMessagesSerializer),
+        'send_friend_request': Endpoint('send_friend_request', SendFriendRequestSerializer),
+        'respond_to_friend_request': Endpoint('respond_to_friend_request', RespondToFriendRequestSerializer),
+        'remove_friend': Endpoint('remove_friend', RemoveFriendSerializer),
+        'withdraw_friend_request': Endpoint('withdraw_friend_request', WithdrawFriendRequestSerializer),
+        'get_messages': Endpoint('get_messages', GetMessagesSerializer, read_only=True),
+        'get_friend_requests': Endpoint('get_friend_requests', GetFriendRequestsSerializer, read_only=True),
+        'mark_read': Endpoint('mark_read', MarkReadSerializer),
+        'get_conversations': Endpoint('get_conversations', GetConversationsSerializer, read_only=True),
+        'sync': Endpoint('sync', SyncSerializer, read_only=True),
+        'search_users': Endpoint('search_users', SearchUsersSerializer, read_only=True),
+        'get_presence': Endpoint('get_presence', GetPresenceSerializer, read_only=True)
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         self.user = None
-        self.endpoints = None
         self.request_count = None
-        user_logged_out.connect(receiver=self.logout_callback)
-        post_save.connect(receiver=self.received_message_callback, sender=Message)
-        post_save.connect(receiver=self.received_friend_request_callback, sender=FriendRequest)
-        post_save.connect(receiver=self.new_friend_callback, sender=Friendship)
-        post_delete.connect(receiver=self.removed_friend_callback, sender=Friendship)
-        self.endpoints = {
-            "send_message": Endpoint(endpoint=self.send_message,
-                                     serializer=SendMessageSerializer),
-            "send_friend_request": Endpoint(endpoint=self.send_friend_request,
-                                            serializer=SendFriendRequestSerializer),
-            "respond_to_friend_request": Endpoint(endpoint=self.respond_to_friend_request,
-                                                  serializer=RespondToFriendRequestSerializer),
-            'remove_friend': Endpoint(endpoint=self.remove_friend,
-                                      serializer=RemoveFriendSerializer),
-            'withdraw_friend_request': Endpoint(endpoint=self.withdraw_friend_request,
-                                                serializer=WithdrawFriendRequestSerializer),
-            'get_messages': Endpoint(endpoint=self.get_messages, serializer=GetMessagesSerializer),
-            'get_friend_requests': Endpoint(endpoint=self.get_friend_requests, 
-                                                    serializer=GetFriendRequestsSerializer)
-        }
-
-    def connect(self):
-        self.user = self.scope['user']
-        if not (self.user and self.user.is_authenticated):
-            self.close(code="Login required!")
-            return
-        self.accept()
-
-    def receive(self, text_data=None, bytes_data=None):
+        self.session_checked_at = float('-inf')
+        self.codec = frames.JSONCodec()
+        self.counted_socket = False
+        self.present = False
+
+    @login_required
+    def handle_request(self, msg):
+        name = msg.get('endpoint') if isinstance(msg, dict) else None
+        token = current_endpoint.set(name if isinstance(name, str) else None)
         try:
-            msg = json.loads(text_data)
-        except json.JSONDecodeError as e:
-            self.wrap_and_send('Response', {'Error': 'Invalid format!'})
-            return
-        serializer = EndpointInSerializer(data=msg, context={'consumer': self})
-        if not serializer.is_valid():
-            self.wrap_and_send('Response', serializer.errors)
-            return
-        endpoint, endpoint_serializer = serializer.validated_data['endpoint'], serializer.validated_data['content']
-        endpoint(**endpoint_serializer.validated_data)
+            try:
+                endpoint, arguments = validate_frame(self.endpoints, msg, self)
+            except ValidationError as exc:
+                self.wrap_and_send('Response', exc.detail)
+                return
+            endpoint(self, **arguments)
+        finally:
+            current_endpoint.reset(token)
 
     # ENDPOINTS:
 
-    def send_message(self, friendship, content):
-        Message.objects.create(friendship=friendship, content=content)
+    def send_message(self, friendship_id, recipient_id, content):
+        try:
+            with transaction.atomic():
+                Message.objects.create(friendship_id=friendship_id, sender=self.user, recipient_id=recipient_id,
+                                       content=content)
+        except IntegrityError:
+            # Removed after the friend list was read.
+            self.wrap_and_send('Response', {'Error': 'That user is not in your friend list.'})
+            return
         self.wrap_and_send('Response', {'Success': 'Message sent.'})
 
-    def send_friend_request(self, friend_request):
+    def send_messages(self, messages):
+        """
+            Stores a batch of messages in one transaction and acks each by its client_id.
+            A client_id the user already sent is acked as a duplicate instead of stored
+            again, so replaying an outbox after a reconnect is safe.
+
+            Duplicates are looked up before the transaction, which then only writes: on
+            SQLite a transaction reading before it writes fails when another writer
+            committed in between. A duplicate sent concurrently is caught by the unique
+            (sender, client_id) constraint.
+        """
+        acks, deliverable = {}, []
+        for message in messages:
+            if 'error' in message:
+                acks[message['client_id']] = {'status': 'error', 'error': message['error']}
+            else:
+                deliverable.append(message)
+        client_ids = [message['client_id'] for message in deliverable]
+        existing = Message.objects.filter(sender=self.user, client_id__in=client_ids)
+        for client_id, pk in existing.values_list('client_id', 'id'):
+            acks[client_id] = {'status': 'duplicate', 'id': pk}
+        deliverable = [message for message in deliverable if message['client_id'] not in acks]
+        received = []
         try:
-            friend_request.save(force_insert=True)
-        except IntegrityError as e:
-            self.wrap_and_send('Response', {'Error': 'You have already sent a friend request to that user.'})
-        except AssertionError as e:
+            with transaction.atomic():
+                created = Message.objects.bulk_create([
+                    Message(friendship_id=message['friendship_id'], sender=self.user,
+                            recipient_id=message['recipient_id'], content=message['content'],
+                            client_id=message['client_id'])
+                    for message in deliverable
+                ])
+                record_messages(created)
+                for message, instance in zip(deliverable, created):
+                    received.append((instance.recipient_id, {
+                        'id': instance.id,
+                        'from_user': self.user.username,
+                        'to_user': message['friend'],
+                        'created_at': instance.created_at,
+                        'has_been_read': False,
+                        'read_at': None,
+                        'content': instance.content
+                    }))
+                MessageRowSerializer.render([row for _, row in received])
+                # Logged with the messages, pushed once they commit.
+                dispatch_received_messages(received)
+        except IntegrityError:
+            self.wrap_and_send('Response', {'Error': 'Messages with these client_ids are being sent, retry.'})
+            return
+        for message, instance in zip(deliverable, created):
+            acks[message['client_id']] = {'status': 'sent', 'id': instance.id}
+        self.wrap_and_send('messages_sent', acks)
+
+    def send_friend_request(self, to_user):
+        try:
+            friendships.send_request(self.user, to_user)
+        except FriendshipError as e:
             self.wrap_and_send('Response', {'Error': str(e)})
 
-    def respond_to_friend_request(self, friend_request, accept):
-        if accept:
-            friend_request.accept_request()
-            self.wrap_and_send('Response', {'Errors': '', 'status': 'Friend request accepted.'})
+    def respond_to_friend_request(self, from_user, accept):
+        try:
+            if accept:
+                friendships.accept_request(self.user, from_user)
+            else:
+                friendships.reject_request(self.user, from_user)
+        except FriendshipError as e:
+            self.wrap_and_send('Response', {'Error': str(e)})
             return
-        friend_request.reject_request()
-        self.wrap_and_send('Response', {'Errors': '', 'status': 'Friend request rejected.'})
+        status = 'Friend request accepted.' if accept else 'Friend request rejected.'
+        self.wrap_and_send('Response', {'Errors': '', 'status': status})
 
-    def remove_friend(self, friendship):
-        friendship.delete()
+    def remove_friend(self, friend):
+        try:
+            friendships.remove_friend(self.user, friend)
+        except FriendshipError as e:
+            self.wrap_and_send('Response', {'Error': str(e)})
+            return
         self.wrap_and_send('Response', {'Errors': '', 'status': 'Friend removed.'})
 
-    def withdraw_friend_request(self, friend_request):
-        friend_request.delete()
+    def withdraw_friend_request(self, to_user):
+        try:
+            friendships.withdraw_request(self.user, to_user)
+        except FriendshipError as e:
+            self.wrap_and_send('Response', {'Error': str(e)})
+            return
         self.wrap_and_send('Response', {'Errors': '', 'status': 'Friend request withdrawn.'})
 
-    def get_messages(self):
-        received_messages = Message.objects.filter(friendship__friend = self.user)
-        sent_messages = Message.objects.filter(friendship__user = self.user)
-        received_messages_arr, sent_messages_arr = [], []
-        for message in received_messages:
-            serializer = MessageOutSerializer(message)
-            received_messages_arr.append(serializer.data)
-        for message in sent_messages:
-            serializer = MessageOutSerializer(message)
-            sent_messages_arr.append(serializer.data)
+    def get_messages(self, friend=None, friendship_id=None, before=None, after=None, limit=None,
+                     stream=False, chunk_size=None):
+        if friend is not None:
+            self.get_conversation_page(friend, friendship_id, before, after, limit)
+            return
+        parts = []
+        for kind, user_field in (('received_messages', 'recipient'), ('sent_messages', 'sender')):
+            if archive.enabled():
+                parts.append((kind, ArchivedMessage.objects.filter(**{user_field: self.user})))
+            parts.append((kind, Message.objects.filter(**{user_field: self.user})))
+        if stream:
+            self.stream_rows('messages_chunk', 'messages', MessageRowSerializer, chunk_size, parts)
+            return
+        content = {'received_messages': [], 'sent_messages': []}
+        for kind, messages in parts:
+            content[kind] += MessageRowSerializer(messages).data
+        self.wrap_and_send(msg_type='messages', content=content)
+
+    def get_conversation_page(self, friend, friendship_id, before, after, limit):
+        """
+            Keyset pagination over (created_at, id), served by the Message(friendship, created_at)
+            index. Without a cursor the newest page is returned. Messages are always in
+            chronological order, the 'before'/'after' cursors fetch the adjacent pages.
+            Pages reaching past the newest archived message are merged with the archive.
+        """
+        messages = conversation_keyset(Message.objects.filter(friendship_id=friendship_id), before, after)
+        page = MessageRowSerializer.fetch(messages[:limit + 1])
+        if archive.reaches_archive(friendship_id, page, after, limit):
+            archived = conversation_keyset(ArchivedMessage.objects.filter(friendship_id=friendship_id), before, after)
+            page += MessageRowSerializer.fetch(archived[:limit + 1])
+            page.sort(key=lambda row: (row['created_at'], row['id']), reverse=not after)
+        has_more, page = len(page) > limit, page[:limit]
+        if not after:
+            page.reverse()
+        cursor = MessageCursorField()
+        before = cursor.to_representation((page[0]['created_at'], page[0]['id'])) if page else None
+        after = cursor.to_representation((page[-1]['created_at'], page[-1]['id'])) if page else None
         content = {
-            'received_messages': received_messages_arr,
-            'sent_messages': sent_messages_arr
+            'friend': friend,
+            'messages': MessageRowSerializer.render(page),
+            'has_more': has_more,
+            'before': before,
+            'after': after
         }
-        self.wrap_and_send(msg_type='messages', content=content)
+        self.wrap_and_send(msg_type='messages_page', content=content)
+
+    def mark_read(self, friend_id, friendship_id, up_to):
+        """
+            Marks every unread message from the friend up to and including the cursor as read
+            in a single UPDATE, then tells the friend once.
+        """
+        read_at = timezone.now()
+        messages = Message.objects.filter(friendship_id=friendship_id, recipient=self.user, has_been_read=False)
+        if up_to:
+            created_at, pk = up_to
+            messages = messages.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lte=pk))
+        with transaction.atomic():
+            count = messages.update(has_been_read=True, read_at=read_at)
+            record_read(friendship_id, self.user.id, count)
+            if count:
+                # Logged with the reads, pushed once they commit.
+                push_event(friend_id, 'messages_read', 'messages_read_callback', {
+                    'friend': self.user.username,
+                    'up_to': MessageCursorField().to_representation(up_to) if up_to else None,
+                    'read_at': MessageRowSerializer.datetime_field.to_representation(read_at),
+                    'count': count
+                })
+        self.wrap_and_send('Response', {'Success': 'Messages marked read.', 'count': count})
+
+    def get_conversations(self):
+        conversations = ConversationSummary.objects.filter(user=self.user).order_by(*ConversationSummary.INBOX_ORDER)
+        self.wrap_and_send(msg_type='conversations', content=ConversationRowSerializer(conversations).data)
+
+    def sync(self, cursor, limit):
+        """
+            Everything pushed to the user after `cursor`, in order: the same received_message,
+            messages_read, new_friend_request, new_friend and removed_friend payloads the
+            socket gets live. The returned cursor is the seq to sync from next time.
+
+            Once events after the cursor were pruned, `resync_required` is set instead: the
+            client reloads its state with the other endpoints, then syncs from the returned
+            cursor.
+        """
+        try:
+            events, has_more = events_since(self.user.id, cursor, limit)
+        except ResyncRequired as e:
+            self.wrap_and_send(msg_type='sync', content={'events': [], 'cursor': e.cursor, 'has_more': False,
+                                                         'resync_required': True})
+            return
+        content = {
+            'events': events,
+            'cursor': events[-1]['seq'] if events else cursor,
+            'has_more': has_more,
+            'resync_required': False
+        }
+        self.wrap_and_send(msg_type='sync', content=content)
+
+    def search_users(self, query, limit):
+        content = {
+            'query': query,
+            'users': search_usernames(self.user.id, query, limit)
+        }
+        self.wrap_and_send(msg_type='users', content=content)
 
-    def get_friend_requests(self):
-        received_friend_requests = FriendRequest.objects.filter(to_user = self.user)
-        sent_friend_requests = FriendRequest.objects.filter(from_user = self.user)
-        received_friend_requests_arr, sent_friend_requests_arr = [], []
-        for request in received_friend_requests:
-            serializer = FriendRequestOutSerializer(request)
-            received_friend_requests_arr.append(serializer.data)
-        for request in sent_friend_requests:
-            serializer = FriendRequestOutSerializer(request)
-            sent_friend_requests_arr.append(serializer.data)
+    def get_presence(self):
+        """Answered from the presence registry and the friend cache, see presence.py."""
+        friends = get_friends(self.user.id)
         content = {
-            'received_friend_requests': received_friend_requests_arr,
-            'sent_friend_requests': sent_friend_requests_arr
+            'users': [presence.registry.describe(username, friend_id)
+                      for username, (friend_id, _) in sorted(friends.items())]
+        }
+        self.wrap_and_send(msg_type='presence', content=content)
+
+    def get_friend_requests(self, stream=False, chunk_size=None):
+        received_friend_requests = FriendRequest.objects.filter(to_user=self.user)
+        sent_friend_requests = FriendRequest.objects.filter(from_user=self.user)
+        if stream:
+            self.stream_rows('friend_requests_chunk', 'friend_requests', FriendRequestRowSerializer, chunk_size,
+                             [('received_friend_requests', received_friend_requests),
+                              ('sent_friend_requests', sent_friend_requests)])
+            return
+        content = {
+            'received_friend_requests': FriendRequestRowSerializer(received_friend_requests).data,
+            'sent_friend_requests': FriendRequestRowSerializer(sent_friend_requests).data
         }
         self.wrap_and_send(msg_type='friend_requests', content=content)
 
-    # CALLBACKS
+    # UTILITIES
 
-    def logout_callback(self, sender, request, user, **kwargs):
-        if not self.user == user:
-            return
-        self.send("Connection closing: Logging out.")
-        async_to_sync(self.close())
+    def stream_rows(self, msg_type, key, serializer, chunk_size, parts):
+        """
+            Sends the rows of each (kind, queryset) part as `msg_type` frames of at most
+            chunk_size rows, {chunk, kind, <key>: [...], final}, reading and encoding one chunk
+            at a time. Chunks are numbered from 0 and only the last one is final.
+        """
+        number, pending = 0, None
+        for kind, queryset in parts:
+            for rows in serializer.chunks(queryset, chunk_size):
+                if pending is not None:
+                    self.wrap_and_send(msg_type, pending)
+                    number += 1
+                pending = {'chunk': number, 'kind': kind, key: rows, 'final': False}
+        if pending is None:
+            pending = {'chunk': 0, 'kind': parts[0][0], key: [], 'final': False}
+        pending['final'] = True
+        self.wrap_and_send(msg_type, pending)
+
+    def connection_groups(self):
+        groups = [user_group(self.user.id)]
+        session = self.scope.get('session')
+        if session is not None and session.session_key:
+            groups.append(session_group(session_digest(session.session_key)))
+        return groups
+
+    def session_is_valid(self):
+        session = self.scope.get('session')
+        if session is None:
+            # Authenticated without a session, nothing can expire after the handshake.
+            return True
+        now = time.monotonic()
+        if now - self.session_checked_at < settings.WS_API_SESSION_CHECK_TTL:
+            return True
+        if self.scope.get('token_auth'):
+            # The handshake read neither the session nor the user, see auth.py: authenticate
+            # them as a cookie handshake would, from a fresh copy of the session.
+            request = SimpleNamespace(session=type(session)(session.session_key))
+            if get_user(request).pk != self.user.pk:
+                return False
+        elif not (session.session_key and session.exists(session.session_key)):
+            session.flush()
+            return False
+        self.session_checked_at = now
+        return True
+
+    def encode_frame(self, msg_type, content):
+        """Returns the send() arguments of the frame in the connection's wire format, see frames.py."""
+        data = {'type': msg_type,
+                'content': content}
+        frame = self.codec.encode(data)
+        sample = metrics.current_sample.get()
+        if sample is not None:
+            sample.size += len(frame['text_data'].encode()) if 'text_data' in frame else len(frame['bytes_data'])
+        return frame
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        if text_data is not None:
+            return frames.loads(text_data)
+        return self.codec.decode(bytes_data)
+
+    def socket_opened(self):
+        presence.registry.connected(self.user.id, self.user.username)
+        self.present = True
+        if settings.METRICS_ENABLED:
+            metrics.sockets.opened(type(self).__name__, self.user.id)
+            self.counted_socket = True
+
+    def socket_closed(self):
+        if self.present:
+            presence.registry.disconnected(self.user.id)
+            self.present = False
+        if self.counted_socket:
+            metrics.sockets.closed(type(self).__name__, self.user.id)
+            self.counted_socket = False
+
+    def wrap_and_send(self, msg_type, content):
+        raise NotImplementedError
+
+    def sync_close(self):
+        raise NotImplementedError
+
+
+class APIConsumer(APIConsumerMixin, WebsocketConsumer):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbox = Outbox(self.send_frame, self.close_socket)
+        self.asgi_send = None
 
-    def received_message_callback(self, instance, created, **kwargs):
-        if not (created and instance.friendship.friend == self.user):
+    async def __call__(self, scope, receive, send):
+        # The sync consumer's base_send blocks, the outbox writes from the event loop with the raw one.
+        self.asgi_send = send
+        await super().__call__(scope, receive, send)
+
+    def connect(self):
+        self.user = self.scope['user']
+        if not (self.user and self.user.is_authenticated):
+            self.close(code="Login required!")
+            return
+        self.codec = frames.negotiate(self.scope.get('subprotocols', ()))
+        for group in self.connection_groups():
+            async_to_sync(self.channel_layer.group_add)(group, self.channel_name)
+        async_to_sync(presence.registry.ensure_running)()
+        self.socket_opened()
+        self.accept(self.codec.subprotocol)
+
+    def disconnect(self, code):
+        async_to_sync(self.outbox.stop)()
+        self.socket_closed()
+        if not (self.user and self.user.is_authenticated):
             return
-        serializer = MessageOutSerializer(instance)
-        self.wrap_and_send(msg_type="received_message", content=serializer.data)
+        for group in self.connection_groups():
+            async_to_sync(self.channel_layer.group_discard)(group, self.channel_name)
 
-    def received_friend_request_callback(self, instance, created, **kwargs):
-        if not (created and instance.to_user == self.user):
+    def receive(self, text_data=None, bytes_data=None):
+        msg = self.decode_frame(text_data, bytes_data)
+        if msg is None:
+            self.wrap_and_send('Response', {'Error': 'Invalid format!'})
             return
-        serializer = FriendRequestOutSerializer(instance)
-        self.wrap_and_send(msg_type="new_friend_request", content=serializer.data)
+        self.handle_request(msg)
+
+    # CALLBACKS
+    # Invoked through the user's group, see dispatch.py. Sent through the outbox, see outbox.py.
+
+    def logout_callback(self, event):
+        self.send("Connection closing: Logging out.")
+        self.close()
+
+    def received_message_callback(self, event):
+        self.queue_frame(msg_type="received_message", content=event['content'])
+
+    def received_messages_callback(self, event):
+        self.queue_frame(msg_type="received_messages", content=event['content'])
+
+    def messages_read_callback(self, event):
+        self.queue_frame(msg_type="messages_read", content=event['content'])
+
+    def received_friend_request_callback(self, event):
+        self.queue_frame(msg_type="new_friend_request", content=event['content'])
+
+    def new_friend_callback(self, event):
+        self.queue_frame(msg_type="new_friend", content=event['content'])
+
+    def removed_friend_callback(self, event):
+        self.queue_frame(msg_type='removed_friend', content=event['content'])
+
+    def presence_callback(self, event):
+        self.queue_frame(msg_type='presence', content=event['content'])
+
+    # UTILITIES
 
-    def new_friend_callback(self, instance, created, **kwargs):
-        if not (created and instance.user == self.user):
+    def wrap_and_send(self, msg_type, content):
+        self.send(**self.encode_frame(msg_type, content))
+
+    def queue_frame(self, msg_type, content):
+        async_to_sync(self.outbox.put)(msg_type, content)
+
+    async def send_frame(self, msg_type, content):
+        frame = self.encode_frame(msg_type, content)
+        if 'text_data' in frame:
+            await self.asgi_send({'type': 'websocket.send', 'text': frame['text_data']})
+        else:
+            await self.asgi_send({'type': 'websocket.send', 'bytes': frame['bytes_data']})
+
+    async def close_socket(self):
+        await self.asgi_send({'type': 'websocket.close'})
+
+    def sync_close(self):
+        self.close()
+
+
+class AsyncAPIConsumer(APIConsumerMixin, AsyncWebsocketConsumer):
+    """
+        Same endpoints as APIConsumer, served from the event loop.
+
+        Each request runs its validation and ORM work in a single hop to the
+        bounded database pool (settings.WS_API_DB_POOL_SIZE). Requests from one
+        socket are pipelined: read-only endpoints run concurrently, while the
+        others keep their arrival order behind a per-connection lock. At most
+        settings.WS_API_MAX_PIPELINED_REQUESTS requests per socket are in flight,
+        frames past that are answered with an error rather than queued.
+
+        Opt-in on ws/ws-api-async/, ws/ws-api/ stays on APIConsumer: on SQLite it
+        handshakes faster but does not answer requests faster, and its send p99 is
+        worse, see bench_consumers.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_lock = asyncio.Lock()
+        self.pending_requests = set()
+        self.outbox = Outbox(self.async_wrap_and_send, self.close)
+
+    async def connect(self):
+        self.user = self.scope['user']
+        if not (self.user and self.user.is_authenticated):
+            await self.close(code="Login required!")
+            return
+        self.codec = frames.negotiate(self.scope.get('subprotocols', ()))
+        for group in self.connection_groups():
+            await self.channel_layer.group_add(group, self.channel_name)
+        await presence.registry.ensure_running()
+        self.socket_opened()
+        await self.accept(self.codec.subprotocol)
+
+    async def disconnect(self, code):
+        for task in self.pending_requests:
+            task.cancel()
+        await self.outbox.stop()
+        self.socket_closed()
+        if not (self.user and self.user.is_authenticated):
             return
-        serializer = FriendshipOutSerializer(instance)
-        self.wrap_and_send(msg_type="new_friend", content=serializer.data)
+        for group in self.connection_groups():
+            await self.channel_layer.group_discard(group, self.channel_name)
 
-    def removed_friend_callback(self, instance, **kwargs):
-        if not instance.user == self.user:
+    async def receive(self, text_data=None, bytes_data=None):
+        msg = self.decode_frame(text_data, bytes_data)
+        if msg is None:
+            await self.async_wrap_and_send('Response', {'Error': 'Invalid format!'})
             return
-        serializer = FriendshipOutSerializer(instance)
-        self.wrap_and_send(msg_type='removed_friend', content=serializer.data)
+        if len(self.pending_requests) >= settings.WS_API_MAX_PIPELINED_REQUESTS:
+            await self.async_wrap_and_send('Response', {'Error': 'Too many requests in flight.'})
+            return
+        task = asyncio.ensure_future(self.run_request(msg))
+        self.pending_requests.add(task)
+        task.add_done_callback(self.pending_requests.discard)
+
+    async def run_request(self, msg):
+        name = msg.get('endpoint') if isinstance(msg, dict) else None
+        endpoint = self.endpoints.get(name) if isinstance(name, str) else None
+        ordering = nullcontext() if endpoint and endpoint.read_only else self.write_lock
+        async with ordering:
+            try:
+                await run_in_db_pool(self.handle_request, msg)
+            except Exception:
+                logger.exception('Request to %s failed.', msg.get('endpoint'))
+                await self.async_wrap_and_send('Response', {'Error': 'Request failed.'})
+
+    # CALLBACKS
+    # Invoked through the user's group, see dispatch.py. Sent through the outbox, see outbox.py.
+
+    async def logout_callback(self, event):
+        await self.send("Connection closing: Logging out.")
+        await self.close()
+
+    async def received_message_callback(self, event):
+        await self.outbox.put(msg_type="received_message", content=event['content'])
+
+    async def received_messages_callback(self, event):
+        await self.outbox.put(msg_type="received_messages", content=event['content'])
+
+    async def messages_read_callback(self, event):
+        await self.outbox.put(msg_type="messages_read", content=event['content'])
+
+    async def received_friend_request_callback(self, event):
+        await self.outbox.put(msg_type="new_friend_request", content=event['content'])
+
+    async def new_friend_callback(self, event):
+        await self.outbox.put(msg_type="new_friend", content=event['content'])
+
+    async def removed_friend_callback(self, event):
+        await self.outbox.put(msg_type='removed_friend', content=event['content'])
+
+    async def presence_callback(self, event):
+        await self.outbox.put(msg_type='presence', content=event['content'])
 
     # UTILITIES
 
     def wrap_and_send(self, msg_type, content):
-        data = {'type': msg_type,
-                'content': content}
-        self.send(json.dumps(data))
+        # Called by the endpoints from a database pool thread.
+        async_to_sync(self.send)(**self.encode_frame(msg_type, content))
+
+    async def async_wrap_and_send(self, msg_type, content):
+        await self.send(**self.encode_frame(msg_type, content))
+
+    def sync_close(self):
+        async_to_sync(self.close)()
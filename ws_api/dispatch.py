@@ -0,0 +1,126 @@
+"""
+    Routes model events to the sockets of the users they concern.
+
+    Every connected APIConsumer joins the group of its user, so an event is
+    sent once to the recipient's group instead of being offered to every
+    open socket. The group message type names the consumer callback that
+    handles it.
+
+    Events are appended to the user's event log (api/events.py) before they
+    are pushed, and carry their 'seq' so clients know where to sync from.
+"""
+from collections import defaultdict
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_save, post_delete
+from django.contrib.auth.signals import user_logged_out
+from django.dispatch import receiver
+from api.models import DefaultUser, Friendship, FriendRequest, Message
+from api.events import record_events
+from api.tokens import session_digest, revoke_tokens
+from api.serializers import MessageOutSerializer, FriendRequestOutSerializer, FriendshipOutSerializer
+
+
+def user_group(user_id):
+    return f'user.{user_id}'
+
+
+def session_group(digest):
+    """The group of the sockets opened with a session, by its tokens.session_digest()."""
+    return f'session.{digest}'
+
+
+def push_to_group(group, callback, content=None):
+    """Sends once the current transaction commits, so clients never act on state other workers can't read yet."""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    transaction.on_commit(lambda: async_to_sync(channel_layer.group_send)(group, {'type': callback,
+                                                                                  'content': content}))
+
+
+def push_to_user(user_id, callback, content=None):
+    push_to_group(user_group(user_id), callback, content)
+
+
+def push_event(user_id, event_type, callback, content):
+    """Logs the event for the user and pushes it to their sockets with its seq."""
+    seq, = record_events(user_id, [(event_type, content)])
+    push_to_user(user_id, callback, {**content, 'seq': seq})
+
+
+@receiver(post_save, sender=Message)
+def dispatch_received_message(instance, created, **kwargs):
+    if not created:
+        return
+    serializer = MessageOutSerializer(instance)
+    push_event(instance.recipient_id, 'received_message', 'received_message_callback', dict(serializer.data))
+
+
+def dispatch_received_messages(messages):
+    """
+        Pushes messages saved with bulk_create, which sends no post_save, as one
+        batch per recipient. Takes (recipient id, rendered message) pairs.
+    """
+    batches = defaultdict(list)
+    for recipient_id, message in messages:
+        batches[recipient_id].append(message)
+    for recipient_id, batch in batches.items():
+        seqs = record_events(recipient_id, [('received_message', message) for message in batch])
+        push_to_user(recipient_id, 'received_messages_callback',
+                     [{**message, 'seq': seq} for seq, message in zip(seqs, batch)])
+
+
+@receiver(post_save, sender=FriendRequest)
+def dispatch_received_friend_request(instance, created, **kwargs):
+    if not created:
+        return
+    serializer = FriendRequestOutSerializer(instance)
+    push_event(instance.to_user_id, 'new_friend_request', 'received_friend_request_callback',
+               dict(serializer.data))
+
+
+@receiver(post_save, sender=Friendship)
+def dispatch_new_friend(instance, created, **kwargs):
+    if not created:
+        return
+    for user_id in (instance.user_id, instance.friend_id):
+        serializer = FriendshipOutSerializer(instance, context={'user_id': user_id})
+        push_event(user_id, 'new_friend', 'new_friend_callback', dict(serializer.data))
+
+
+def is_deleting_user(origin, user_id):
+    if isinstance(origin, DefaultUser):
+        return origin.id == user_id
+    if isinstance(origin, QuerySet) and origin.model is DefaultUser:
+        return origin.filter(id=user_id).exists()
+    return False
+
+
+@receiver(post_delete, sender=Friendship)
+def dispatch_removed_friend(instance, origin=None, **kwargs):
+    for user_id in (instance.user_id, instance.friend_id):
+        if is_deleting_user(origin, user_id):
+            # The friendship goes with the user, who has no log left to write to.
+            continue
+        serializer = FriendshipOutSerializer(instance, context={'user_id': user_id})
+        push_event(user_id, 'removed_friend', 'removed_friend_callback', dict(serializer.data))
+
+
+@receiver(user_logged_out)
+def dispatch_logout(request, user, **kwargs):
+    """
+        Closes the sockets of the session being logged out, or all of the user's if it is
+        unknown. The session's connection tokens are revoked right away, the sockets are
+        closed once the logout is committed.
+    """
+    session_key = getattr(getattr(request, 'session', None), 'session_key', None)
+    if session_key:
+        revoke_tokens(session_key)
+        push_to_group(session_group(session_digest(session_key)), 'logout_callback')
+        return
+    if user is None:
+        return
+    push_to_user(user.id, 'logout_callback')
@@ -0,0 +1,155 @@
+"""
+    Encoding of websocket frames.
+
+    Without a subprotocol, or with 'messer.json', frames are JSON text. orjson is used when it
+    is installed, the standard library json module otherwise; both produce the same documents.
+
+    With 'messer.msgpack' frames are binary: one header byte, PLAIN or DEFLATE, followed by a
+    MessagePack document whose keys listed in FIELD_NAMES are replaced by their position in
+    the list. 'messer.msgpack.deflate' additionally compresses documents of
+    settings.WS_API_DEFLATE_THRESHOLD bytes or more with raw deflate. Clients may compress
+    the frames they send under either MessagePack subprotocol.
+"""
+import json
+import zlib
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+if orjson is not None:
+
+    def dumps(data):
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(text_data):
+        try:
+            return orjson.loads(text_data)
+        except orjson.JSONDecodeError:
+            return None
+
+else:
+
+    def dumps(data):
+        return json.dumps(data)
+
+    def loads(text_data):
+        try:
+            return json.loads(text_data)
+        except (json.JSONDecodeError, TypeError):
+            return None
+
+
+SUBPROTOCOL_JSON = 'messer.json'
+SUBPROTOCOL_MSGPACK = 'messer.msgpack'
+SUBPROTOCOL_MSGPACK_DEFLATE = 'messer.msgpack.deflate'
+
+# Append only, clients keep their own copy of this list.
+FIELD_NAMES = (
+    'type', 'content', 'endpoint', 'id', 'from_user', 'to_user', 'created_at', 'has_been_read', 'read_at',
+    'friend', 'messages', 'has_more', 'before', 'after', 'limit', 'up_to', 'count', 'status', 'error',
+    'client_id', 'accept', 'received_messages', 'sent_messages', 'received_friend_requests',
+    'sent_friend_requests', 'last_message_id', 'last_message_from', 'last_message_preview', 'last_message_at',
+    'unread_count', 'Success', 'Error', 'Errors', 'seq', 'cursor', 'events',
+    'query', 'users',
+    'stream', 'chunk_size', 'chunk', 'kind', 'final', 'friend_requests',
+    'user', 'online', 'last_seen'
+)
+FIELD_CODES = {name: code for code, name in enumerate(FIELD_NAMES)}
+
+PLAIN = b'\x00'
+DEFLATE = b'\x01'
+MAX_INFLATED_SIZE = 1 << 20
+
+
+SCALARS = frozenset((str, int, float, bool, type(None)))
+
+
+def shorten(data):
+    if isinstance(data, dict):
+        return {FIELD_CODES.get(key, key): value if type(value) in SCALARS else shorten(value)
+                for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [item if type(item) in SCALARS else shorten(item) for item in data]
+    return data
+
+
+def expand(data):
+    if isinstance(data, dict):
+        return {FIELD_NAMES[key] if type(key) is int and 0 <= key < len(FIELD_NAMES) else key:
+                value if type(value) in SCALARS else expand(value)
+                for key, value in data.items()}
+    if isinstance(data, list):
+        return [item if type(item) in SCALARS else expand(item) for item in data]
+    return data
+
+
+def inflate(data):
+    decompressor = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+    inflated = decompressor.decompress(data, MAX_INFLATED_SIZE)
+    if decompressor.unconsumed_tail:
+        raise ValueError('Frame too large.')
+    return inflated
+
+
+def deflate(data):
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class JSONCodec:
+
+    def __init__(self, subprotocol=None):
+        self.subprotocol = subprotocol
+
+    def encode(self, data):
+        return {'text_data': dumps(data)}
+
+    def decode(self, bytes_data):
+        return loads(bytes_data)
+
+
+class MessagePackCodec:
+
+    def __init__(self, subprotocol, deflate_threshold=None):
+        self.subprotocol = subprotocol
+        self.deflate_threshold = deflate_threshold
+
+    def encode(self, data):
+        packed = msgpack.packb(shorten(data))
+        if self.deflate_threshold is not None and len(packed) >= self.deflate_threshold:
+            return {'bytes_data': DEFLATE + deflate(packed)}
+        return {'bytes_data': PLAIN + packed}
+
+    def decode(self, bytes_data):
+        try:
+            header, body = bytes_data[:1], bytes_data[1:]
+            if header == DEFLATE:
+                body = inflate(body)
+            elif header != PLAIN:
+                return None
+            return expand(msgpack.unpackb(body, strict_map_key=False))
+        except (ValueError, TypeError, zlib.error, msgpack.UnpackException):
+            return None
+
+
+def negotiate(subprotocols):
+    """Returns the codec of the first offered subprotocol the server speaks, plain JSON if there is none."""
+    for subprotocol in subprotocols:
+        if subprotocol == SUBPROTOCOL_JSON:
+            return JSONCodec(subprotocol)
+        if msgpack is None:
+            continue
+        if subprotocol == SUBPROTOCOL_MSGPACK:
+            return MessagePackCodec(subprotocol)
+        if subprotocol == SUBPROTOCOL_MSGPACK_DEFLATE:
+            return MessagePackCodec(subprotocol, settings.WS_API_DEFLATE_THRESHOLD)
+    return JSONCodec()
@@ -0,0 +1,88 @@
+"""
+    Shared helpers for the bench_* management commands. Benchmarks run against
+    a throwaway test database, never the configured one.
+"""
+import os
+import time
+import tempfile
+from contextlib import contextmanager
+from channels.testing import WebsocketCommunicator
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+from api.models import DefaultUser, Friendship, Message, ConversationSummary
+
+
+@contextmanager
+def test_database():
+    # SQLite's shared in-memory test database locks whole tables, use a file so concurrent writers wait instead.
+    if connection.vendor == 'sqlite' and not connection.settings_dict['TEST']['NAME']:
+        connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+    if connection.vendor == 'sqlite':
+        # Load runs queue many writers, the default 5s busy timeout would fail requests instead of timing them.
+        connection.settings_dict['OPTIONS'].setdefault('timeout', 60)
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+
+def create_users(count, prefix='bench'):
+    """Creates `count` users where every even/odd pair are friends."""
+    users = DefaultUser.objects.bulk_create([
+        DefaultUser(username=f'{prefix}{i}', email=f'{prefix}{i}@bench.local') for i in range(count)
+    ])
+    friendships = Friendship.objects.bulk_create([
+        Friendship(**Friendship.canonical(users[i].id, users[i + 1].id)) for i in range(0, count - 1, 2)
+    ])
+    ConversationSummary.objects.bulk_create([
+        ConversationSummary(friendship=friendship, user_id=user_id, friend_id=friendship.other(user_id))
+        for friendship in friendships for user_id in (friendship.user_id, friendship.friend_id)
+    ])
+    return users
+
+
+def create_history(users, per_user):
+    """Gives every user `per_user` sent messages to their friend."""
+    friendships = Friendship.objects.filter(user__in=users)
+    Message.objects.bulk_create([
+        Message(friendship=friendship, sender_id=sender_id, recipient_id=friendship.other(sender_id),
+                content=f'message {i}')
+        for friendship in friendships for sender_id in (friendship.user_id, friendship.friend_id)
+        for i in range(per_user)
+    ], batch_size=1000)
+
+
+def friend_of(user_index, users):
+    return users[user_index ^ 1]
+
+
+async def connect(application, user, path='/ws/ws-api/'):
+    communicator = WebsocketCommunicator(application, path)
+    communicator.scope['user'] = user
+    connected, _ = await communicator.connect()
+    assert connected, f'Could not connect {user}.'
+    return communicator
+
+
+async def receive_until(communicator, msg_types, timeout=30):
+    """Reads frames until one of each type in `msg_types` arrived, returns their arrival times."""
+    arrived = {}
+    while len(arrived) < len(msg_types):
+        received = await communicator.receive_json_from(timeout=timeout)
+        for frame in received['content'] if received['type'] == 'batch' else [received]:
+            if frame['type'] in msg_types and frame['type'] not in arrived:
+                arrived[frame['type']] = time.perf_counter()
+    return arrived
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def ms(seconds):
+    return f'{seconds * 1000:.1f}'
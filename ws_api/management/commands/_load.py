@@ -0,0 +1,280 @@
+"""
+    Simulated clients and workloads for bench_load.
+
+    Every client is a WebsocketCommunicator on the project's ASGI application,
+    authenticated by a real session cookie, so a run goes through the same
+    middleware, routing and consumers as production traffic. Latencies are
+    recorded per endpoint, queries are attributed to the endpoint that ran them
+    through consumers.current_endpoint.
+"""
+import time
+import random
+import asyncio
+import threading
+from importlib import import_module
+from collections import defaultdict, Counter
+from contextlib import contextmanager
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY, BACKEND_SESSION_KEY, HASH_SESSION_KEY
+from django.db import connections
+from django.db.backends.signals import connection_created
+from ws_api.consumers import current_endpoint
+from ._bench import friend_of, percentile
+
+REPLIES = {'Response', 'messages', 'messages_page', 'messages_sent', 'friend_requests', 'conversations',
+           'sync', 'users'}
+
+# Requests made outside of an endpoint, the handshake and session checks.
+OTHER = '(other)'
+
+
+class Stats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.queries = Counter()
+        self.errors = Counter()
+        self.started = time.perf_counter()
+        self.elapsed = None
+
+    def record(self, name, seconds):
+        self.latencies[name].append(seconds)
+
+    def count_query(self):
+        endpoint = current_endpoint.get() or OTHER
+        with self.lock:
+            self.queries[endpoint] += 1
+
+    def stop(self):
+        self.elapsed = time.perf_counter() - self.started
+
+    def summary(self):
+        """Maps each endpoint to its request count, rate, latency percentiles and queries per request."""
+        rows = {}
+        for name, latencies in sorted(self.latencies.items()):
+            rows[name] = {
+                'count': len(latencies),
+                'rate': len(latencies) / self.elapsed,
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'queries': self.queries[name] / len(latencies) if name in self.queries else None,
+                'errors': self.errors[name]
+            }
+        if self.queries[OTHER]:
+            rows.setdefault(OTHER, {'count': None, 'rate': None, 'p50': None, 'p95': None, 'p99': None,
+                                    'errors': 0})
+            rows[OTHER]['queries'] = self.queries[OTHER]
+        return rows
+
+
+@contextmanager
+def counting_queries(count):
+    """Calls `count()` for every query run while active, on every thread's connection."""
+    wrapped = []
+
+    def wrapper(execute, sql, params, many, context):
+        count()
+        return execute(sql, params, many, context)
+
+    def install(connection, **kwargs):
+        if wrapper not in connection.execute_wrappers:
+            connection.execute_wrappers.append(wrapper)
+            wrapped.append(connection)
+
+    connection_created.connect(install, weak=False)
+    for connection in connections.all():
+        install(connection)
+    try:
+        yield
+    finally:
+        connection_created.disconnect(install)
+        for connection in wrapped:
+            connection.execute_wrappers.remove(wrapper)
+
+
+def create_session(user):
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    return f'{settings.SESSION_COOKIE_NAME}={session.session_key}'.encode()
+
+
+class Client:
+
+    def __init__(self, application, path, user, cookie, stats):
+        self.application = application
+        self.path = path
+        self.user = user
+        self.cookie = cookie
+        self.stats = stats
+        self.communicator = None
+        self.pushed = []
+        self.cursor = 0
+
+    async def connect(self):
+        started = time.perf_counter()
+        self.communicator = WebsocketCommunicator(self.application, self.path, headers=[(b'cookie', self.cookie)])
+        connected, _ = await self.communicator.connect(timeout=30)
+        assert connected, f'{self.user} could not connect.'
+        self.stats.record('connect', time.perf_counter() - started)
+
+    async def disconnect(self):
+        await self.communicator.disconnect()
+
+    async def request(self, endpoint, content, reply=None):
+        """
+            Sends a request and waits for its reply, `reply` names the reply's type unless it is a 'Response'.
+            A failed request is counted against the endpoint, the run goes on.
+        """
+        started = time.perf_counter()
+        await self.communicator.send_json_to({'endpoint': endpoint, 'content': content})
+        frame = await self.receive(reply or 'Response')
+        self.stats.record(endpoint, time.perf_counter() - started)
+        if is_error(frame):
+            self.stats.errors[endpoint] += 1
+        return frame
+
+    async def send(self, endpoint, content):
+        await self.communicator.send_json_to({'endpoint': endpoint, 'content': content})
+
+    async def receive(self, msg_type, timeout=30):
+        """Returns the next frame of `msg_type` or error Response, keeping the pushed events read on the way."""
+        for i, frame in enumerate(self.pushed):
+            if frame['type'] == msg_type:
+                return self.pushed.pop(i)
+        while True:
+            received = await self.communicator.receive_json_from(timeout=timeout)
+            found = None
+            for frame in received['content'] if received['type'] == 'batch' else [received]:
+                if found is None and (frame['type'] == msg_type or is_error(frame)):
+                    found = frame
+                else:
+                    self.take(frame)
+            if found is not None:
+                self.take_seq(found)
+                return found
+
+    def take(self, frame):
+        self.take_seq(frame)
+        if frame['type'] in ('received_message', 'received_messages'):
+            messages = frame['content'] if frame['type'] == 'received_messages' else [frame['content']]
+            for message in messages:
+                sent_at = message['content'].split(' ')[0]
+                self.stats.record('delivery', time.perf_counter() - float(sent_at))
+            return
+        if frame['type'] in ('messages_read', 'presence'):
+            return
+        if frame['type'] in REPLIES:
+            raise AssertionError(f'{self.user} got an unexpected reply: {frame}')
+        self.pushed.append(frame)
+
+    def take_seq(self, frame):
+        content = frame['content']
+        if isinstance(content, dict) and 'seq' in content:
+            self.cursor = max(self.cursor, content['seq'])
+        if isinstance(content, list):
+            self.cursor = max([self.cursor] + [item.get('seq', 0) for item in content if isinstance(item, dict)])
+
+
+def is_error(frame):
+    return frame['type'] == 'Response' and 'Error' in frame['content']
+
+
+def stamped(text):
+    return f'{time.perf_counter():.6f} {text}'
+
+
+async def chat(clients, users, rounds):
+    """Friends message each other in bursts, with some paging, a batched send and an inbox refresh."""
+
+    async def run(index, client):
+        friend = friend_of(index, users).username
+        rng = random.Random(index)
+        for i in range(rounds):
+            await client.request('send_message', {'friend': friend, 'content': stamped('chat')})
+            if rng.random() < 0.2:
+                await client.request('get_messages', {'friend': friend, 'limit': 50}, 'messages_page')
+        await client.request('send_messages', {'messages': [
+            {'friend': friend, 'content': stamped('batch'), 'client_id': f'{index}.{i}'} for i in range(10)
+        ]}, 'messages_sent')
+        await client.request('mark_read', {'friend': friend})
+        await client.request('get_conversations', {}, 'conversations')
+
+    await asyncio.gather(*(run(i, client) for i, client in enumerate(clients)))
+
+
+async def reconnect_storm(clients, users, rounds):
+    """Every client drops and reconnects at once, then catches up through sync and its inbox."""
+    for _ in range(rounds):
+        await asyncio.gather(*(client.disconnect() for client in clients))
+        await asyncio.gather(*(client.connect() for client in clients))
+
+        async def catch_up(client):
+            await client.request('sync', {'cursor': client.cursor}, 'sync')
+            await client.request('get_conversations', {}, 'conversations')
+
+        await asyncio.gather(*(catch_up(client) for client in clients))
+
+
+async def send_friend_request(client, other):
+    """
+        The request gets no reply unless it fails, so it is timed until `other` is pushed it.
+        Returns whether it went through.
+    """
+    started = time.perf_counter()
+    await client.send('send_friend_request', {'to_user': other.user.username})
+    pushed = asyncio.ensure_future(other.receive('new_friend_request'))
+    failed = asyncio.ensure_future(client.receive('Response'))
+    done, pending = await asyncio.wait({pushed, failed}, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    client.stats.record('send_friend_request', time.perf_counter() - started)
+    if failed in done:
+        client.stats.errors['send_friend_request'] += 1
+        return False
+    return True
+
+
+async def friend_churn(clients, users, rounds):
+    """
+        Pairs of strangers befriend, unfriend, then send and withdraw a request, `rounds` times.
+        A pair stops at its first failed step, their friendship is in an unknown state.
+    """
+
+    async def cycle(client, other):
+        if not await send_friend_request(client, other):
+            return False
+        accepted = {'from_user': client.user.username, 'accept': True}
+        if is_error(await other.request('respond_to_friend_request', accepted)):
+            return False
+        await client.receive('new_friend')
+        await other.receive('new_friend')
+        await client.request('get_friend_requests', {}, 'friend_requests')
+        if is_error(await client.request('remove_friend', {'friend': other.user.username})):
+            return False
+        await client.receive('removed_friend')
+        await other.receive('removed_friend')
+        if not await send_friend_request(client, other):
+            return False
+        return not is_error(await client.request('withdraw_friend_request', {'to_user': other.user.username}))
+
+    async def run(client, other):
+        for _ in range(rounds):
+            if not await cycle(client, other):
+                return
+
+    # Users 4k + 0/1 are friends with 4k + 1/0, so pairing them with 4k + 2/3 gives strangers.
+    pairs = [(clients[i], clients[i + 2]) for i in range(0, len(clients) - 3, 4) for i in (i, i + 1)]
+    await asyncio.gather(*(run(client, other) for client, other in pairs))
+
+
+WORKLOADS = {
+    'chat': chat,
+    'reconnect': reconnect_storm,
+    'churn': friend_churn,
+}
@@ -0,0 +1,55 @@
+import time
+import asyncio
+from django.core.management.base import BaseCommand
+from ws_api.consumers import APIConsumer, AsyncAPIConsumer
+from ._bench import test_database, create_users, create_history, friend_of, connect, receive_until, \
+    percentile, ms
+
+
+class Command(BaseCommand):
+    help = 'Compares APIConsumer and AsyncAPIConsumer: handshakes/sec, request throughput and latency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, nargs='+', default=[50, 200])
+        parser.add_argument('--rounds', type=int, default=3,
+                            help='Pipelined get_messages + send_message pairs per connection.')
+        parser.add_argument('--history', type=int, default=10,
+                            help='Messages each user has already sent.')
+
+    def handle(self, *args, **options):
+        with test_database():
+            users = create_users(max(options['connections']))
+            create_history(users, options['history'])
+            self.stdout.write(f"{'consumer':<18}{'conns':>7}{'handshakes/s':>14}{'req/s':>9}"
+                              f"{'send p50':>10}{'send p99':>10}{'get p99':>10}")
+            for consumer in (APIConsumer, AsyncAPIConsumer):
+                for count in options['connections']:
+                    result = asyncio.run(self.run(consumer, users[:count], options['rounds']))
+                    self.stdout.write(f"{consumer.__name__:<18}{count:>7}{result['handshakes']:>14.0f}"
+                                      f"{result['throughput']:>9.0f}{ms(percentile(result['send'], 50)):>10}"
+                                      f"{ms(percentile(result['send'], 99)):>10}"
+                                      f"{ms(percentile(result['get'], 99)):>10}")
+
+    async def run(self, consumer, users, rounds):
+        application = consumer.as_asgi()
+        start = time.perf_counter()
+        communicators = await asyncio.gather(*(connect(application, user) for user in users))
+        handshakes = len(users) / (time.perf_counter() - start)
+        send_latencies, get_latencies = [], []
+
+        async def client(index, communicator):
+            friend = friend_of(index, users).username
+            for _ in range(rounds):
+                sent_at = time.perf_counter()
+                await communicator.send_json_to({'endpoint': 'get_messages', 'content': {}})
+                await communicator.send_json_to({'endpoint': 'send_message',
+                                                 'content': {'friend': friend, 'content': 'bench'}})
+                arrived = await receive_until(communicator, {'messages', 'Response'})
+                get_latencies.append(arrived['messages'] - sent_at)
+                send_latencies.append(arrived['Response'] - sent_at)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client(i, communicator) for i, communicator in enumerate(communicators)))
+        throughput = 2 * rounds * len(users) / (time.perf_counter() - start)
+        await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+        return {'handshakes': handshakes, 'throughput': throughput, 'send': send_latencies, 'get': get_latencies}
@@ -0,0 +1,61 @@
+import time
+import threading
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, connections, OperationalError
+from api.models import Message
+from ._bench import test_database, create_users
+
+
+class Command(BaseCommand):
+    help = 'Measures concurrent message write throughput on the configured database, ' \
+           'on SQLite both with and without SQLITE_PRAGMAS.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--seconds', type=float, default=5)
+
+    def handle(self, *args, **options):
+        modes = [('configured', settings.SQLITE_PRAGMAS)]
+        if connection.vendor == 'sqlite':
+            modes = [('sqlite default', {}), ('sqlite tuned', settings.SQLITE_PRAGMAS)]
+        self.stdout.write(f"{'mode':<16}{'threads':>8}{'writes/s':>10}{'locked':>8}")
+        pragmas = settings.SQLITE_PRAGMAS
+        try:
+            for name, mode_pragmas in modes:
+                settings.SQLITE_PRAGMAS = mode_pragmas
+                with test_database():
+                    writes, locked = self.run(options['threads'], options['seconds'])
+                self.stdout.write(f"{name:<16}{options['threads']:>8}{writes / options['seconds']:>10.0f}{locked:>8}")
+        finally:
+            settings.SQLITE_PRAGMAS = pragmas
+
+    def run(self, thread_count, seconds):
+        users = create_users(2 * thread_count)
+        connections.close_all()
+        counts = {'writes': 0, 'locked': 0}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + seconds
+
+        def writer(index):
+            sender, recipient = users[2 * index], users[2 * index + 1]
+            friendship = sender.friendships.get()
+            writes = locked = 0
+            while time.perf_counter() < deadline:
+                try:
+                    Message.objects.create(friendship=friendship, sender=sender, recipient=recipient,
+                                           content='load')
+                    writes += 1
+                except OperationalError:
+                    locked += 1
+            connection.close()
+            with lock:
+                counts['writes'] += writes
+                counts['locked'] += locked
+
+        threads = [threading.Thread(target=writer, args=(i,)) for i in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return counts['writes'], counts['locked']
@@ -0,0 +1,81 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from api.models import FriendRequest
+from ws_api import frames
+from ws_api.consumers import APIConsumer
+from ws_api.serializers import validate_frame
+from ._bench import test_database, create_users, create_history
+
+
+class BenchConsumer(APIConsumer):
+    """Serves frames straight through receive(), encoding the replies but sending them nowhere."""
+
+    def __init__(self, user):
+        super().__init__()
+        self.scope = {'user': user}
+        self.user = user
+
+    def send(self, text_data=None, bytes_data=None, close=False):
+        pass
+
+
+def bench_frames(users):
+    user, friend, stranger, requester, requested = (user.username for user in users[:5])
+    return {
+        'send_message': {'friend': friend, 'content': 'bench'},
+        'send_messages': {'messages': [{'friend': friend, 'content': 'bench', 'client_id': str(i)}
+                                       for i in range(10)]},
+        'send_friend_request': {'to_user': stranger},
+        'respond_to_friend_request': {'from_user': requester, 'accept': True},
+        'remove_friend': {'friend': friend},
+        'withdraw_friend_request': {'to_user': requested},
+        'get_messages': {'friend': friend, 'limit': 50},
+        'get_friend_requests': {},
+        'mark_read': {'friend': friend},
+        'get_conversations': {},
+        'sync': {'cursor': 0}
+    }
+
+
+class Command(BaseCommand):
+    help = 'Measures frames/s through APIConsumer.receive for every endpoint, and the share of ' \
+           'each frame spent decoding and validating it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--frames', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = options['frames']
+        codec = 'orjson' if frames.orjson else 'json'
+        with test_database():
+            users = create_users(6)
+            create_history(users[:2], 50)
+            FriendRequest.objects.create(from_user=users[3], to_user=users[0])
+            FriendRequest.objects.create(from_user=users[0], to_user=users[4])
+            consumer = BenchConsumer(users[0])
+            self.stdout.write(f'codec: {codec}, {count} frames per endpoint')
+            self.stdout.write(f"{'endpoint':<28}{'frames/s':>10}{'us/frame':>10}{'validate us':>13}")
+            for endpoint, content in bench_frames(users).items():
+                frame = frames.dumps({'endpoint': endpoint, 'content': content})
+                total = self.run(consumer, frame, count)
+                validate = self.run_validate(consumer, frame, count)
+                self.stdout.write(f'{endpoint:<28}{count / total:>10.0f}{total / count * 1e6:>10.0f}'
+                                  f'{validate / count * 1e6:>13.1f}')
+
+    def run(self, consumer, frame, count):
+        # Every frame is rolled back so each one finds the same friends and friend requests.
+        elapsed = 0.0
+        for _ in range(count):
+            with transaction.atomic():
+                started = time.perf_counter()
+                consumer.receive(frame)
+                elapsed += time.perf_counter() - started
+                transaction.set_rollback(True)
+        return elapsed
+
+    def run_validate(self, consumer, frame, count):
+        started = time.perf_counter()
+        for _ in range(count):
+            validate_frame(consumer.endpoints, consumer.decode_frame(frame), consumer)
+        return time.perf_counter() - started
@@ -0,0 +1,64 @@
+import time
+import asyncio
+from importlib import import_module
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from api.friends import get_friends
+from api.tokens import issue_token
+from messer_backend.asgi import application
+from ._bench import test_database, create_users, percentile, ms
+from ._load import counting_queries, create_session
+from .bench_load import PATHS
+
+
+class Command(BaseCommand):
+    help = 'Measures WebSocket handshakes per second of --sockets clients reconnecting --rounds times, ' \
+           'authenticated by session cookie and by connection token.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=200, help='Clients reconnecting concurrently.')
+        parser.add_argument('--rounds', type=int, default=5, help='Handshakes per client.')
+        parser.add_argument('--consumer', choices=sorted(PATHS), default='sync')
+
+    def handle(self, *args, **options):
+        with test_database():
+            users = create_users(options['sockets'], prefix='handshake')
+            cookies = [create_session(user) for user in users]
+            store = import_module(settings.SESSION_ENGINE).SessionStore
+            tokens = [issue_token(user, store(cookie.split(b'=', 1)[1].decode()))
+                      for user, cookie in zip(users, cookies)]
+            # Presence announcements read the friend lists, only handshakes should be counted.
+            for user in users:
+                get_friends(user.id)
+            path = PATHS[options['consumer']]
+            self.stdout.write(f"{options['sockets']} sockets, {options['rounds']} rounds, "
+                              f"{options['consumer']} consumer")
+            self.stdout.write(f"{'auth':<8}{'handshakes/s':>14}{'p50 ms':>9}{'p99 ms':>9}{'queries':>9}")
+            self.measure('cookie', [(path, [(b'cookie', cookie)]) for cookie in cookies], options)
+            self.measure('token', [(f'{path}?token={token}', []) for token in tokens], options)
+
+    def measure(self, auth, clients, options):
+        latencies, queries = [], [0]
+
+        def count():
+            queries[0] += 1
+
+        async def reconnect(path, headers):
+            for _ in range(options['rounds']):
+                started = time.perf_counter()
+                communicator = WebsocketCommunicator(application, path, headers=headers)
+                connected, _ = await communicator.connect(timeout=60)
+                assert connected, f'Handshake to {path} refused.'
+                latencies.append(time.perf_counter() - started)
+                await communicator.disconnect()
+
+        async def storm():
+            await asyncio.gather(*(reconnect(path, headers) for path, headers in clients))
+
+        started = time.perf_counter()
+        with counting_queries(count):
+            asyncio.run(storm())
+        seconds = time.perf_counter() - started
+        self.stdout.write(f"{auth:<8}{len(latencies) / seconds:>14.0f}{ms(percentile(latencies, 50)):>9}"
+                          f"{ms(percentile(latencies, 99)):>9}{queries[0] / len(latencies):>9.1f}")
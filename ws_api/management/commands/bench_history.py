@@ -0,0 +1,65 @@
+import time
+import tracemalloc
+from django.core.management.base import BaseCommand
+from api.models import Message
+from ws_api.consumers import APIConsumer
+from ._bench import test_database, create_users
+
+
+class MeasuringConsumer(APIConsumer):
+    """Encodes frames like a socket would, keeping only their count, total and largest size."""
+
+    def __init__(self, user):
+        super().__init__()
+        self.scope = {'user': user}
+        self.user = user
+        self.frames = 0
+        self.bytes = 0
+        self.largest = 0
+
+    def wrap_and_send(self, msg_type, content):
+        size = len(self.encode_frame(msg_type, content)['text_data'])
+        self.frames += 1
+        self.bytes += size
+        self.largest = max(self.largest, size)
+
+
+class Command(BaseCommand):
+    help = 'Measures peak memory and time of get_messages over --messages messages, streamed and buffered.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1_000_000)
+        parser.add_argument('--chunk-size', type=int, default=200)
+        parser.add_argument('--buffered', action='store_true',
+                            help='Also measures the single frame response, which holds the whole history.')
+
+    def handle(self, *args, **options):
+        with test_database():
+            user, friend = create_users(2, prefix='history')
+            friendship_id = user.friendships.values_list('id', flat=True).get()
+            started = time.perf_counter()
+            for i in range(0, options['messages'], 10000):
+                Message.objects.bulk_create([
+                    Message(friendship_id=friendship_id, sender=friend if j % 2 else user,
+                            recipient=user if j % 2 else friend, content=f'message {i + j} ' + 'x' * 80)
+                    for j in range(min(10000, options['messages'] - i))
+                ])
+            self.stdout.write(f"seeded {options['messages']} messages in {time.perf_counter() - started:.0f}s")
+            self.stdout.write(f"{'mode':<10}{'seconds':>9}{'peak MiB':>10}{'frames':>8}{'MiB sent':>10}"
+                              f"{'largest KiB':>13}")
+            self.measure('streamed', user, {'stream': True, 'chunk_size': options['chunk_size']})
+            if options['buffered']:
+                self.measure('buffered', user, {})
+
+    def measure(self, mode, user, content):
+        consumer = MeasuringConsumer(user)
+        tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            consumer.handle_request({'endpoint': 'get_messages', 'content': content})
+            seconds = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.stdout.write(f'{mode:<10}{seconds:>9.1f}{peak / 2 ** 20:>10.1f}{consumer.frames:>8}'
+                          f'{consumer.bytes / 2 ** 20:>10.1f}{consumer.largest / 1024:>13.1f}')
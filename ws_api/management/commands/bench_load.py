@@ -0,0 +1,97 @@
+import json
+import asyncio
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from messer_backend.asgi import application
+from ._bench import test_database, create_users, create_history, ms
+from ._load import WORKLOADS, Stats, Client, counting_queries, create_session
+
+PATHS = {
+    'sync': '/ws/ws-api/',
+    'async': '/ws/ws-api-async/',
+}
+
+
+class Command(BaseCommand):
+    help = 'Drives --users authenticated WebSocket clients through scripted workloads and reports, ' \
+           'per endpoint, throughput, latency percentiles and queries per request.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--consumer', choices=sorted(PATHS), default='sync')
+        parser.add_argument('--workloads', nargs='+', choices=list(WORKLOADS), default=list(WORKLOADS))
+        parser.add_argument('--rounds', type=int, default=5,
+                            help='Messages sent per client, reconnects or friend request cycles per pair.')
+        parser.add_argument('--history', type=int, default=20,
+                            help='Messages each user has already sent.')
+        parser.add_argument('--output', help='Writes the results as JSON, to serve as a later --baseline.')
+        parser.add_argument('--baseline', help='Fails on a regression against the results of an earlier run.')
+        parser.add_argument('--tolerance', type=float, default=1.5,
+                            help='How many times its baseline p99 an endpoint may take.')
+
+    def handle(self, *args, **options):
+        with test_database():
+            self.stdout.write(f"database: {connection.vendor}, {options['users']} users, "
+                              f"{options['consumer']} consumer")
+            users = create_users(options['users'] - options['users'] % 4, prefix='load')
+            create_history(users, options['history'])
+            cookies = [create_session(user) for user in users]
+            results = asyncio.run(self.run(users, cookies, options))
+        for workload, rows in results.items():
+            self.report(workload, rows)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(results, file, indent=2)
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                baseline = json.load(file)
+            regressions = list(self.compare(baseline, results, options['tolerance']))
+            for regression in regressions:
+                self.stderr.write(regression)
+            if regressions:
+                raise CommandError(f'{len(regressions)} regressions against {options["baseline"]}.')
+
+    async def run(self, users, cookies, options):
+        path = PATHS[options['consumer']]
+        results = {}
+        stats = Stats()
+        with counting_queries(lambda: stats.count_query()):
+            clients = [Client(application, path, user, cookie, stats) for user, cookie in zip(users, cookies)]
+            await asyncio.gather(*(client.connect() for client in clients))
+            stats.stop()
+            results['connect'] = stats.summary()
+            for workload in options['workloads']:
+                stats = Stats()
+                for client in clients:
+                    client.stats = stats
+                await WORKLOADS[workload](clients, users, options['rounds'])
+                stats.stop()
+                results[workload] = stats.summary()
+            await asyncio.gather(*(client.disconnect() for client in clients))
+        return results
+
+    def report(self, workload, rows):
+        self.stdout.write(f"\n{workload:<28}{'count':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+                          f"{'queries':>9}{'errors':>8}")
+        for name, row in rows.items():
+            queries = '' if row['queries'] is None else f"{row['queries']:.1f}"
+            if row['count'] is None:
+                self.stdout.write(f"  {name:<26}{'':>44}{queries:>9}")
+                continue
+            self.stdout.write(f"  {name:<26}{row['count']:>8}{row['rate']:>9.0f}{ms(row['p50']):>9}"
+                              f"{ms(row['p95']):>9}{ms(row['p99']):>9}{queries:>9}{row['errors']:>8}")
+
+    def compare(self, baseline, results, tolerance):
+        for workload, rows in results.items():
+            for name, row in rows.items():
+                before = baseline.get(workload, {}).get(name)
+                if before is None or row['count'] is None:
+                    continue
+                if before['queries'] is not None and row['queries'] is not None \
+                        and row['queries'] > before['queries'] + 1e-6:
+                    yield f"{workload} {name}: {row['queries']:.2f} queries per request, " \
+                          f"was {before['queries']:.2f}"
+                if row['errors'] > before['errors']:
+                    yield f"{workload} {name}: {row['errors']} errors, was {before['errors']}"
+                if row['p99'] > before['p99'] * tolerance:
+                    yield f"{workload} {name}: p99 {ms(row['p99'])} ms, was {ms(before['p99'])} ms"
@@ -0,0 +1,79 @@
+import time
+import logging
+import threading
+from collections import Counter
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+from api.models import DefaultUser
+from api import hashing
+from ._bench import test_database, percentile, ms
+
+
+class Command(BaseCommand):
+    help = 'Measures GetFriends latency while --flood clients log in at --rate per second, ' \
+           'hashing inline and on the pool.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--flood', type=int, default=32, help='Concurrent login clients.')
+        parser.add_argument('--rate', type=float, default=100, help='Logins per second offered by the flood.')
+        parser.add_argument('--ips', type=int, default=None,
+                            help='Addresses the flood comes from, one per client by default.')
+        parser.add_argument('--seconds', type=float, default=5)
+        parser.add_argument('--workers', type=int, default=2, help='Hashing processes of the pool phase.')
+
+    def handle(self, *args, **options):
+        with test_database():
+            password = make_password('password')
+            users = DefaultUser.objects.bulk_create([
+                DefaultUser(username=f'login{i}', email=f'login{i}@bench.local', password=password)
+                for i in range(options['flood'] + 1)
+            ])
+            # Every 429 and 503 of the flood would be logged.
+            logging.getLogger('django.request').disabled = True
+            self.stdout.write(f"{'phase':<10}{'probe/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+                              f"{'logins/s':>10}{'200':>6}{'429':>6}{'503':>6}")
+            self.run('idle', users, 0, options, workers=options['workers'])
+            self.run('inline', users, options['flood'], options, workers=0)
+            with override_settings(PASSWORD_HASHING_WORKERS=options['workers']):
+                # Starts the pool's processes before the phase is timed.
+                hashing.hash_password('password')
+            self.run('pool', users, options['flood'], options, workers=options['workers'])
+
+    def run(self, phase, users, flood, options, workers):
+        cache.clear()
+        stop = threading.Event()
+        latencies, outcomes = [], Counter()
+        ips = options['ips'] or flood
+
+        def probe():
+            client = Client()
+            client.force_login(users[-1])
+            while not stop.is_set():
+                started = time.perf_counter()
+                client.post('/api/get-friends/')
+                latencies.append(time.perf_counter() - started)
+
+        def login(index):
+            client = Client(REMOTE_ADDR=f'10.0.{index % ips // 256}.{index % ips % 256}')
+            interval = flood / options['rate']
+            due = time.perf_counter() + index * interval / flood
+            while not stop.wait(max(0.0, due - time.perf_counter())):
+                due += interval
+                response = client.post('/api/login/', {'username': users[index].username, 'password': 'password'})
+                outcomes[response.status_code] += 1
+
+        with override_settings(PASSWORD_HASHING_WORKERS=workers, ALLOWED_HOSTS=['testserver']):
+            threads = [threading.Thread(target=login, args=(i,)) for i in range(flood)]
+            threads.append(threading.Thread(target=probe))
+            for thread in threads:
+                thread.start()
+            time.sleep(options['seconds'])
+            stop.set()
+            for thread in threads:
+                thread.join()
+        seconds = options['seconds']
+        self.stdout.write(f"{phase:<10}{len(latencies) / seconds:>9.0f}{ms(percentile(latencies, 50)):>9}"
+                          f"{ms(percentile(latencies, 99)):>9}{ms(max(latencies)):>9}"
+                          f"{outcomes[200] / seconds:>10.1f}{outcomes[200]:>6}{outcomes[429]:>6}{outcomes[503]:>6}")
@@ -0,0 +1,76 @@
+import time
+import random
+from django.core.management.base import BaseCommand
+from django.db.models.functions import Lower
+from api.models import DefaultUser, Friendship
+from api.search import search_usernames, search_queryset
+from ._bench import test_database, percentile, ms
+
+SYLLABLES = ['an', 'be', 'ca', 'da', 'el', 'fi', 'go', 'ha', 'is', 'jo', 'ka', 'li', 'ma', 'ne', 'ol',
+             'pa', 'qu', 'ri', 'sa', 'to', 'ul', 'vi', 'wa', 'xe', 'yo', 'za']
+
+
+def usernames(count, seed):
+    rng = random.Random(seed)
+    names = set()
+    while len(names) < count:
+        name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        if rng.random() < 0.5:
+            name += str(rng.randint(0, 9999))
+        if rng.random() < 0.3:
+            name = name.capitalize()
+        names.add(name)
+    names = sorted(names)
+    rng.shuffle(names)
+    return names
+
+
+class Command(BaseCommand):
+    help = 'Measures search_users latency against a test database seeded with --users users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1_000_000)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--friends', type=int, default=200)
+
+    def handle(self, *args, **options):
+        with test_database():
+            started = time.perf_counter()
+            names = self.seed(options['users'], options['friends'])
+            self.stdout.write(f"seeded {options['users']} users in {time.perf_counter() - started:.0f}s")
+            searcher = DefaultUser.objects.get(username=names[0])
+            rng = random.Random(1)
+            plan = search_queryset(searcher.id, 'ab')[:10].explain()
+            self.stdout.write(f'plan: {plan}')
+            self.stdout.write(f"{'query':<18}{'p50 ms':>8}{'p99 ms':>8}{'results':>9}")
+            for length in (1, 2, 3, 5, None):
+                queries = [name[:length] for name in rng.sample(names, options['queries'])]
+                self.report(f'prefix {length}' if length else 'full name', queries,
+                            lambda query: search_usernames(searcher.id, query, 10))
+            queries = [name[:3] for name in rng.sample(names, 20)]
+            self.report('istartswith 3', queries, lambda query: list(
+                DefaultUser.objects.filter(username__istartswith=query).order_by(Lower('username'))
+                .values_list('username', flat=True)[:10]
+            ))
+
+    def seed(self, count, friends):
+        names = usernames(count, seed=0)
+        for i in range(0, count, 10000):
+            DefaultUser.objects.bulk_create([
+                DefaultUser(username=name, email=f'user{i + j}@bench.local')
+                for j, name in enumerate(names[i:i + 10000])
+            ])
+        users = list(DefaultUser.objects.filter(username__in=names[:friends + 1]).order_by('id'))
+        Friendship.objects.bulk_create([
+            Friendship(**Friendship.canonical(users[0].id, friend.id)) for friend in users[1:]
+        ])
+        return names
+
+    def report(self, name, queries, search):
+        timings, results = [], 0
+        for query in queries:
+            started = time.perf_counter()
+            results += len(search(query))
+            timings.append(time.perf_counter() - started)
+        self.stdout.write(f'{name:<18}{ms(percentile(timings, 50)):>8}{ms(percentile(timings, 99)):>8}'
+                          f'{results / len(queries):>9.1f}')
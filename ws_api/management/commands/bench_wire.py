@@ -0,0 +1,98 @@
+import json
+import time
+from django.core.management.base import BaseCommand
+from api.models import DefaultUser, Friendship
+from ws_api import frames
+from ._bench import test_database, create_users, create_history
+from .bench_dispatch import BenchConsumer
+
+
+class RawMessagePackCodec(frames.MessagePackCodec):
+    """MessagePack with the full key names, to tell the share of the field codes."""
+
+    def encode(self, data):
+        return {'bytes_data': frames.PLAIN + frames.msgpack.packb(data)}
+
+    def decode(self, bytes_data):
+        return frames.msgpack.unpackb(bytes_data[1:])
+
+
+class StdlibJSONCodec(frames.JSONCodec):
+
+    def encode(self, data):
+        return {'text_data': json.dumps(data)}
+
+    def decode(self, text_data):
+        return json.loads(text_data)
+
+
+class CapturingConsumer(BenchConsumer):
+
+    def wrap_and_send(self, msg_type, content):
+        self.frame = {'type': msg_type, 'content': content}
+
+
+def capture(consumer, endpoint, content):
+    consumer.handle_request({'endpoint': endpoint, 'content': content})
+    return consumer.frame
+
+
+class Command(BaseCommand):
+    help = 'Compares the size and encode/decode time of frames in the JSON and MessagePack wire formats.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=200)
+
+    def handle(self, *args, **options):
+        if frames.msgpack is None:
+            self.stderr.write('msgpack is not installed.')
+            return
+        codecs = [('json', StdlibJSONCodec())]
+        if frames.orjson is not None:
+            codecs.append(('orjson', frames.JSONCodec()))
+        codecs += [
+            ('msgpack', RawMessagePackCodec(None)),
+            ('msgpack+codes', frames.MessagePackCodec(frames.SUBPROTOCOL_MSGPACK)),
+            ('msgpack+deflate', frames.MessagePackCodec(frames.SUBPROTOCOL_MSGPACK_DEFLATE, deflate_threshold=1024))
+        ]
+        with test_database():
+            payloads = self.payloads()
+        self.stdout.write(f"{'frame':<22}{'codec':<17}{'bytes':>8}{'ratio':>7}{'encode us':>11}{'decode us':>11}")
+        for name, data in payloads:
+            baseline = None
+            for codec_name, codec in codecs:
+                size, encode, decode = self.measure(codec, data, options['repeat'])
+                baseline = baseline or size
+                self.stdout.write(f'{name:<22}{codec_name:<17}{size:>8}{size / baseline:>7.2f}'
+                                  f'{encode * 1e6:>11.1f}{decode * 1e6:>11.1f}')
+
+    def payloads(self):
+        users = create_users(2)
+        create_history(users, 200)
+        friends = DefaultUser.objects.bulk_create([
+            DefaultUser(username=f'friend{i}', email=f'friend{i}@bench.local') for i in range(50)
+        ])
+        for friend in friends:
+            Friendship.objects.create(**Friendship.canonical(users[0].id, friend.id))
+        consumer = CapturingConsumer(users[0])
+        page = capture(consumer, 'get_messages', {'friend': users[1].username, 'limit': 200})
+        return [
+            ('received_message', {'type': 'received_message', 'content': page['content']['messages'][0]}),
+            ('messages_page 50', capture(consumer, 'get_messages', {'friend': users[1].username, 'limit': 50})),
+            ('messages_page 200', page),
+            ('messages (all)', capture(consumer, 'get_messages', {})),
+            ('conversations 51', capture(consumer, 'get_conversations', {})),
+        ]
+
+    def measure(self, codec, data, repeat):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            encoded = codec.encode(data)
+        encode = (time.perf_counter() - started) / repeat
+        frame = encoded.get('text_data') or encoded.get('bytes_data')
+        started = time.perf_counter()
+        for _ in range(repeat):
+            codec.decode(frame)
+        decode = (time.perf_counter() - started) / repeat
+        size = len(frame.encode()) if isinstance(frame, str) else len(frame)
+        return size, encode, decode
@@ -0,0 +1,118 @@
+"""
+    Per-connection queue of the events pushed to a socket.
+
+    Events arriving within settings.WS_API_COALESCE_WINDOW seconds of each other
+    leave as one frame, {type: 'batch', content: [<frame>, ...]}; a lone event is
+    sent as a plain frame. While a send is in progress new events keep queueing and
+    go out together with the next frame, so a slow client gets fewer, larger frames.
+
+    At most settings.WS_API_OUTBOX_HIGH_WATER events wait per socket. Past that,
+    WS_API_OUTBOX_OVERFLOW decides: 'drop' discards new events and later sends a
+    'dropped' frame with their count, the client catches up through the sync
+    endpoint; 'disconnect' closes the socket.
+"""
+import asyncio
+import logging
+from collections import deque
+from django.conf import settings
+from api import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxStats:
+    """Process wide outbox counters, the queue depth is summed over all sockets."""
+
+    def __init__(self):
+        self.depth = 0
+        self.max_depth = 0
+        self.frames = 0
+        self.batches = 0
+        self.dropped = 0
+        self.disconnects = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+    def collect(self):
+        yield from metrics.family('messer_outbox_depth', 'gauge', 'Events waiting in outboxes.',
+                                  [('', (), (), self.depth)])
+        yield from metrics.family('messer_outbox_max_depth', 'gauge', 'Most events ever waiting in outboxes.',
+                                  [('', (), (), self.max_depth)])
+        for name, help_text in (('frames', 'Frames sent from outboxes.'), ('batches', 'Batch frames sent.'),
+                                ('dropped', 'Events dropped by full outboxes.'),
+                                ('disconnects', 'Sockets closed by full outboxes.')):
+            yield from metrics.family(f'messer_outbox_{name}_total', 'counter', help_text,
+                                      [('', (), (), getattr(self, name))])
+
+
+stats = OutboxStats()
+metrics.registry.register(stats.collect)
+
+
+class Outbox:
+
+    def __init__(self, send, close, window=None, high_water=None, overflow=None):
+        """`send(msg_type, content)` and `close()` are coroutines writing to the socket."""
+        self.send = send
+        self.close = close
+        self.window = settings.WS_API_COALESCE_WINDOW if window is None else window
+        self.high_water = settings.WS_API_OUTBOX_HIGH_WATER if high_water is None else high_water
+        self.overflow = settings.WS_API_OUTBOX_OVERFLOW if overflow is None else overflow
+        self.queue = deque()
+        self.dropped = 0
+        self.closed = False
+        self.flusher = None
+
+    @property
+    def depth(self):
+        return len(self.queue)
+
+    async def put(self, msg_type, content):
+        if self.closed:
+            return
+        if len(self.queue) >= self.high_water:
+            await self.overflowed()
+            return
+        self.queue.append({'type': msg_type, 'content': content})
+        stats.depth += 1
+        stats.max_depth = max(stats.max_depth, stats.depth)
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.flush())
+
+    async def overflowed(self):
+        if self.overflow == 'disconnect':
+            logger.warning('Outbox over %d events, disconnecting.', self.high_water)
+            stats.disconnects += 1
+            await self.stop()
+            await self.close()
+            return
+        self.dropped += 1
+        stats.dropped += 1
+
+    async def flush(self):
+        try:
+            await asyncio.sleep(self.window)
+            while self.queue or self.dropped:
+                frames = list(self.queue)
+                self.queue.clear()
+                stats.depth -= len(frames)
+                if self.dropped:
+                    frames.append({'type': 'dropped', 'content': {'count': self.dropped}})
+                    self.dropped = 0
+                stats.frames += 1
+                if len(frames) == 1:
+                    await self.send(frames[0]['type'], frames[0]['content'])
+                    continue
+                stats.batches += 1
+                await self.send('batch', frames)
+        finally:
+            self.flusher = None
+
+    async def stop(self):
+        """Discards the queue and stops the flusher once the socket is going away."""
+        self.closed = True
+        if self.flusher is not None:
+            self.flusher.cancel()
+        stats.depth -= len(self.queue)
+        self.queue.clear()
@@ -0,0 +1,248 @@
+"""
+    Who is online, kept in memory.
+
+    Each process counts the open sockets of every user in `registry`, and shares its
+    counts over the channel layer: it joins the 'presence' group with a channel of its
+    own, sends the counts that changed once per settings.WS_API_PRESENCE_INTERVAL and
+    all of them every settings.WS_API_PRESENCE_HEARTBEAT seconds. A process unheard of
+    for three heartbeats is forgotten along with its sockets. A user is online while
+    any process holds one of their sockets.
+
+    Transitions are debounced. A user disconnected for less than
+    settings.WS_API_PRESENCE_GRACE seconds never appears offline, and a socket opened
+    and closed within one interval is never announced. The process that saw a
+    transition announces it once per interval, as one {type: 'presence', content:
+    {users: [...]}} event per friend listing every change among that friend's friends.
+    Announcements are states, not toggles: a user moving between processes may be
+    announced online twice. Presence is not logged for sync, clients ask get_presence.
+"""
+import time
+import uuid
+import asyncio
+import logging
+import threading
+from contextvars import Context
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from api.friends import get_friends
+from api.serializers import MessageRowSerializer
+from .dispatch import user_group
+
+logger = logging.getLogger(__name__)
+
+GROUP = 'presence'
+
+
+def format_time(timestamp):
+    if timestamp is None:
+        return None
+    return MessageRowSerializer.datetime_field.to_representation(datetime.fromtimestamp(timestamp, timezone.utc))
+
+
+def friends_of(user_ids):
+    return {user_id: [friend_id for friend_id, _ in get_friends(user_id).values()] for user_id in user_ids}
+
+
+class Presence:
+
+    def __init__(self, interval=None, grace=None, heartbeat=None):
+        self.node = uuid.uuid4().hex
+        self._interval = interval
+        self._grace = grace
+        self._heartbeat = heartbeat
+        self.lock = threading.Lock()
+        # Sockets per user in this process, and (heard at, sockets per user) per other process.
+        self.local = Counter()
+        self.remote = {}
+        # When the last socket of a user closed, on any process.
+        self.last_seen = {}
+        # Users with a transition in this process, not yet announced, and their usernames.
+        self.pending = set()
+        self.usernames = {}
+        # Users this process last announced online.
+        self.announced = set()
+        # Users whose count in this process changed since it was last shared.
+        self.changed = set()
+        self.shared_at = float('-inf')
+        self.snapshot_due = True
+        self.loop = None
+        self.tasks = []
+        self.channel = None
+
+    @property
+    def interval(self):
+        return settings.WS_API_PRESENCE_INTERVAL if self._interval is None else self._interval
+
+    @property
+    def grace(self):
+        return settings.WS_API_PRESENCE_GRACE if self._grace is None else self._grace
+
+    @property
+    def heartbeat(self):
+        return settings.WS_API_PRESENCE_HEARTBEAT if self._heartbeat is None else self._heartbeat
+
+    def connected(self, user_id, username):
+        with self.lock:
+            self.local[user_id] += 1
+            self.usernames[user_id] = username
+            self.pending.add(user_id)
+            self.changed.add(user_id)
+
+    def disconnected(self, user_id, now=None):
+        with self.lock:
+            self.local[user_id] -= 1
+            if self.local[user_id] <= 0:
+                del self.local[user_id]
+                self.last_seen[user_id] = time.time() if now is None else now
+            self.pending.add(user_id)
+            self.changed.add(user_id)
+
+    def count(self, user_id):
+        return self.local.get(user_id, 0) + sum(users.get(user_id, 0) for _, users in self.remote.values())
+
+    def describe(self, username, user_id, now=None):
+        """
+            The presence entry of a user: online, or when their last socket closed if known.
+            Like announcements, a user disconnected for less than the grace period is online.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            last_seen = self.last_seen.get(user_id)
+            online = self.count(user_id) > 0 or (last_seen is not None and now - last_seen < self.grace)
+        return {'user': username, 'online': online, 'last_seen': None if online else format_time(last_seen)}
+
+    # ROUNDS
+
+    async def tick(self, now=None):
+        """Shares the changed counts, then announces the transitions that are due."""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.expire(now)
+            changes = self.due_changes(now)
+            update = self.update(now)
+        if update is not None:
+            await get_channel_layer().group_send(GROUP, update)
+        if changes:
+            await self.announce(changes)
+
+    def expire(self, now):
+        for node, (heard_at, _) in list(self.remote.items()):
+            if now - heard_at > 3 * self.heartbeat:
+                del self.remote[node]
+
+    def due_changes(self, now):
+        changes = []
+        for user_id in list(self.pending):
+            online = self.count(user_id) > 0
+            if online != (user_id in self.announced):
+                if not online and now - self.last_seen.get(user_id, now) < self.grace:
+                    continue
+                changes.append({'id': user_id, 'user': self.usernames[user_id], 'online': online,
+                                'last_seen': None if online else self.last_seen.get(user_id)})
+                if online:
+                    self.announced.add(user_id)
+                else:
+                    self.announced.discard(user_id)
+            self.pending.discard(user_id)
+            if user_id not in self.local:
+                del self.usernames[user_id]
+        return changes
+
+    def update(self, now):
+        if self.channel is None:
+            self.changed.clear()
+            return None
+        full = self.snapshot_due or now - self.shared_at >= self.heartbeat
+        user_ids = self.local if full else self.changed
+        self.changed = set()
+        if not (full or user_ids):
+            return None
+        if full:
+            self.snapshot_due = False
+            self.shared_at = now
+        # Lists rather than maps, the Redis layer unpacks string keys only.
+        return {'type': 'presence.update', 'node': self.node, 'full': full,
+                'users': [[user_id, self.local.get(user_id, 0), self.last_seen.get(user_id)]
+                          for user_id in user_ids]}
+
+    def received(self, message, now=None):
+        if message['node'] == self.node:
+            return
+        with self.lock:
+            if message['type'] == 'presence.hello':
+                self.snapshot_due = True
+                return
+            _, users = self.remote.get(message['node'], (None, {}))
+            if message['full']:
+                users = {}
+            for user_id, count, last_seen in message['users']:
+                if count:
+                    users[user_id] = count
+                else:
+                    users.pop(user_id, None)
+                if last_seen is not None and last_seen > self.last_seen.get(user_id, last_seen - 1):
+                    self.last_seen[user_id] = last_seen
+            self.remote[message['node']] = (time.time() if now is None else now, users)
+
+    async def announce(self, changes):
+        try:
+            friends = await database_sync_to_async(friends_of)([change['id'] for change in changes])
+        except Exception:
+            logger.exception('Could not look up the friends of %d users changing presence.', len(changes))
+            return
+        batches = defaultdict(list)
+        for change in changes:
+            entry = {'user': change['user'], 'online': change['online'], 'last_seen': format_time(change['last_seen'])}
+            for friend_id in friends[change['id']]:
+                batches[friend_id].append(entry)
+        channel_layer = get_channel_layer()
+        for friend_id, users in batches.items():
+            await channel_layer.group_send(user_group(friend_id), {'type': 'presence_callback',
+                                                                    'content': {'users': users}})
+
+    # TASKS
+
+    async def ensure_running(self):
+        """Starts ticking and listening to other processes on the running loop, once per loop."""
+        loop = asyncio.get_running_loop()
+        if self.loop is loop:
+            return
+        self.loop = loop
+        # The loop only keeps weak references to its tasks.
+        self.tasks = [self.start(loop, self.run())]
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        if self.channel is not None:
+            await channel_layer.group_discard(GROUP, self.channel)
+        self.channel = await channel_layer.new_channel()
+        await channel_layer.group_add(GROUP, self.channel)
+        self.tasks.append(self.start(loop, self.listen(channel_layer, self.channel)))
+        await channel_layer.group_send(GROUP, {'type': 'presence.hello', 'node': self.node})
+
+    @staticmethod
+    def start(loop, coroutine):
+        # In a fresh context: the caller's may hold an async_to_sync executor that is gone once it returns.
+        return Context().run(loop.create_task, coroutine)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception('Presence round failed.')
+
+    async def listen(self, channel_layer, channel):
+        while True:
+            message = await channel_layer.receive(channel)
+            try:
+                self.received(message)
+            except Exception:
+                logger.exception('Invalid presence message.')
+
+
+registry = Presence()
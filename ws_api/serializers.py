@@ -1,5 +1,32 @@
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework import serializers
-from api.models import FriendRequest, DefaultUser
+from rest_framework.fields import SkipField
+from rest_framework.serializers import as_serializer_error
+from rest_framework.settings import api_settings
+from api.friends import get_friends
+
+
+class MessageCursorField(serializers.Field):
+    """
+        A position in a conversation, the (created_at, id) of a message encoded as '<created_at>_<id>'.
+    """
+    default_error_messages = {'invalid': 'Invalid cursor.'}
+
+    def to_internal_value(self, data):
+        try:
+            created_at, pk = str(data).rsplit('_', 1)
+            created_at, pk = parse_datetime(created_at), int(pk)
+        except ValueError:
+            self.fail('invalid')
+        # Clients build cursors from the created_at of pushed messages, which end in 'Z'.
+        if created_at is None or timezone.is_naive(created_at):
+            self.fail('invalid')
+        return created_at, pk
+
+    def to_representation(self, value):
+        created_at, pk = value
+        return f'{created_at.isoformat()}_{pk}'
 
 
 class ConsumerSpecificSerializer(serializers.Serializer):
@@ -10,22 +37,63 @@ class ConsumerSpecificSerializer(serializers.Serializer):
         self.consumer = self.context['consumer']
 
 
-class EndpointInSerializer(ConsumerSpecificSerializer):
-    endpoint = serializers.ChoiceField(choices=[])
-    content = serializers.JSONField()
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.fields['endpoint'].choices = self.consumer.endpoints.keys()
-
-    def validate(self, data):
-        endpoint = self.consumer.endpoints[data['endpoint']]
-        if not endpoint.serializer:
-            return {'endpoint': endpoint, 'content': None}
-        endpoint_serializer = endpoint.serializer(data=data['content'], context={'consumer': self.consumer})
-        if not endpoint_serializer.is_valid():
-            raise serializers.ValidationError(endpoint_serializer.errors)
-        return {'endpoint': endpoint, 'content': endpoint_serializer}
+class EndpointSchema:
+    """
+        Validates the content of a frame with the fields of an endpoint serializer. The
+        fields are bound once per serializer class, a frame only builds the serializer
+        for its validate() hook. Errors have the same shape as serializer.errors.
+    """
+
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+        self.fields = list(serializer_class(context={'consumer': None}).fields.values())
+
+    def validate(self, content, consumer):
+        if not isinstance(content, dict):
+            raise serializers.ValidationError({api_settings.NON_FIELD_ERRORS_KEY: [
+                f'Invalid data. Expected a dictionary, but got {type(content).__name__}.'
+            ]})
+        data, errors = {}, {}
+        for field in self.fields:
+            try:
+                data[field.field_name] = field.run_validation(field.get_value(content))
+            except serializers.ValidationError as exc:
+                errors[field.field_name] = exc.detail
+            except SkipField:
+                pass
+        if errors:
+            raise serializers.ValidationError(errors)
+        try:
+            return self.serializer_class(context={'consumer': consumer}).validate(data)
+        except serializers.ValidationError as exc:
+            raise serializers.ValidationError(as_serializer_error(exc))
+
+
+def validate_frame(endpoints, msg, consumer):
+    """
+        Checks the {endpoint, content} envelope of a frame without a serializer and returns
+        the endpoint with its validated arguments. Raises ValidationError.
+    """
+    if not isinstance(msg, dict):
+        raise serializers.ValidationError({api_settings.NON_FIELD_ERRORS_KEY: [
+            f'Invalid data. Expected a dictionary, but got {type(msg).__name__}.'
+        ]})
+    errors = {}
+    name = msg.get('endpoint')
+    endpoint = endpoints.get(name) if isinstance(name, str) else None
+    if 'endpoint' not in msg:
+        errors['endpoint'] = ['This field is required.']
+    elif name is None:
+        errors['endpoint'] = ['This field may not be null.']
+    elif endpoint is None:
+        errors['endpoint'] = [f'"{name}" is not a valid choice.']
+    if 'content' not in msg:
+        errors['content'] = ['This field is required.']
+    if errors:
+        raise serializers.ValidationError(errors)
+    if endpoint.schema is None:
+        return endpoint, {}
+    return endpoint, endpoint.schema.validate(msg['content'], consumer)
 
 
 class SendMessageSerializer(ConsumerSpecificSerializer):
@@ -33,64 +101,118 @@ class SendMessageSerializer(ConsumerSpecificSerializer):
     content = serializers.CharField()
 
     def validate(self, data):
-        friendship_queryset = self.consumer.user.friendships.filter(friend__username=data['friend'])
-        if not friendship_queryset.exists():
+        friends = get_friends(self.consumer.user.id)
+        if data['friend'] not in friends:
             raise serializers.ValidationError("That user is not in your friend list.", code='Forbidden')
-        return {'friendship': friendship_queryset.first(), 'content': data['content']}
+        recipient_id, friendship_id = friends[data['friend']]
+        return {'friendship_id': friendship_id, 'recipient_id': recipient_id, 'content': data['content']}
 
 
-class SendFriendRequestSerializer(ConsumerSpecificSerializer):
-    to_user = serializers.CharField()
+class OutgoingMessageSerializer(serializers.Serializer):
+    friend = serializers.CharField()
+    content = serializers.CharField(max_length=200)
+    client_id = serializers.CharField(max_length=64)
+
+
+class SendMessagesSerializer(ConsumerSpecificSerializer):
+    messages = serializers.ListField(child=OutgoingMessageSerializer(), allow_empty=False, max_length=100)
 
     def validate(self, data):
-        to_user = data['to_user']
-        to_user_queryset = DefaultUser.objects.filter(username=to_user)
-        if not to_user_queryset.exists():
-            raise serializers.ValidationError('That user does not exists.', code='Not Found')
-        friend_request = FriendRequest(from_user=self.consumer.user, to_user=to_user_queryset.first())
-        return {'friend_request': friend_request}
+        messages = data['messages']
+        if len({message['client_id'] for message in messages}) != len(messages):
+            raise serializers.ValidationError('Every message needs a distinct client_id.')
+        friends = get_friends(self.consumer.user.id)
+        for message in messages:
+            if message['friend'] not in friends:
+                message['error'] = 'That user is not in your friend list.'
+                continue
+            message['recipient_id'], message['friendship_id'] = friends[message['friend']]
+        return {'messages': messages}
+
+
+class SendFriendRequestSerializer(ConsumerSpecificSerializer):
+    to_user = serializers.CharField()
 
 
 class RespondToFriendRequestSerializer(ConsumerSpecificSerializer):
     from_user = serializers.CharField()
     accept = serializers.BooleanField()
 
-    def validate(self, data):
-        from_user, accept = data['from_user'], data['accept']
-        friend_request_queryset = self.consumer.user.received_friend_requests.filter(from_user__username=from_user)
-        if not friend_request_queryset.exists():
-            raise serializers.ValidationError('You do not have any pending friend requests from that user.')
-        return {'friend_request': friend_request_queryset.first(), 'accept': accept}
-
 
 class RemoveFriendSerializer(ConsumerSpecificSerializer):
     friend = serializers.CharField()
 
-    def validate(self, data):
-        friend = data['friend']
-        friendship_queryset = self.consumer.user.friendships.filter(friend__username=friend)
-        if not friendship_queryset.exists():
-            raise serializers.ValidationError('You do not have a friend with that name.')
-        return {'friendship': friendship_queryset.first()}
-
 
 class WithdrawFriendRequestSerializer(ConsumerSpecificSerializer):
     to_user = serializers.CharField()
 
-    def validate(self, data):
-        to_user = data['to_user']
-        friend_request_queryset = self.consumer.user.sent_friend_requests.filter(to_user__username=to_user)
-        if not friend_request_queryset.exists():
-            raise serializers.ValidationError('You do not have a pending friend request sent to that user.')
-        return {'friend_request': friend_request_queryset.first()}
 
 class GetMessagesSerializer(ConsumerSpecificSerializer):
-    
+    friend = serializers.CharField(required=False)
+    before = MessageCursorField(required=False)
+    after = MessageCursorField(required=False)
+    limit = serializers.IntegerField(required=False, min_value=1, max_value=200, default=50)
+    stream = serializers.BooleanField(default=False)
+    chunk_size = serializers.IntegerField(min_value=1, max_value=1000, default=200)
+
+    def validate(self, data):
+        if 'friend' not in data:
+            # The whole history, a friend's conversation is already paged.
+            return {'stream': data['stream'], 'chunk_size': data['chunk_size']}
+        if 'before' in data and 'after' in data:
+            raise serializers.ValidationError('Use either before or after, not both.')
+        friends = get_friends(self.consumer.user.id)
+        if data['friend'] not in friends:
+            raise serializers.ValidationError('That user is not in your friend list.', code='Forbidden')
+        _, friendship_id = friends[data['friend']]
+        return {'friend': data['friend'], 'friendship_id': friendship_id, 'before': data.get('before'),
+                'after': data.get('after'), 'limit': data['limit']}
+
+
+class MarkReadSerializer(ConsumerSpecificSerializer):
+    friend = serializers.CharField()
+    up_to = MessageCursorField(required=False)
+
+    def validate(self, data):
+        friends = get_friends(self.consumer.user.id)
+        if data['friend'] not in friends:
+            raise serializers.ValidationError('That user is not in your friend list.', code='Forbidden')
+        friend_id, friendship_id = friends[data['friend']]
+        return {'friend_id': friend_id, 'friendship_id': friendship_id, 'up_to': data.get('up_to')}
+
+
+class SearchUsersSerializer(ConsumerSpecificSerializer):
+    query = serializers.CharField(max_length=150)
+    limit = serializers.IntegerField(min_value=1, max_value=50, default=10)
+
+    def validate(self, data):
+        return data
+
+
+class SyncSerializer(ConsumerSpecificSerializer):
+    cursor = serializers.IntegerField(min_value=0, default=0)
+    limit = serializers.IntegerField(min_value=1, max_value=1000, default=500)
+
+    def validate(self, data):
+        return data
+
+
+class GetConversationsSerializer(ConsumerSpecificSerializer):
+
     def validate(self, data):
         return {}
 
-class GetFriendRequestsSerializer(ConsumerSpecificSerializer):
+
+class GetPresenceSerializer(ConsumerSpecificSerializer):
 
     def validate(self, data):
         return {}
+
+
+class GetFriendRequestsSerializer(ConsumerSpecificSerializer):
+    stream = serializers.BooleanField(default=False)
+    chunk_size = serializers.IntegerField(min_value=1, max_value=1000, default=200)
+
+    def validate(self, data):
+        return {'stream': data['stream'], 'chunk_size': data['chunk_size']}
         
\ No newline at end of file
@@ -0,0 +1,142 @@
+"""
+    Test support for running the websocket API across several processes.
+
+    SharedProcessChannelLayer is a stand-in for the Redis channel layer: its channels and
+    groups live in a multiprocessing manager, so every process connected to the manager
+    sees the same layer. Not for production use.
+"""
+import os
+import uuid
+import asyncio
+import threading
+from contextlib import contextmanager
+from multiprocessing.managers import BaseManager
+from channels.layers import BaseChannelLayer
+
+
+class LayerState:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.groups = {}
+
+    def send(self, channel, message):
+        with self.lock:
+            self.channels.setdefault(channel, []).append(message)
+
+    def receive(self, channel):
+        with self.lock:
+            messages = self.channels.get(channel)
+            return messages.pop(0) if messages else None
+
+    def group_add(self, group, channel):
+        with self.lock:
+            self.groups.setdefault(group, set()).add(channel)
+
+    def group_discard(self, group, channel):
+        with self.lock:
+            self.groups.get(group, set()).discard(channel)
+
+    def group_send(self, group, message):
+        with self.lock:
+            for channel in self.groups.get(group, ()):
+                self.channels.setdefault(channel, []).append(message)
+
+
+_layer_state = LayerState()
+
+
+def get_layer_state():
+    return _layer_state
+
+
+class LayerStateManager(BaseManager):
+    pass
+
+
+LayerStateManager.register('state', callable=get_layer_state)
+
+
+class SharedProcessChannelLayer(BaseChannelLayer):
+    extensions = ['groups']
+
+    def __init__(self, address, authkey, poll_interval=0.01, **kwargs):
+        super().__init__(**kwargs)
+        manager = LayerStateManager(address=tuple(address), authkey=authkey.encode())
+        manager.connect()
+        self.state = manager.state()
+        self.poll_interval = poll_interval
+
+    async def send(self, channel, message):
+        await asyncio.to_thread(self.state.send, channel, message)
+
+    async def receive(self, channel):
+        while True:
+            message = await asyncio.to_thread(self.state.receive, channel)
+            if message is not None:
+                return message
+            await asyncio.sleep(self.poll_interval)
+
+    async def new_channel(self, prefix='specific.'):
+        return f'{prefix}{uuid.uuid4().hex}'
+
+    async def group_add(self, group, channel):
+        await asyncio.to_thread(self.state.group_add, group, channel)
+
+    async def group_discard(self, group, channel):
+        await asyncio.to_thread(self.state.group_discard, group, channel)
+
+    async def group_send(self, group, message):
+        await asyncio.to_thread(self.state.group_send, group, message)
+
+
+@contextmanager
+def shared_channel_layer(context):
+    """Yields a CHANNEL_LAYERS entry shared by every process, Redis when REDIS_URL is set."""
+    from django.conf import settings
+    if settings.REDIS_URL:
+        yield settings.CHANNEL_LAYERS['default']
+        return
+    authkey = uuid.uuid4().hex
+    manager = LayerStateManager(address=('127.0.0.1', 0), authkey=authkey.encode(), ctx=context)
+    manager.start()
+    try:
+        yield {
+            'BACKEND': 'ws_api.testing.SharedProcessChannelLayer',
+            'CONFIG': {'address': manager.address, 'authkey': authkey},
+        }
+    finally:
+        manager.shutdown()
+
+
+def run_node(role, layer_config, ready, results, user_id=1):
+    """
+        Entry point of a spawned server process. The 'receiver' holds a socket of the user,
+        the 'sender' emits a message event for that user once the socket is connected.
+    """
+    import django
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'messer_backend.settings')
+    django.setup()
+    from django.conf import settings
+    settings.CHANNEL_LAYERS = {'default': layer_config}
+    if role == 'receiver':
+        asyncio.run(_receive(user_id, ready, results))
+    else:
+        from .dispatch import push_to_user
+        ready.wait(30)
+        push_to_user(user_id, 'received_message_callback', {'content': f'sent from {os.getpid()}'})
+
+
+async def _receive(user_id, ready, results):
+    from channels.testing import WebsocketCommunicator
+    from api.models import DefaultUser
+    from .consumers import AsyncAPIConsumer
+    communicator = WebsocketCommunicator(AsyncAPIConsumer.as_asgi(), '/ws/ws-api-async/')
+    communicator.scope['user'] = DefaultUser(id=user_id, username=f'user{user_id}')
+    await communicator.connect()
+    ready.set()
+    try:
+        results.put(await communicator.receive_json_from(timeout=30))
+    finally:
+        await communicator.disconnect()
@@ -1,3 +1,1058 @@
-from django.test import TestCase
+import os
+import gzip
+import json
+import time
+import asyncio
+import tempfile
+import tracemalloc
+from io import StringIO
+from unittest import mock
+from datetime import timedelta
+import multiprocessing
+from importlib import import_module
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.conf import settings
+from django.core.management import call_command, CommandError
+from django.db import connection, DatabaseError
+from django.test import TestCase, SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from api import friendships, metrics
+from api.models import DefaultUser, Friendship, FriendRequest, Message, ArchivedMessage, ConversationSummary, \
+    UserEvent
+from api.friends import get_friends
+from api.serializers import MessageOutSerializer, FriendRequestOutSerializer, MessageRowSerializer
+from api.tests import metric_value
+from . import frames
+from .auth import TokenAuthMiddleware, token_user
+from .consumers import APIConsumer, AsyncAPIConsumer
+from .dispatch import user_group
+from .outbox import Outbox, stats as outbox_stats
+from .presence import Presence
+from .testing import shared_channel_layer, run_node
 
-# Create your tests here.
+
+class RecordingConsumer(APIConsumer):
+
+    def __init__(self, user):
+        super().__init__()
+        self.scope = {'user': user}
+        self.user = user
+        self.sent = []
+
+    def wrap_and_send(self, msg_type, content):
+        self.sent.append({'type': msg_type, 'content': content})
+
+
+def create_user(username):
+    return DefaultUser.objects.create(username=username, email=f'{username}@messer.local')
+
+
+class FriendsTestCase(TestCase):
+    """A user and their friend, with a RecordingConsumer of the user and an empty cache."""
+
+    def setUp(self):
+        cache.clear()
+        self.user, self.friend = create_user('user'), create_user('friend')
+        self.friendship = Friendship.objects.create(user=self.user, friend=self.friend)
+        self.consumer = RecordingConsumer(self.user)
+
+
+class BulkReadQueryCountTests(FriendsTestCase):
+
+    def add_messages(self, count):
+        Message.objects.bulk_create(
+            [Message(friendship=self.friendship, sender=self.user, recipient=self.friend, content='sent')
+             for _ in range(count)] +
+            [Message(friendship=self.friendship, sender=self.friend, recipient=self.user, content='received')
+             for _ in range(count)])
+
+    def add_friend_requests(self, count):
+        for i in range(count):
+            other = create_user(f'other{DefaultUser.objects.count()}')
+            FriendRequest.objects.create(from_user=other, to_user=self.user)
+            FriendRequest.objects.create(from_user=self.user, to_user=other)
+
+    def test_get_messages_query_count_is_constant(self):
+        for count in (1, 25):
+            self.add_messages(count)
+            with self.assertNumQueries(2):
+                self.consumer.handle_request({'endpoint': 'get_messages', 'content': {}})
+
+    def test_get_messages_page_query_count_is_constant(self):
+        get_friends(self.user.id)
+        for count in (1, 25):
+            self.add_messages(count)
+            with self.assertNumQueries(1):
+                self.consumer.handle_request({'endpoint': 'get_messages', 'content': {'friend': 'friend'}})
+
+    def test_get_friend_requests_query_count_is_constant(self):
+        for count in (1, 10):
+            self.add_friend_requests(count)
+            with self.assertNumQueries(2):
+                self.consumer.handle_request({'endpoint': 'get_friend_requests', 'content': {}})
+
+    def test_rows_match_model_serializers(self):
+        self.add_messages(2)
+        self.add_friend_requests(1)
+        self.consumer.handle_request({'endpoint': 'get_messages', 'content': {}})
+        self.consumer.handle_request({'endpoint': 'get_friend_requests', 'content': {}})
+        messages, friend_requests = self.consumer.sent[0]['content'], self.consumer.sent[1]['content']
+        expected = MessageOutSerializer(Message.objects.filter(sender=self.user), many=True).data
+        self.assertEqual(messages['sent_messages'], [dict(row) for row in expected])
+        expected = FriendRequestOutSerializer(FriendRequest.objects.filter(to_user=self.user), many=True).data
+        self.assertEqual(friend_requests['received_friend_requests'], [dict(row) for row in expected])
+
+
+class EncodingConsumer(RecordingConsumer):
+    """Encodes its frames like a socket would and keeps only their type and size."""
+
+    def wrap_and_send(self, msg_type, content):
+        self.sent.append({'type': msg_type, 'size': len(self.encode_frame(msg_type, content)['text_data'])})
+
+
+class StreamingHistoryTests(FriendsTestCase):
+
+    def add_messages(self, sent, received):
+        Message.objects.bulk_create(
+            [Message(friendship=self.friendship, sender=self.user, recipient=self.friend, content='sent')
+             for _ in range(sent)] +
+            [Message(friendship=self.friendship, sender=self.friend, recipient=self.user, content='x' * 100)
+             for _ in range(received)], batch_size=1000)
+
+    def stream(self, consumer, endpoint, chunk_size):
+        consumer.handle_request({'endpoint': endpoint, 'content': {'stream': True, 'chunk_size': chunk_size}})
+        return consumer.sent
+
+    def test_chunks_cover_the_history(self):
+        self.add_messages(sent=120, received=250)
+        consumer = RecordingConsumer(self.user)
+        consumer.handle_request({'endpoint': 'get_messages', 'content': {}})
+        whole = consumer.sent[0]['content']
+        frames = self.stream(RecordingConsumer(self.user), 'get_messages', 100)
+        self.assertEqual({frame['type'] for frame in frames}, {'messages_chunk'})
+        chunks = [frame['content'] for frame in frames]
+        self.assertEqual([chunk['chunk'] for chunk in chunks], list(range(5)))
+        self.assertEqual([chunk['final'] for chunk in chunks], [False] * 4 + [True])
+        self.assertEqual([len(chunk['messages']) for chunk in chunks], [100, 100, 50, 100, 20])
+        for kind in ('received_messages', 'sent_messages'):
+            streamed = [row for chunk in chunks if chunk['kind'] == kind for row in chunk['messages']]
+            self.assertEqual(streamed, whole[kind])
+
+    def test_empty_history_sends_a_final_chunk(self):
+        frames = self.stream(RecordingConsumer(self.user), 'get_friend_requests', 100)
+        self.assertEqual(frames, [{'type': 'friend_requests_chunk', 'content': {
+            'chunk': 0, 'kind': 'received_friend_requests', 'friend_requests': [], 'final': True}}])
+
+    def test_memory_does_not_grow_with_the_history(self):
+        peaks = []
+        for total in (500, 4000):
+            self.add_messages(sent=0, received=total - Message.objects.count())
+            consumer = EncodingConsumer(self.user)
+            tracemalloc.start()
+            try:
+                self.stream(consumer, 'get_messages', 100)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(len(consumer.sent), total // 100)
+        self.assertLess(peaks[1], peaks[0] * 1.5)
+
+
+@override_settings(MESSAGE_ARCHIVE_AFTER_DAYS=10)
+class MessageArchiveTests(FriendsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # 40 messages a day apart, the first 30 past the hot window, then the last one sent live.
+        Message.objects.bulk_create([
+            Message(friendship=self.friendship, sender=self.user if i % 2 else self.friend,
+                    recipient=self.friend if i % 2 else self.user, content=f'message {i}', has_been_read=True)
+            for i in range(40)])
+        now = timezone.now()
+        for i, message in enumerate(Message.objects.order_by('id')):
+            Message.objects.filter(id=message.id).update(created_at=now - timedelta(days=40 - i, hours=-12))
+        self.last = Message.objects.create(friendship=self.friendship, sender=self.friend, recipient=self.user,
+                                           content='last')
+
+    def archive(self, *args):
+        call_command('archive_messages', *args, stdout=StringIO())
+
+    def walk(self, direction, limit=7):
+        """Every page of the conversation, from the newest back or from the oldest on."""
+        pages, cursor = [], None
+        while True:
+            content = {'friend': 'friend', 'limit': limit}
+            if cursor:
+                content[direction] = cursor
+            self.consumer.handle_request({'endpoint': 'get_messages', 'content': content})
+            page = self.consumer.sent.pop()['content']
+            pages.append(page['messages'])
+            if not page['has_more']:
+                return pages
+            cursor = page[direction]
+
+    def oldest_first(self):
+        first = self.walk('before', limit=200)[0][0]
+        pages, cursor = [], f"{first['created_at']}_{first['id'] - 1}"
+        while True:
+            self.consumer.handle_request({'endpoint': 'get_messages', 'content': {
+                'friend': 'friend', 'limit': 7, 'after': cursor}})
+            page = self.consumer.sent.pop()['content']
+            pages.append(page['messages'])
+            if not page['has_more']:
+                return pages
+            cursor = page['after']
+
+    def test_pages_read_through_the_archive(self):
+        before, after = self.walk('before'), self.oldest_first()
+        self.archive()
+        self.assertEqual(ArchivedMessage.objects.count(), 30)
+        self.assertEqual(Message.objects.count(), 11)
+        self.assertEqual(self.walk('before'), before)
+        self.assertEqual(self.oldest_first(), after)
+
+    def test_unread_and_last_messages_stay_in_the_table(self):
+        unread = Message.objects.order_by('id')[0]
+        Message.objects.filter(id=unread.id).update(has_been_read=False)
+        Message.objects.filter(id=self.last.id).update(created_at=timezone.now() - timedelta(days=50))
+        self.archive()
+        self.assertEqual(set(Message.objects.filter(created_at__lt=timezone.now() - timedelta(days=10))
+                             .values_list('id', flat=True)), {unread.id, self.last.id})
+
+    def test_hot_pages_skip_the_archive(self):
+        self.archive()
+        get_friends(self.user.id)
+        self.walk('before', limit=5)
+        with self.assertNumQueries(1):
+            self.consumer.handle_request({'endpoint': 'get_messages', 'content': {'friend': 'friend', 'limit': 5}})
+        with self.assertNumQueries(2):
+            self.consumer.handle_request({'endpoint': 'get_messages', 'content': {'friend': 'friend', 'limit': 15}})
+
+    def test_whole_history_includes_the_archive(self):
+        self.consumer.handle_request({'endpoint': 'get_messages', 'content': {}})
+        whole = self.consumer.sent.pop()['content']
+        self.archive()
+        self.consumer.handle_request({'endpoint': 'get_messages', 'content': {}})
+        self.assertEqual(self.consumer.sent.pop()['content'], whole)
+        self.consumer.handle_request({'endpoint': 'get_messages', 'content': {'stream': True, 'chunk_size': 8}})
+        chunks = [frame['content'] for frame in self.consumer.sent]
+        self.assertEqual([row for chunk in chunks if chunk['kind'] == 'received_messages'
+                          for row in chunk['messages']], whole['received_messages'])
+
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.archive('--export', directory, '--batch-size', '8')
+            [name] = os.listdir(directory)
+            with gzip.open(os.path.join(directory, name), 'rt') as export:
+                rows = [json.loads(line) for line in export]
+        self.assertEqual([row['id'] for row in rows], list(ArchivedMessage.objects.order_by('id')
+                                                            .values_list('id', flat=True)))
+        self.assertEqual(rows[0]['content'], 'message 0')
+
+    @override_settings(MESSAGE_ARCHIVE_AFTER_DAYS=None)
+    def test_disabled(self):
+        with self.assertRaisesMessage(CommandError, 'MESSAGE_ARCHIVE_AFTER_DAYS is not set.'):
+            self.archive()
+
+
+class FrameValidationTests(FriendsTestCase):
+
+    def receive(self, frame):
+        self.consumer.receive(json.dumps(frame))
+        return self.consumer.sent.pop()
+
+    def test_envelope_errors(self):
+        self.assertEqual(self.receive({}), {'type': 'Response', 'content': {
+            'endpoint': ['This field is required.'], 'content': ['This field is required.']}})
+        self.assertEqual(self.receive({'endpoint': 'nope', 'content': {}}), {'type': 'Response', 'content': {
+            'endpoint': ['"nope" is not a valid choice.']}})
+        self.assertEqual(self.receive([]), {'type': 'Response', 'content': {
+            'non_field_errors': ['Invalid data. Expected a dictionary, but got list.']}})
+
+    def test_content_errors(self):
+        self.assertEqual(self.receive({'endpoint': 'send_message', 'content': {'friend': 'friend'}}), {
+            'type': 'Response', 'content': {'content': ['This field is required.']}})
+        self.assertEqual(self.receive({'endpoint': 'send_message', 'content': {'friend': 'x', 'content': 'hi'}}), {
+            'type': 'Response', 'content': {'non_field_errors': ['That user is not in your friend list.']}})
+        self.assertEqual(self.receive({'endpoint': 'get_messages', 'content': {'friend': 'friend', 'limit': 0}}), {
+            'type': 'Response', 'content': {'limit': ['Ensure this value is greater than or equal to 1.']}})
+
+    def test_valid_frame_reaches_endpoint(self):
+        reply = self.receive({'endpoint': 'send_message', 'content': {'friend': 'friend', 'content': 'hi'}})
+        self.assertEqual(reply, {'type': 'Response', 'content': {'Success': 'Message sent.'}})
+        self.assertTrue(Message.objects.filter(sender=self.user, recipient=self.friend, content='hi').exists())
+
+
+class SendMessagesTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user, self.one, self.two = create_user('user'), create_user('one'), create_user('two')
+        create_user('stranger')
+        Friendship.objects.create(user=self.user, friend=self.one)
+        Friendship.objects.create(user=self.user, friend=self.two)
+        self.consumer = RecordingConsumer(self.user)
+        patcher = mock.patch('ws_api.dispatch.push_to_group')
+        self.push_to_group = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.messages = [{'client_id': 'a', 'friend': 'one', 'content': 'first'},
+                         {'client_id': 'b', 'friend': 'two', 'content': 'second'},
+                         {'client_id': 'c', 'friend': 'one', 'content': 'third'},
+                         {'client_id': 'd', 'friend': 'stranger', 'content': 'fourth'}]
+
+    def send(self, messages):
+        self.consumer.handle_request({'endpoint': 'send_messages', 'content': {'messages': messages}})
+        frame = self.consumer.sent.pop()
+        self.assertEqual(frame['type'], 'messages_sent')
+        return frame['content']
+
+    def test_each_message_is_acked_by_client_id(self):
+        acks = self.send(self.messages)
+        ids = dict(Message.objects.values_list('client_id', 'id'))
+        self.assertEqual(acks, {
+            'a': {'status': 'sent', 'id': ids['a']},
+            'b': {'status': 'sent', 'id': ids['b']},
+            'c': {'status': 'sent', 'id': ids['c']},
+            'd': {'status': 'error', 'error': 'That user is not in your friend list.'}
+        })
+
+    def test_one_batch_per_recipient(self):
+        self.send(self.messages)
+        batches = {call.args[0]: call.args[2] for call in self.push_to_group.call_args_list
+                   if call.args[1] == 'received_messages_callback'}
+        self.assertEqual(set(batches), {user_group(self.one.id), user_group(self.two.id)})
+        self.assertEqual([message['content'] for message in batches[user_group(self.one.id)]], ['first', 'third'])
+        self.assertEqual([message['content'] for message in batches[user_group(self.two.id)]], ['second'])
+        self.assertEqual(batches[user_group(self.one.id)][0]['from_user'], 'user')
+
+    def test_replayed_batch_is_acked_as_duplicates(self):
+        sent = self.send(self.messages[:2])
+        self.push_to_group.reset_mock()
+        acks = self.send(self.messages[:3])
+        self.assertEqual(acks['a'], {'status': 'duplicate', 'id': sent['a']['id']})
+        self.assertEqual(acks['b'], {'status': 'duplicate', 'id': sent['b']['id']})
+        self.assertEqual(acks['c']['status'], 'sent')
+        self.assertEqual(Message.objects.count(), 3)
+        self.assertEqual([call.args[2][0]['content'] for call in self.push_to_group.call_args_list], ['third'])
+
+    def test_messages_roll_back_with_their_events(self):
+        with mock.patch('ws_api.dispatch.record_events', side_effect=DatabaseError), self.assertRaises(DatabaseError):
+            self.send(self.messages)
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(ConversationSummary.objects.filter(last_message__isnull=False).exists())
+
+
+class MarkReadTests(FriendsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.messages = [Message.objects.create(friendship=self.friendship, sender=self.friend, recipient=self.user,
+                                                content=f'message {i}') for i in range(3)]
+        # Ties on created_at are broken by id.
+        Message.objects.update(created_at=self.messages[0].created_at)
+        patcher = mock.patch('ws_api.consumers.push_event')
+        self.push_event = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def mark_read(self, up_to=None):
+        content = {'friend': 'friend'}
+        if up_to is not None:
+            content['up_to'] = f'{self.messages[0].created_at.isoformat()}_{up_to.id}'
+        self.consumer.handle_request({'endpoint': 'mark_read', 'content': content})
+        return self.consumer.sent.pop()
+
+    def unread_count(self):
+        return ConversationSummary.objects.get(friendship=self.friendship, user=self.user).unread_count
+
+    def test_up_to_is_inclusive(self):
+        self.assertEqual(self.unread_count(), 3)
+        self.assertEqual(self.mark_read(up_to=self.messages[1]),
+                         {'type': 'Response', 'content': {'Success': 'Messages marked read.', 'count': 2}})
+        self.assertEqual(list(Message.objects.order_by('id').values_list('has_been_read', flat=True)),
+                         [True, True, False])
+        self.assertEqual(self.unread_count(), 1)
+        friend_id, event_type, callback, content = self.push_event.call_args.args
+        self.assertEqual((friend_id, event_type, callback), (self.friend.id, 'messages_read', 'messages_read_callback'))
+        self.assertEqual(content['friend'], 'user')
+        self.assertEqual(content['count'], 2)
+        self.assertTrue(content['up_to'].endswith(f'_{self.messages[1].id}'))
+
+    def test_cursor_from_a_pushed_created_at(self):
+        # As the API renders it, ending in 'Z'.
+        created_at = MessageRowSerializer.datetime_field.to_representation(self.messages[0].created_at)
+        self.assertTrue(created_at.endswith('Z'))
+        self.consumer.handle_request({'endpoint': 'mark_read', 'content': {
+            'friend': 'friend', 'up_to': f'{created_at}_{self.messages[1].id}'}})
+        self.assertEqual(self.consumer.sent.pop()['content']['count'], 2)
+
+    def test_marking_again_reads_nothing(self):
+        self.assertEqual(self.mark_read()['content']['count'], 3)
+        self.assertEqual(self.mark_read()['content']['count'], 0)
+        # One coalesced event for the three messages, none for the repeat.
+        self.assertEqual(self.push_event.call_count, 1)
+        self.assertIsNone(self.push_event.call_args.args[3]['up_to'])
+        self.assertEqual(self.unread_count(), 0)
+
+    def test_messages_sent_by_the_user_are_not_marked(self):
+        Message.objects.create(friendship=self.friendship, sender=self.user, recipient=self.friend, content='reply')
+        self.assertEqual(self.mark_read()['content']['count'], 3)
+        self.assertFalse(Message.objects.get(content='reply').has_been_read)
+
+    def test_reads_roll_back_with_their_event(self):
+        self.push_event.side_effect = DatabaseError
+        with self.assertRaises(DatabaseError):
+            self.mark_read()
+        self.assertFalse(Message.objects.filter(has_been_read=True).exists())
+        self.assertEqual(self.unread_count(), 3)
+
+
+class ConversationSummaryTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user, self.friend, self.other = create_user('user'), create_user('friend'), create_user('other')
+        Friendship.objects.create(user=self.user, friend=self.friend)
+        Friendship.objects.create(user=self.user, friend=self.other)
+        self.consumer, self.friend_consumer = RecordingConsumer(self.user), RecordingConsumer(self.friend)
+
+    def inbox(self, consumer):
+        consumer.handle_request({'endpoint': 'get_conversations', 'content': {}})
+        frame = consumer.sent.pop()
+        self.assertEqual(frame['type'], 'conversations')
+        return {row['friend']: row for row in frame['content']}
+
+    def test_summaries_follow_sent_and_read_messages(self):
+        self.consumer.handle_request({'endpoint': 'send_message', 'content': {'friend': 'friend', 'content': 'one'}})
+        self.consumer.handle_request({'endpoint': 'send_messages', 'content': {'messages': [
+            {'client_id': 'a', 'friend': 'friend', 'content': 'two'},
+            {'client_id': 'b', 'friend': 'friend', 'content': 'three ' + 'x' * 100}]}})
+        last = Message.objects.latest('id')
+        row = self.inbox(self.friend_consumer)['user']
+        self.assertEqual(row['unread_count'], 3)
+        self.assertEqual((row['last_message_id'], row['last_message_from']), (last.id, 'user'))
+        self.assertEqual(row['last_message_preview'], last.content[:50])
+        own = self.inbox(self.consumer)
+        self.assertEqual((own['friend']['unread_count'], own['friend']['last_message_id']), (0, last.id))
+        self.assertEqual((own['other']['unread_count'], own['other']['last_message_id']), (0, None))
+        self.friend_consumer.handle_request({'endpoint': 'mark_read', 'content': {'friend': 'user'}})
+        row = self.inbox(self.friend_consumer)['user']
+        self.assertEqual((row['unread_count'], row['last_message_id']), (0, last.id))
+
+    def test_inbox_is_one_query(self):
+        for friend in ('friend', 'other'):
+            self.consumer.handle_request({'endpoint': 'send_message', 'content': {'friend': friend, 'content': 'hi'}})
+        get_friends(self.user.id)
+        with self.assertNumQueries(1):
+            inbox = self.inbox(self.consumer)
+        # Most recent conversation first.
+        self.assertEqual(list(inbox), ['other', 'friend'])
+
+    def test_conversations_without_messages_come_last(self):
+        Friendship.objects.create(user=create_user('quiet'), friend=self.user)
+        self.consumer.handle_request({'endpoint': 'send_message', 'content': {'friend': 'friend', 'content': 'hi'}})
+        friends = list(self.inbox(self.consumer))
+        self.assertEqual(friends[0], 'friend')
+        self.assertEqual(set(friends[1:]), {'other', 'quiet'})
+
+
+class DispatchOnCommitTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user, self.friend = create_user('user'), create_user('friend')
+        FriendRequest.objects.create(from_user=self.friend, to_user=self.user)
+        get_friends(self.user.id)
+        self.channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        patcher = mock.patch('ws_api.dispatch.get_channel_layer', return_value=self.channel_layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cache_and_pushes_wait_for_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            friendships.accept_request(self.user, 'friend')
+        # Until then, a concurrent reader could only see, and cache, the old friend list.
+        self.assertNotIn('friend', get_friends(self.user.id))
+        self.channel_layer.group_send.assert_not_called()
+        for callback in callbacks:
+            callback()
+        self.assertIn('friend', get_friends(self.user.id))
+        pushed = {(call.args[0], call.args[1]['type']) for call in self.channel_layer.group_send.call_args_list}
+        self.assertEqual(pushed, {(user_group(self.user.id), 'new_friend_callback'),
+                                  (user_group(self.friend.id), 'new_friend_callback')})
+
+
+class GroupDeliveryTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user, self.friend, self.stranger = create_user('user'), create_user('friend'), create_user('stranger')
+        Friendship.objects.create(user=self.user, friend=self.friend)
+        patcher = mock.patch('ws_api.presence.registry', Presence(interval=3600, grace=5, heartbeat=3600))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_message_reaches_only_the_recipient(self):
+        async def connect(user):
+            communicator = WebsocketCommunicator(APIConsumer.as_asgi(), '/ws/ws-api/')
+            communicator.scope['user'] = user
+            await communicator.connect()
+            return communicator
+
+        async def exchange():
+            user, friend, stranger = [await connect(user) for user in (self.user, self.friend, self.stranger)]
+            await user.send_json_to({'endpoint': 'send_message', 'content': {'friend': 'friend', 'content': 'hi'}})
+            self.assertEqual(await user.receive_json_from(), {'type': 'Response',
+                                                              'content': {'Success': 'Message sent.'}})
+            frame = await friend.receive_json_from()
+            self.assertEqual((frame['type'], frame['content']['content']), ('received_message', 'hi'))
+            self.assertTrue(await stranger.receive_nothing())
+            self.assertTrue(await user.receive_nothing())
+            for communicator in (user, friend, stranger):
+                await communicator.disconnect()
+
+        # The sync consumer's handlers run on this thread, their transactions commit and push.
+        async_to_sync(exchange)()
+
+
+class RemovedFriendTests(TransactionTestCase):
+
+    def test_message_to_a_friend_removed_meanwhile(self):
+        user, friend = create_user('user'), create_user('friend')
+        Friendship.objects.create(user=user, friend=friend)
+        consumer = RecordingConsumer(user)
+        get_friends(user.id)
+        # Removed by another worker after the list was cached.
+        with mock.patch('api.friends.invalidate_friends'):
+            Friendship.objects.get().delete()
+        consumer.handle_request({'endpoint': 'send_message', 'content': {'friend': 'friend', 'content': 'hi'}})
+        self.assertEqual(consumer.sent, [{'type': 'Response',
+                                          'content': {'Error': 'That user is not in your friend list.'}}])
+        self.assertFalse(Message.objects.exists())
+
+
+class SyncTests(FriendsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.friend_consumer = RecordingConsumer(self.friend)
+
+    def sync(self, **content):
+        self.consumer.handle_request({'endpoint': 'sync', 'content': content})
+        return self.consumer.sent.pop()['content']
+
+    def test_sync_replays_events_after_cursor(self):
+        self.friend_consumer.handle_request({'endpoint': 'send_message',
+                                             'content': {'friend': 'user', 'content': 'one'}})
+        everything = self.sync()
+        self.assertEqual([event['type'] for event in everything['events']], ['new_friend', 'received_message'])
+        self.assertEqual(everything['cursor'], 2)
+        self.friend_consumer.handle_request({'endpoint': 'send_messages', 'content': {'messages': [
+            {'friend': 'user', 'content': 'two', 'client_id': 'a'},
+            {'friend': 'user', 'content': 'three', 'client_id': 'b'}]}})
+        Friendship.objects.get().delete()
+        with self.assertNumQueries(1):
+            update = self.sync(cursor=everything['cursor'])
+        self.assertEqual([(event['seq'], event['type']) for event in update['events']],
+                         [(3, 'received_message'), (4, 'received_message'), (5, 'removed_friend')])
+        self.assertEqual([event['content']['content'] for event in update['events'][:2]], ['two', 'three'])
+        self.assertEqual(update['cursor'], 5)
+        self.assertFalse(update['has_more'])
+        self.assertEqual(self.sync(cursor=5), {'events': [], 'cursor': 5, 'has_more': False,
+                                               'resync_required': False})
+
+    def send(self, count):
+        for i in range(count):
+            self.friend_consumer.handle_request({'endpoint': 'send_message',
+                                                 'content': {'friend': 'user', 'content': str(i)}})
+
+    @override_settings(EVENT_LOG_MAX_EVENTS=2)
+    def test_logs_are_capped_per_user(self):
+        self.send(3)
+        out = StringIO()
+        call_command('prune_events', stdout=out)
+        self.assertIn('pruned 2 events', out.getvalue())
+        self.assertEqual(list(UserEvent.objects.filter(user=self.user).values_list('seq', flat=True)), [3, 4])
+        self.assertEqual(list(UserEvent.objects.filter(user=self.friend).values_list('seq', flat=True)), [1])
+        resync = {'events': [], 'cursor': 4, 'has_more': False, 'resync_required': True}
+        self.assertEqual(self.sync(), resync)
+        self.assertEqual(self.sync(cursor=1), resync)
+        self.assertEqual([event['seq'] for event in self.sync(cursor=2)['events']], [3, 4])
+
+    def test_old_events_are_pruned(self):
+        self.send(2)
+        UserEvent.objects.filter(seq=1).update(created_at=timezone.now() - timedelta(days=31))
+        with override_settings(EVENT_LOG_MAX_AGE_DAYS=30):
+            call_command('prune_events', stdout=StringIO())
+        self.assertTrue(self.sync()['resync_required'])
+        update = self.sync(cursor=1)
+        self.assertFalse(update['resync_required'])
+        self.assertEqual([event['seq'] for event in update['events']], [2, 3])
+        # Nothing new and nothing lost since the cursor.
+        self.assertFalse(self.sync(cursor=3)['resync_required'])
+
+    def test_sync_pages_with_limit(self):
+        for i in range(3):
+            self.friend_consumer.handle_request({'endpoint': 'send_message',
+                                                 'content': {'friend': 'user', 'content': str(i)}})
+        page = self.sync(cursor=1, limit=2)
+        self.assertEqual([event['seq'] for event in page['events']], [2, 3])
+        self.assertTrue(page['has_more'])
+        self.assertEqual([event['seq'] for event in self.sync(cursor=page['cursor'])['events']], [4])
+
+    def test_logs_of_users_are_numbered_separately(self):
+        self.consumer.handle_request({'endpoint': 'send_message', 'content': {'friend': 'friend', 'content': 'hi'}})
+        self.friend_consumer.handle_request({'endpoint': 'mark_read', 'content': {'friend': 'user'}})
+        self.assertEqual(list(UserEvent.objects.filter(user=self.friend).values_list('seq', 'type')),
+                         [(1, 'new_friend'), (2, 'received_message')])
+        self.assertEqual(list(UserEvent.objects.filter(user=self.user).values_list('seq', 'type')),
+                         [(1, 'new_friend'), (2, 'messages_read')])
+
+
+class SearchUsersTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = create_user('user')
+        for username in ('Anna', 'anna', 'annabel', 'Ann', 'anders', 'bob', 'annafriend'):
+            create_user(username)
+        Friendship.objects.create(user=self.user, friend=DefaultUser.objects.get(username='annafriend'))
+        self.consumer = RecordingConsumer(self.user)
+
+    def search(self, **content):
+        self.consumer.handle_request({'endpoint': 'search_users', 'content': content})
+        return self.consumer.sent.pop()['content']['users']
+
+    def test_prefix_is_case_insensitive_and_excludes_friends(self):
+        self.assertEqual(self.search(query='ANN'), ['Ann', 'Anna', 'anna', 'annabel'])
+        self.assertEqual(self.search(query='us'), [])
+        self.assertEqual(self.search(query='a', limit=2), ['anders', 'Ann'])
+
+    def test_search_is_one_query_once_friends_are_cached(self):
+        get_friends(self.user.id)
+        with self.assertNumQueries(1):
+            self.search(query='an')
+
+
+class WireProtocolTests(FriendsTestCase):
+
+    async def connect(self, subprotocols):
+        communicator = WebsocketCommunicator(APIConsumer.as_asgi(), '/ws/ws-api/', subprotocols=subprotocols)
+        communicator.scope['user'] = self.user
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, subprotocol
+
+    async def test_plain_json_without_subprotocol(self):
+        communicator, subprotocol = await self.connect([])
+        await communicator.send_json_to({'endpoint': 'get_conversations', 'content': {}})
+        frame = await communicator.receive_json_from()
+        await communicator.disconnect()
+        self.assertIsNone(subprotocol)
+        self.assertEqual(frame['type'], 'conversations')
+
+    async def test_msgpack_round_trip(self):
+        communicator, subprotocol = await self.connect(['unknown', frames.SUBPROTOCOL_MSGPACK])
+        codec = frames.MessagePackCodec(subprotocol)
+        await communicator.send_to(**codec.encode({'endpoint': 'send_message',
+                                                   'content': {'friend': 'friend', 'content': 'hi'}}))
+        response = await communicator.receive_from()
+        await communicator.disconnect()
+        self.assertEqual(subprotocol, frames.SUBPROTOCOL_MSGPACK)
+        self.assertEqual(response[:1], frames.PLAIN)
+        self.assertEqual(codec.decode(response), {'type': 'Response', 'content': {'Success': 'Message sent.'}})
+
+    def test_codes_round_trip_data_keys(self):
+        codec = frames.MessagePackCodec(frames.SUBPROTOCOL_MSGPACK_DEFLATE, deflate_threshold=64)
+        acks = {'type': 'messages_sent', 'content': {'id': {'status': 'sent', 'id': 1}, '7': {'status': 'error'}}}
+        page = {'type': 'messages_page', 'content': {'messages': [{'from_user': 'user', 'content': 'x' * 100}]}}
+        for data in (acks, page):
+            self.assertEqual(codec.decode(codec.encode(data)['bytes_data']), data)
+        self.assertEqual(codec.encode(page)['bytes_data'][:1], frames.DEFLATE)
+        self.assertIsNone(codec.decode(frames.DEFLATE + frames.deflate(b'\x00' * (frames.MAX_INFLATED_SIZE + 1))))
+
+
+class PipeliningTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = create_user('user')
+        patcher = mock.patch('ws_api.presence.registry', Presence(interval=3600, grace=5, heartbeat=3600))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(WS_API_MAX_PIPELINED_REQUESTS=3)
+    async def test_reads_overlap_writes_keep_order_and_excess_is_refused(self):
+        started, release = [], asyncio.Event()
+
+        async def run_in_db_pool(func, msg):
+            started.append(msg['content']['n'])
+            await release.wait()
+
+        communicator = WebsocketCommunicator(AsyncAPIConsumer.as_asgi(), '/ws/ws-api-async/')
+        communicator.scope['user'] = self.user
+        await communicator.connect()
+        with mock.patch('ws_api.consumers.run_in_db_pool', run_in_db_pool):
+            for n, endpoint in enumerate(('send_message', 'send_message', 'get_messages', 'get_messages')):
+                await communicator.send_json_to({'endpoint': endpoint, 'content': {'n': n}})
+            self.assertEqual(await communicator.receive_json_from(),
+                             {'type': 'Response', 'content': {'Error': 'Too many requests in flight.'}})
+            # The second write waits for the first, the read does not.
+            self.assertEqual(started, [0, 2])
+            release.set()
+            await asyncio.sleep(0.05)
+            self.assertEqual(started, [0, 2, 1])
+        await communicator.disconnect()
+
+
+@override_settings(METRICS_ENABLED=True)
+class MetricsTests(FriendsTestCase):
+
+    async def test_endpoints_and_sockets_are_recorded(self):
+        requests = 'messer_request_duration_seconds_count{transport="ws",endpoint="get_conversations"}'
+        sockets = 'messer_open_sockets{consumer="APIConsumer"}'
+        size = 'messer_response_size_bytes_sum{transport="ws",endpoint="get_conversations"}'
+        before = metrics.registry.render()
+        communicator = WebsocketCommunicator(APIConsumer.as_asgi(), '/ws/ws-api/')
+        communicator.scope['user'] = self.user
+        await communicator.connect()
+        await communicator.send_json_to({'endpoint': 'get_conversations', 'content': {}})
+        frame = await communicator.receive_from()
+        during = metrics.registry.render()
+        await communicator.disconnect()
+        after = metrics.registry.render()
+        self.assertEqual(metric_value(after, requests), metric_value(before, requests) + 1)
+        self.assertEqual(metric_value(after, size), metric_value(before, size) + len(frame.encode()))
+        self.assertEqual(metric_value(during, sockets), metric_value(before, sockets) + 1)
+        self.assertEqual(metric_value(after, sockets), metric_value(before, sockets))
+        self.assertIn('messer_connected_users{sockets="1"}', during)
+        self.assertIn('messer_outbox_frames_total', during)
+
+
+class PresenceRegistryTests(SimpleTestCase):
+
+    def setUp(self):
+        self.presence = Presence(interval=1, grace=5, heartbeat=30)
+        self.announced = []
+
+        async def announce(changes):
+            self.announced.append([(change['user'], change['online']) for change in changes])
+
+        self.presence.announce = announce
+
+    def tick(self, now):
+        async_to_sync(self.presence.tick)(now)
+
+    def test_reconnects_within_the_grace_period_do_not_flap(self):
+        self.presence.connected(1, 'user')
+        self.tick(100)
+        self.presence.disconnected(1, now=101)
+        self.presence.connected(1, 'user')
+        self.tick(102)
+        self.presence.disconnected(1, now=103)
+        self.tick(104)
+        self.tick(107)
+        self.assertEqual(self.announced, [[('user', True)]])
+        self.assertEqual(self.presence.describe('user', 1, now=107), {'user': 'user', 'online': True,
+                                                                      'last_seen': None})
+        self.tick(108.5)
+        self.assertEqual(self.announced, [[('user', True)], [('user', False)]])
+        self.assertEqual(self.presence.describe('user', 1, now=108.5), {'user': 'user', 'online': False,
+                                                                        'last_seen': '1970-01-01T00:01:43Z'})
+
+    def test_changes_of_a_round_are_announced_together(self):
+        self.presence.connected(1, 'one')
+        self.presence.connected(2, 'two')
+        self.presence.connected(3, 'three')
+        self.presence.disconnected(3)
+        self.tick(time.time())
+        self.assertEqual(sorted(self.announced[0]), [('one', True), ('two', True)])
+
+    def test_sockets_of_other_processes(self):
+        self.presence.received({'type': 'presence.update', 'node': 'other', 'full': True,
+                                'users': [[1, 2, None], [2, 1, None]]}, now=100)
+        self.assertTrue(self.presence.describe('one', 1)['online'])
+        self.presence.received({'type': 'presence.update', 'node': 'other', 'full': False,
+                                'users': [[1, 0, 150]]}, now=150)
+        self.assertEqual(self.presence.describe('one', 1), {'user': 'one', 'online': False,
+                                                           'last_seen': '1970-01-01T00:02:30Z'})
+        self.tick(150 + 3 * 30 + 1)
+        self.assertFalse(self.presence.describe('two', 2)['online'])
+
+
+class PresenceTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user, self.one, self.two = create_user('user'), create_user('one'), create_user('two')
+        Friendship.objects.create(user=self.user, friend=self.one)
+        Friendship.objects.create(user=self.user, friend=self.two)
+        self.presence = Presence(interval=3600, grace=5, heartbeat=3600)
+        patcher = mock.patch('ws_api.presence.registry', self.presence)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(AsyncAPIConsumer.as_asgi(), '/ws/ws-api-async/')
+        communicator.scope['user'] = user
+        await communicator.connect()
+        return communicator
+
+    async def test_friends_get_one_frame_per_round(self):
+        user, one, two = [await self.connect(user) for user in (self.user, self.one, self.two)]
+        await self.presence.tick()
+        frame = await user.receive_json_from()
+        self.assertEqual(frame['type'], 'presence')
+        self.assertEqual(sorted(frame['content']['users'], key=lambda entry: entry['user']), [
+            {'user': 'one', 'online': True, 'last_seen': None}, {'user': 'two', 'online': True, 'last_seen': None}])
+        self.assertEqual(await one.receive_json_from(), {'type': 'presence', 'content': {'users': [
+            {'user': 'user', 'online': True, 'last_seen': None}]}})
+        await two.receive_json_from()
+        await two.disconnect()
+        await self.presence.tick(time.time() + 10)
+        frame = await user.receive_json_from()
+        self.assertEqual([(entry['user'], entry['online']) for entry in frame['content']['users']], [('two', False)])
+        self.assertTrue(await one.receive_nothing())
+        await user.disconnect()
+        await one.disconnect()
+
+    def test_get_presence_needs_no_query(self):
+        self.presence.connected(self.one.id, 'one')
+        consumer = RecordingConsumer(self.user)
+        get_friends(self.user.id)
+        with self.assertNumQueries(0):
+            consumer.handle_request({'endpoint': 'get_presence', 'content': {}})
+        self.assertEqual(consumer.sent, [{'type': 'presence', 'content': {'users': [
+            {'user': 'one', 'online': True, 'last_seen': None},
+            {'user': 'two', 'online': False, 'last_seen': None}]}}])
+
+
+class SessionCheckTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = create_user('user')
+        self.session = import_module(settings.SESSION_ENGINE).SessionStore()
+        self.session['user'] = self.user.id
+        self.session.save()
+        self.consumer = RecordingConsumer(self.user)
+        self.consumer.scope['session'] = self.session
+        self.consumer.close = mock.Mock()
+        get_friends(self.user.id)
+
+    def request(self, now):
+        with mock.patch('ws_api.consumers.time.monotonic', return_value=now):
+            self.consumer.handle_request({'endpoint': 'get_presence', 'content': {}})
+        return self.consumer.sent.pop()
+
+    @override_settings(WS_API_SESSION_CHECK_TTL=60)
+    def test_session_store_is_read_once_per_ttl(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.request(1000)['type'], 'presence')
+        with self.assertNumQueries(0):
+            self.request(1030)
+            self.request(1059)
+        with self.assertNumQueries(1):
+            self.request(1060)
+        self.consumer.close.assert_not_called()
+
+    @override_settings(WS_API_SESSION_CHECK_TTL=60)
+    def test_ended_session_closes_the_socket(self):
+        self.request(1000)
+        self.session.delete()
+        # Still trusted within the TTL, then refused.
+        self.assertEqual(self.request(1030)['type'], 'presence')
+        self.assertEqual(self.request(1061), {'type': 'Response',
+                                              'content': {'Error': 'Authentication Failed: Login Required!'}})
+        self.consumer.close.assert_called_once_with()
+
+
+class TokenAuthTests(FriendsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+        self.token = self.client.post('/api/connection-token/').json()['token']
+        self.application = TokenAuthMiddleware(APIConsumer.as_asgi())
+        patcher = mock.patch('ws_api.presence.registry', Presence(interval=3600, grace=5, heartbeat=3600))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def handshake(self, path, headers=()):
+        """Connects and disconnects, returns whether the socket was accepted and the queries run."""
+        async def connect():
+            communicator = WebsocketCommunicator(self.application, path, headers=list(headers))
+            connected, _ = await communicator.connect()
+            await communicator.disconnect()
+            return connected
+
+        # The sync consumer's handlers run on this thread, and its connection.
+        with CaptureQueriesContext(connection) as queries:
+            connected = async_to_sync(connect)()
+        return connected, len(queries)
+
+    def test_handshake_runs_no_query(self):
+        cookie = f'{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}'
+        connected, queries = self.handshake('/ws/ws-api/', [(b'cookie', cookie.encode())])
+        self.assertTrue(connected)
+        self.assertGreater(queries, 0)
+        self.assertEqual(self.handshake(f'/ws/ws-api/?token={self.token}'), (True, 0))
+
+    async def test_invalid_and_expired_tokens_are_refused(self):
+        for path in ('/ws/ws-api/?token=invalid', f'/ws/ws-api/?token={self.token}x'):
+            connected, _ = await WebsocketCommunicator(self.application, path).connect()
+            self.assertFalse(connected)
+        with override_settings(WS_API_TOKEN_MAX_AGE=-1):
+            connected, _ = await WebsocketCommunicator(self.application, f'/ws/ws-api/?token={self.token}').connect()
+        self.assertFalse(connected)
+
+    async def test_logout_closes_token_sockets(self):
+        communicator = WebsocketCommunicator(self.application, f'/ws/ws-api/?token={self.token}')
+        await communicator.connect()
+        await communicator.send_json_to({'endpoint': 'get_conversations', 'content': {}})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'conversations')
+
+        def logout():
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post('/api/logout/')
+
+        await database_sync_to_async(logout)()
+        self.assertEqual(await communicator.receive_from(), 'Connection closing: Logging out.')
+        self.assertEqual((await communicator.receive_output())['type'], 'websocket.close')
+
+    async def test_token_is_refused_after_logout(self):
+        await database_sync_to_async(self.client.post)('/api/logout/')
+        connected, _ = await WebsocketCommunicator(self.application, f'/ws/ws-api/?token={self.token}').connect()
+        self.assertFalse(connected)
+
+    async def test_token_lookup_does_not_block_the_event_loop(self):
+        session_key = await database_sync_to_async(lambda: self.client.session.session_key)()
+        with mock.patch('api.tokens.cache') as token_cache:
+            token_cache.aget = mock.AsyncMock(return_value=session_key)
+            connected, _ = await WebsocketCommunicator(self.application, f'/ws/ws-api/?token={self.token}').connect()
+        self.assertTrue(connected)
+        token_cache.aget.assert_awaited_once()
+        token_cache.get.assert_not_called()
+
+    def token_consumer(self):
+        consumer = RecordingConsumer(token_user(self.user.id, 'user'))
+        consumer.scope['session'] = import_module(settings.SESSION_ENGINE).SessionStore(self.client.session.session_key)
+        consumer.scope['token_auth'] = True
+        consumer.close = mock.Mock()
+        return consumer
+
+    def request(self, consumer, now):
+        with mock.patch('ws_api.consumers.time.monotonic', return_value=now):
+            consumer.handle_request({'endpoint': 'get_presence', 'content': {}})
+        return consumer.sent.pop()
+
+    @override_settings(WS_API_SESSION_CHECK_TTL=60)
+    def test_session_and_user_are_checked_once_per_ttl(self):
+        consumer = self.token_consumer()
+        get_friends(self.user.id)
+        # The session and the user.
+        with self.assertNumQueries(2):
+            self.assertEqual(self.request(consumer, 1000)['type'], 'presence')
+        with self.assertNumQueries(0):
+            self.request(consumer, 1059)
+        with self.assertNumQueries(2):
+            self.request(consumer, 1060)
+
+    @override_settings(WS_API_SESSION_CHECK_TTL=60)
+    def test_ended_session_and_inactive_user_fail_requests(self):
+        refused = {'type': 'Response', 'content': {'Error': 'Authentication Failed: Login Required!'}}
+        consumer = self.token_consumer()
+        self.request(consumer, 1000)
+        self.client.session.delete()
+        self.assertEqual(self.request(consumer, 1030)['type'], 'presence')
+        self.assertEqual(self.request(consumer, 1060), refused)
+        consumer.close.assert_called_once_with()
+
+        self.client.force_login(self.user)
+        consumer = self.token_consumer()
+        self.request(consumer, 1000)
+        DefaultUser.objects.filter(id=self.user.id).update(is_active=False)
+        self.assertEqual(self.request(consumer, 1060), refused)
+
+    def test_token_user_loads_other_fields_on_access(self):
+        user = token_user(self.user.id, 'user')
+        with self.assertNumQueries(0):
+            self.assertEqual((user.id, user.username, user.is_authenticated), (self.user.id, 'user', True))
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, 'user@messer.local')
+
+
+class OutboxTests(SimpleTestCase):
+
+    async def burst(self, consumer_class, count):
+        communicator = WebsocketCommunicator(consumer_class.as_asgi(), '/ws/ws-api/')
+        communicator.scope['user'] = DefaultUser(id=1, username='user')
+        await communicator.connect()
+        for i in range(count):
+            await get_channel_layer().group_send(user_group(1), {'type': 'received_message_callback',
+                                                                 'content': {'content': i}})
+        received = []
+        while len(received) < count:
+            frame = await communicator.receive_json_from()
+            received.append(frame)
+            if frame['type'] == 'batch':
+                received[-1:] = frame['content']
+        await communicator.disconnect()
+        return received
+
+    async def test_burst_is_coalesced(self):
+        for consumer_class in (APIConsumer, AsyncAPIConsumer):
+            frames_before = outbox_stats.frames
+            received = await self.burst(consumer_class, 50)
+            self.assertEqual([frame['content']['content'] for frame in received], list(range(50)))
+            self.assertEqual({frame['type'] for frame in received}, {'received_message'})
+            self.assertLess(outbox_stats.frames - frames_before, 50)
+
+    async def test_overflow_drops_and_reports(self):
+        sent = []
+
+        async def send(msg_type, content):
+            sent.append((msg_type, content))
+
+        outbox = Outbox(send, None, window=0, high_water=3, overflow='drop')
+        for i in range(5):
+            await outbox.put('received_message', i)
+        self.assertEqual(outbox.depth, 3)
+        await outbox.flusher
+        self.assertEqual(sent, [('batch', [{'type': 'received_message', 'content': i} for i in range(3)] +
+                                 [{'type': 'dropped', 'content': {'count': 2}}])])
+
+    async def test_overflow_disconnects(self):
+        closed = []
+
+        async def close():
+            closed.append(True)
+
+        outbox = Outbox(None, close, window=0, high_water=1, overflow='disconnect')
+        with self.assertLogs('ws_api.outbox', 'WARNING'):
+            for i in range(3):
+                await outbox.put('received_message', i)
+        self.assertEqual(closed, [True])
+        self.assertEqual(outbox.depth, 0)
+
+
+class CrossProcessDeliveryTests(SimpleTestCase):
+
+    def test_event_reaches_socket_in_another_process(self):
+        context = multiprocessing.get_context('spawn')
+        with shared_channel_layer(context) as layer_config:
+            ready, results = context.Event(), context.Queue()
+            nodes = [context.Process(target=run_node, args=(role, layer_config, ready, results))
+                     for role in ('receiver', 'sender')]
+            for node in nodes:
+                node.start()
+            frame = results.get(timeout=60)
+            for node in nodes:
+                node.join(30)
+        receiver, sender = nodes
+        self.assertEqual(frame, {'type': 'received_message', 'content': {'content': f'sent from {sender.pid}'}})
+        self.assertEqual([node.exitcode for node in nodes], [0, 0])
@@ -1,6 +1,7 @@
 from django.urls import re_path
-from .consumers import APIConsumer
+from .consumers import APIConsumer, AsyncAPIConsumer
 
 websocket_urlpatterns = [
-    re_path('ws/ws-api/', APIConsumer.as_asgi())
+    re_path('ws/ws-api/', APIConsumer.as_asgi()),
+    re_path('ws/ws-api-async/', AsyncAPIConsumer.as_asgi()),
 ]
\ No newline at end of file